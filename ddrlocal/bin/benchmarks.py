@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+#
+# This file is part of ddr-local
+#
+#
+
+description = """Micro-benchmarks for ddrlocal.models hot spots."""
+
+epilog = """
+Benchmarks use synthetic in-memory data; nothing is read from or written to a Store.
+Each benchmark compares the previous implementation with the current one.
+
+    load_json - Populating an object from JSON data (see ddrlocal.models.schema).
+    duplicates - Entity.detect_file_duplicates and rm_file_duplicates
+                 (10,000 file dicts, 10% duplicated).
+    labels_values - Entity.labels_values; display_* hooks looked up by name
+                 vs. FieldSchema hook tables.
+"""
+
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'ddrlocal.settings')
+
+
+class Thing( object ):
+    pass
+
+def report( name, old, new, number ):
+    print('%s' % name)
+    print('    old: %.6f sec/object' % (old / number))
+    print('    new: %.6f sec/object' % (new / number))
+    print('    speedup: %.1fx' % (old / new))
+
+
+# load_json ------------------------------------------------------------
+
+def entity_json_data( num_files ):
+    """Fake entity.json data: every ENTITY_FIELDS field plus num_files file dicts.
+    """
+    from ddrlocal.models import entity as entitymodule
+    data = [{'application': 'https://github.com/densho/ddr-local.git',
+             'commit': '', 'release': '', 'git': ''}]
+    for f in entitymodule.ENTITY_FIELDS:
+        data.append({f['name']: f.get('default', '')})
+    for item in data:
+        if 'record_created' in item: item['record_created'] = '2014-01-01T00:00:00'
+        if 'record_lastmod' in item: item['record_lastmod'] = '2014-01-01T00:00:00'
+    files = [{'path_rel': 'ddr-test-123-1-master-%010d.jpg' % n,
+              'role': 'master',
+              'sha1': '%040d' % n, 'sha256': '', 'md5': '', 'public': 1,}
+             for n in range(num_files)]
+    for item in data:
+        if 'files' in item:
+            item['files'] = files
+    return data
+
+def load_json_old( obj, json_data ):
+    """Entity.load_json as it was before ddrlocal.models.schema (minus file objects).
+    """
+    from datetime import datetime
+    from django.conf import settings
+    from ddrlocal.models import entity as entitymodule
+    for ff in entitymodule.ENTITY_FIELDS:
+        for f in json_data:
+            if hasattr(f, 'keys') and (f.keys()[0] == ff['name']):
+                setattr(obj, f.keys()[0], f.values()[0])
+    def parsedt(txt):
+        d = datetime.now()
+        try:
+            d = datetime.strptime(txt, settings.DATETIME_FORMAT)
+        except:
+            try:
+                d = datetime.strptime(txt, settings.TIME_FORMAT)
+            except:
+                pass
+        return d
+    if hasattr(obj, 'record_created') and obj.record_created: obj.record_created = parsedt(obj.record_created)
+    if hasattr(obj, 'record_lastmod') and obj.record_lastmod: obj.record_lastmod = parsedt(obj.record_lastmod)
+    for ff in entitymodule.ENTITY_FIELDS:
+        if not hasattr(obj, ff['name']):
+            setattr(obj, ff['name'], ff.get('default',None))
+
+def bench_load_json( args ):
+    from ddrlocal.models import schema
+    data = entity_json_data(args.files)
+    old = timeit.timeit(lambda: load_json_old(Thing(), data), number=args.number)
+    new = timeit.timeit(lambda: schema.ENTITY.load(Thing(), data), number=args.number)
+    report('load_json (entity, %s files, %s JSON items)' % (args.files, len(data)),
+           old, new, args.number)
+
+
+# duplicates -----------------------------------------------------------
+
+DUPLICATES_FILES = 10000
+
+def duplicates_entity( num_files ):
+    """Fake entity with num_files file dicts/objects, every tenth one a duplicate.
+    """
+    fdicts = []
+    for n in range(num_files):
+        if n % 10 == 9:
+            fdicts.append(dict(fdicts[n - 1]))
+            continue
+        fdicts.append({'path_rel': 'ddr-test-123-1-master-%010d.jpg' % n,
+                       'role': ['master','mezzanine'][n % 2],
+                       'sha1': '%040d' % n, 'sha256': '', 'md5': '', 'public': 1,})
+    entity = Thing()
+    entity._files = fdicts
+    entity.files = []
+    for fdict in fdicts:
+        f = Thing()
+        f.__dict__.update(fdict)
+        entity.files.append(f)
+    entity._load_file_objects = lambda: None
+    return entity
+
+def detect_file_duplicates_old( entity, role ):
+    """Entity.detect_file_duplicates before (path_rel, role, sha1) keys.
+    Compares file dicts since the old f2 == f test compared object identity.
+    """
+    duplicates = []
+    for x,f in enumerate(entity._files):
+        for y,f2 in enumerate(entity._files):
+            if (f2 == f) and (f['role'] == role) and (y != x) and (f not in duplicates):
+                duplicates.append(f)
+    return duplicates
+
+def rm_file_duplicates_old( entity ):
+    new_files = []
+    for f in entity._files:
+        if f not in new_files:
+            new_files.append(f)
+    entity.files = new_files
+
+def bench_duplicates( args ):
+    from ddrlocal.models import DDRLocalEntity
+    detect = DDRLocalEntity.detect_file_duplicates.im_func
+    rm = DDRLocalEntity.rm_file_duplicates.im_func
+    entity = duplicates_entity(DUPLICATES_FILES)
+    old_found = detect_file_duplicates_old(entity, 'master')
+    new_found = detect(entity, 'master')
+    assert [f['path_rel'] for f in old_found] == [f.path_rel for f in new_found]
+    # the old versions are quadratic; one run is plenty
+    old = timeit.timeit(lambda: detect_file_duplicates_old(entity, 'master'), number=1)
+    new = timeit.timeit(lambda: detect(entity, 'master'), number=1)
+    report('detect_file_duplicates (%s files)' % DUPLICATES_FILES, old, new, 1)
+    old = timeit.timeit(lambda: rm_file_duplicates_old(duplicates_entity(DUPLICATES_FILES)), number=1)
+    new = timeit.timeit(lambda: rm(duplicates_entity(DUPLICATES_FILES)), number=1)
+    report('rm_file_duplicates (%s files)' % DUPLICATES_FILES, old, new, 1)
+
+
+# labels_values --------------------------------------------------------
+
+def module_function_old( module, function_name, value ):
+    """DDR.models.module_function: look the function up by name on every call.
+    """
+    if (function_name in dir(module)):
+        function = getattr(module, function_name)
+        value = function(value)
+    return value
+
+def labels_values_old( entity ):
+    """Entity.labels_values before ddrlocal.models.schema hook tables.
+    """
+    from ddrlocal.models import entity as entitymodule
+    lv = []
+    for f in entitymodule.ENTITY_FIELDS:
+        if hasattr(entity, f['name']) and f.get('form',None):
+            key = f['name']
+            label = f['form']['label']
+            value = module_function_old(entitymodule,
+                                        'display_%s' % key,
+                                        getattr(entity, f['name']))
+            lv.append( {'label':label, 'value':value,} )
+    return lv
+
+def bench_labels_values( args ):
+    from ddrlocal.models import DDRLocalEntity
+    from ddrlocal.models import schema
+    labels_values = DDRLocalEntity.labels_values.im_func
+    entity = Thing()
+    schema.ENTITY.load(entity, entity_json_data(0))
+    assert labels_values_old(entity) == labels_values(entity)
+    old = timeit.timeit(lambda: labels_values_old(entity), number=args.number)
+    new = timeit.timeit(lambda: labels_values(entity), number=args.number)
+    report('labels_values (entity, %s fields)' % len(schema.ENTITY.form_fields),
+           old, new, args.number)
+
+
+BENCHMARKS = {
+    'load_json': bench_load_json,
+    'duplicates': bench_duplicates,
+    'labels_values': bench_labels_values,
+}
+
+def main():
+
+    parser = argparse.ArgumentParser(description=description, epilog=epilog,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('benchmark', nargs='*', help='Benchmark(s) to run (default: all): %s.' % ', '.join(sorted(BENCHMARKS.keys())))
+    parser.add_argument('-n', '--number', type=int, default=1000, help='Number of iterations.')
+    parser.add_argument('-f', '--files', type=int, default=1000, help='Number of files in synthetic entities.')
+
+    args = parser.parse_args()
+    names = args.benchmark or sorted(BENCHMARKS.keys())
+    for name in names:
+        if name not in BENCHMARKS:
+            parser.error('unknown benchmark: %s' % name)
+    for name in names:
+        BENCHMARKS[name](args)
+
+if __name__ == '__main__':
+    main()
@@ -1,16 +1,16 @@
 from datetime import datetime, date
+from distutils.spawn import find_executable
 import hashlib
-import json
 import logging
 logger = logging.getLogger(__name__)
+from multiprocessing.pool import ThreadPool
 import os
 import re
-from StringIO import StringIO
 import shutil
 import sys
+import threading
 import traceback
 
-import envoy
 from lxml import etree
 
 from django.conf import settings
@@ -20,18 +20,36 @@ from DDR import dvcs
 from DDR import imaging
 from DDR import natural_order_string, natural_sort
 from DDR.models import Collection as DDRCollection, Entity as DDREntity
-from DDR.models import dissect_path, file_hash, _inheritable_fields, _inherit
+from DDR.models import dissect_path, _inheritable_fields, _inherit
 from DDR.models import module_function, module_xml_function, write_json
 from ddrlocal import VERSION, COMMIT
 from ddrlocal.models import collection as collectionmodule
 from ddrlocal.models import entity as entitymodule
 from ddrlocal.models import files as filemodule
+from ddrlocal.models import cache
+from ddrlocal.models import catalog
+from ddrlocal.models import hashing
+from ddrlocal.models import links as linkgraph
+from ddrlocal.models import manifest
+from ddrlocal.models import schema
 from ddrlocal.models.meta import CollectionJSON, EntityJSON, read_json
+from ddrlocal.models.meta import patch_json_file_dict
 from ddrlocal.models.xml import EAD, METS
+from ddrlocal.models.xml import trees as xmltrees
 
 COLLECTION_FILES_PREFIX = 'files'
 ENTITY_FILES_PREFIX = 'files'
 
+# namespaces passed to the mets_* functions in ddrlocal.models.entity
+METS_NAMESPACES = {
+    'mets':  'http://www.loc.gov/METS/',
+    'mix':   'http://www.loc.gov/mix/v10',
+    'mods':  'http://www.loc.gov/mods/v3',
+    'rts':   'http://cosimo.stanford.edu/sdr/metsrights/',
+    'xlink': 'http://www.w3.org/1999/xlink',
+    'xsi':   'http://www.w3.org/2001/XMLSchema-instance',
+}
+
 MODEL_FIELDS = [
     {
         'name':       '',       # The field name.
@@ -55,6 +73,58 @@ MODEL_FIELDS = [
 ]
 
 
+# git/git-annex version banners, keyed by repo path
+# Cleared when the binaries change and on worker start (see webui.tasks).
+_GIT_VERSION = {}
+_GIT_VERSION_BINARIES = {}
+_GIT_VERSION_LOCK = threading.Lock()
+
+def _git_binaries_signature():
+    """(path, mtime, size, inode) of the git and git-annex executables.
+    """
+    sig = []
+    for name in ['git', 'git-annex']:
+        path = _GIT_VERSION_BINARIES.get(name)
+        if not path:
+            path = _GIT_VERSION_BINARIES[name] = find_executable(name)
+        try:
+            st = os.stat(path)
+            sig.append((path, st.st_mtime, st.st_size, st.st_ino))
+        except (OSError, TypeError):
+            # look it up again next time
+            _GIT_VERSION_BINARIES.pop(name, None)
+            sig.append((path, None, None, None))
+    return tuple(sig)
+
+def git_version_clear():
+    """Forget cached git/git-annex versions.
+    """
+    with _GIT_VERSION_LOCK:
+        _GIT_VERSION.clear()
+        _GIT_VERSION_BINARIES.clear()
+
+def git_version( repo_path=None ):
+    """Memoized DDR.dvcs.git_version.
+    
+    The version banner is stamped into the header of every JSON file we
+    write; computing it spawns git and git-annex.  Results are cached per
+    process and per repo, and recomputed if the git or git-annex binaries
+    change (i.e. a package upgrade).
+    
+    @param repo_path: Absolute path to repository.
+    @returns: str
+    """
+    binaries = _git_binaries_signature()
+    with _GIT_VERSION_LOCK:
+        cached = _GIT_VERSION.get(repo_path)
+    if cached and (cached[0] == binaries):
+        return cached[1]
+    version = dvcs.git_version(repo_path)
+    with _GIT_VERSION_LOCK:
+        _GIT_VERSION[repo_path] = (binaries, version)
+    return version
+
+
 
 class DDRLocalCollection( DDRCollection ):
     """
@@ -95,6 +165,8 @@ class DDRLocalCollection( DDRCollection ):
         '/tmp/ddr-testing-123/collection.json'
         """
         super(DDRLocalCollection, self).__init__(*args, **kwargs)
+        # field values as of last load/write, by output; see schema.FieldSchema.snapshot
+        self._snapshots = {}
         self.id = self.uid
         self.repo = self.id.split('-')[0]
         self.org = self.id.split('-')[1]
@@ -137,40 +209,43 @@ class DDRLocalCollection( DDRCollection ):
         >>> c.entities()
         [<DDRLocalEntity ddr-testing-123-1>, <DDRLocalEntity ddr-testing-123-2>, ...]
         
+        Quick list comes from the collection's entity manifest
+        (see ddrlocal.models.manifest).  For paging, sorting, and filtering
+        see ddrlocal.models.catalog.
+
         @param quick: Boolean List only titles and IDs
         """
         # empty class used for quick view
         class ListEntity( object ):
             def __repr__(self):
                 return "<DDRListEntity %s>" % (self.id)
+        if quick:
+            entities = []
+            for m in manifest.entities(self.path):
+                # fake Entity with just enough info for lists
+                e = ListEntity()
+                e.id = e.uid = m['id']
+                e.repo,e.org,e.cid,e.eid = m['id'].split('-')
+                e.title = m['title']
+                e.record_lastmod = m['record_lastmod']
+                e.file_count = m['files']
+                e.public = m['public']
+                e.status = m['status']
+                entities.append(e)
+            return entities
         entity_paths = []
         if os.path.exists(self.files_path):
-            # TODO use cached list if available
             for eid in os.listdir(self.files_path):
                 path = os.path.join(self.files_path, eid)
                 entity_paths.append(path)
         entity_paths = natural_sort(entity_paths)
         entities = []
         for path in entity_paths:
-            if quick:
-                # fake Entity with just enough info for lists
-                entity_json_path = os.path.join(path,'entity.json')
-                if os.path.exists(entity_json_path):
-                    with open(entity_json_path, 'r') as f:
-                        for line in f.readlines():
-                            if '"title":' in line:
-                                e = ListEntity()
-                                e.id = e.uid = eid = os.path.basename(path)
-                                e.repo,e.org,e.cid,e.eid = eid.split('-')
-                                # make a miniature JSON doc out of just title line
-                                e.title = json.loads('{%s}' % line)['title']
-                                entities.append(e)
-            else:
-                entity = DDRLocalEntity.from_json(path)
-                for lv in entity.labels_values():
-                    if lv['label'] == 'title':
-                        entity.title = lv['value']
-                entities.append(entity)
+            entity = DDRLocalEntity.from_json(path)
+            for lv in entity.labels_values():
+                if lv['label'] == 'title':
+                    entity.title = lv['value']
+            entities.append(entity)
         return entities
     
     def inheritable_fields( self ):
@@ -193,14 +268,13 @@ class DDRLocalCollection( DDRCollection ):
         module the contents of the field will be passed to it
         """
         lv = []
-        for f in collectionmodule.COLLECTION_FIELDS:
-            if hasattr(self, f['name']) and f.get('form',None):
-                key = f['name']
+        display = schema.COLLECTION.display
+        for f in schema.COLLECTION.form_fields:
+            key = f['name']
+            if hasattr(self, key):
                 label = f['form']['label']
                 # run display_* functions on field data if present
-                value = module_function(collectionmodule,
-                                        'display_%s' % key,
-                                        getattr(self, f['name']))
+                value = display[key](getattr(self, key))
                 lv.append( {'label':label, 'value':value,} )
         return lv
     
@@ -217,14 +291,12 @@ class DDRLocalCollection( DDRCollection ):
         @returns data: dict object as used by Django Form object.
         """
         data = {}
-        for f in collectionmodule.COLLECTION_FIELDS:
-            if hasattr(self, f['name']) and f.get('form',None):
-                key = f['name']
+        formprep = schema.COLLECTION.formprep
+        for f in schema.COLLECTION.form_fields:
+            key = f['name']
+            if hasattr(self, key):
                 # run formprep_* functions on field data if present
-                value = module_function(collectionmodule,
-                                        'formprep_%s' % key,
-                                        getattr(self, f['name']))
-                data[key] = value
+                data[key] = formprep[key](getattr(self, key))
         return data
     
     def form_post(self, form):
@@ -238,16 +310,33 @@ class DDRLocalCollection( DDRCollection ):
         
         @param form
         """
-        for f in collectionmodule.COLLECTION_FIELDS:
-            if hasattr(self, f['name']) and f.get('form',None):
-                key = f['name']
+        formpost = schema.COLLECTION.formpost
+        for f in schema.COLLECTION.form_fields:
+            key = f['name']
+            if hasattr(self, key):
                 # run formpost_* functions on field data if present
-                cleaned_data = module_function(collectionmodule,
-                                               'formpost_%s' % key,
-                                               form.cleaned_data[key])
-                setattr(self, key, cleaned_data)
-        # update record_lastmod
-        self.record_lastmod = datetime.now()
+                setattr(self, key, formpost[key](form.cleaned_data[key]))
+        # update record_lastmod if anything actually changed
+        if self.changed_fields():
+            self.record_lastmod = datetime.now()
+    
+    def changed_fields( self, output='json' ):
+        """Names of fields changed since the collection was loaded or output written.
+        
+        @param output: 'json' or 'ead'
+        @returns: list of fieldnames
+        """
+        return schema.COLLECTION.changed(self, self._snapshots.get(output, None))
+    
+    def _mark_clean( self, *outputs ):
+        """Records current field values as those in the output files.
+        """
+        snapshot = schema.COLLECTION.snapshot(self)
+        # new dict; cached copies of this object share the old one
+        snapshots = dict(self._snapshots)
+        for output in outputs:
+            snapshots[output] = snapshot
+        self._snapshots = snapshots
     
     def json( self ):
         """Returns a ddrlocal.models.meta.CollectionJSON object
@@ -264,12 +353,17 @@ class DDRLocalCollection( DDRCollection ):
         
         >>> c = DDRLocalCollection.from_json('/tmp/ddr-testing-123')
         """
+        signature = cache.collection_signature(collection_abs)
+        collection = cache.objects.get(DDRLocalCollection, collection_abs, signature)
+        if collection:
+            return collection
         collection = DDRLocalCollection(collection_abs)
         collection_uid = collection.id  # save this just in case
         collection.load_json(collection.json_path)
         if not collection.id:
             # id gets overwritten if collection.json is blank
             collection.id = collection_uid
+        cache.objects.put(DDRLocalCollection, collection_abs, signature, collection)
         return collection
     
     def load_json(self, path):
@@ -280,39 +374,33 @@ class DDRLocalCollection( DDRCollection ):
         
         @param path: Absolute path to collection directory
         """
-        json_data = self.json().data
-        for ff in collectionmodule.COLLECTION_FIELDS:
-            for f in json_data:
-                if hasattr(f, 'keys') and (f.keys()[0] == ff['name']):
-                    setattr(self, f.keys()[0], f.values()[0])
-        # special cases
-        if hasattr(self, 'record_created') and self.record_created:
-            self.record_created = datetime.strptime(self.record_created, settings.DATETIME_FORMAT)
-        else:
-            self.record_created = datetime.now()
-        if hasattr(self, 'record_lastmod') and self.record_lastmod:
-            self.record_lastmod = datetime.strptime(self.record_lastmod, settings.DATETIME_FORMAT)
-        else:
-            self.record_lastmod = datetime.now()
-        # end special cases
-        # Ensure that every field in collectionmodule.COLLECTION_FIELDS is represented
-        # even if not present in json_data.
-        for ff in collectionmodule.COLLECTION_FIELDS:
-            if not hasattr(self, ff['name']):
-                setattr(self, ff['name'], ff.get('default',None))
+        # Sets fields, parses record_created/record_lastmod, and ensures that
+        # every field in COLLECTION_FIELDS is represented even if not present
+        # in json_data.  See ddrlocal.models.schema.
+        schema.COLLECTION.load(self, self.json().data)
+        self._mark_clean('json', 'ead')
     
     def dump_json(self, path=None, template=False):
         """Dump Collection data to .json file.
         
         TODO This should not actually write the JSON! It should return JSON to the code that calls it.
         
+        Does nothing if no field has changed since the collection was loaded
+        or its JSON was last written.
+        
         @param path: [optional] Alternate file path.
         @param template: [optional] Boolean. If true, write default values for fields.
+        @returns: True if the file was written.
         """
+        if not path:
+            path = self.json_path
+        own = (path == self.json_path) and not template
+        if own and os.path.exists(path) and not self.changed_fields('json'):
+            return False
         collection = [{'application': 'https://github.com/densho/ddr-local.git',
                        'commit': COMMIT,
                        'release': VERSION,
-                       'git': dvcs.git_version(self.path),}]
+                       'git': git_version(self.path),}]
         template_passthru = ['id', 'record_created', 'record_lastmod']
         for ff in collectionmodule.COLLECTION_FIELDS:
             item = {}
@@ -331,9 +419,12 @@ class DDRLocalCollection( DDRCollection ):
                 # end special cases
             item[key] = val
             collection.append(item)
-        if not path:
-            path = self.json_path
         write_json(collection, path)
+        cache.objects.invalidate(self.path)
+        if own:
+            catalog.store_catalog().update_collection(self.path, collection)
+            self._mark_clean('json')
+        return True
     
     def ead( self ):
         """Returns a ddrlocal.models.xml.EAD object for the collection.
@@ -349,9 +440,19 @@ class DDRLocalCollection( DDRCollection ):
         
         TODO render a Django/Jinja template instead of using lxml
         TODO This should not actually write the XML! It should return XML to the code that calls it.
+        
+        Does nothing if no field has changed since the collection was loaded
+        or its EAD was last written.
+        
+        @returns: True if the file was written.
         """
         NAMESPACES = None
-        tree = etree.fromstring(self.ead().xml)
+        # copy of cached parse of ead.xml (see xml.TreeCache)
+        if not os.path.exists(self.ead_path):
+            EAD.create(self.ead_path)
+        elif not self.changed_fields('ead'):
+            return False
+        tree = xmltrees.parse(self.ead_path).getroot()
         for f in collectionmodule.COLLECTION_FIELDS:
             key = f['name']
             value = ''
@@ -365,6 +466,9 @@ class DDRLocalCollection( DDRCollection ):
         xml_pretty = etree.tostring(tree, pretty_print=True)
         with open(self.ead_path, 'w') as f:
             f.write(xml_pretty)
+        xmltrees.put(self.ead_path)
+        self._mark_clean('ead')
+        return True
 
 
 
@@ -386,6 +490,8 @@ class DDRLocalEntity( DDREntity ):
     
     def __init__(self, *args, **kwargs):
         super(DDRLocalEntity, self).__init__(*args, **kwargs)
+        # field values as of last load/write, by output; see schema.FieldSchema.snapshot
+        self._snapshots = {}
         self.id = self.uid
         self.repo = self.id.split('-')[0]
         self.org = self.id.split('-')[1]
@@ -402,23 +508,31 @@ class DDRLocalEntity( DDREntity ):
     
     def files_master( self ):
         files = [f for f in self.files if hasattr(f,'role') and (f.role == 'master')]
-        return sorted(files, key=lambda f: f.sort)
+        return FileList(sorted(files, key=lambda f: f.sort))
     
     def files_mezzanine( self ):
         files = [f for f in self.files if hasattr(f,'role') and (f.role == 'mezzanine')]
-        return sorted(files, key=lambda f: f.sort)
+        return FileList(sorted(files, key=lambda f: f.sort))
     
     def detect_file_duplicates( self, role ):
         """Returns list of file dicts that appear in Entity.files more than once
         
+        Files are considered duplicates if they have the same
+        (path_rel, role, sha1) key; the first of each set is returned.
+        
         NOTE: This function looks only at the list of file dicts in entity.json;
         it does not examine the filesystem.
         """
+        counts = {}
+        for f in self.files:
+            key = file_duplicate_key(f)
+            counts[key] = counts.get(key, 0) + 1
         duplicates = []
-        for x,f in enumerate(self.files):
-            for y,f2 in enumerate(self.files):
-                if (f2 == f) and (f.role == role) and (y != x) and (f not in duplicates):
-                    duplicates.append(f)
+        for f in self.files:
+            key = file_duplicate_key(f)
+            if (f.role == role) and (counts[key] > 1):
+                duplicates.append(f)
+                counts[key] = 0  # only report first
         return duplicates
     
     def rm_file_duplicates( self ):
@@ -429,8 +543,11 @@ class DDRLocalEntity( DDREntity ):
         """
         # regenerate files list
         new_files = []
+        seen = set()
         for f in self._files:
-            if f not in new_files:
+            key = file_duplicate_key(f)
+            if key not in seen:
+                seen.add(key)
                 new_files.append(f)
         self.files = new_files
         # reload objects
@@ -452,12 +569,43 @@ class DDRLocalEntity( DDREntity ):
             self.files.append(newfile)
             return 'added'
         # get a file
+        key = (role, sha1[:10])
+        n = self._files_index().get(key, None)
+        if n is not None:
+            f = self.files[n]
+            if file_index_key(f) == key:
+                return f
+        # index is stale (i.e. a file's sha1 or role was changed in place)
         for f in self.files:
-            if (f.sha1[:10] == sha1[:10]) and (f.role == role):
+            if file_index_key(f) == key:
+                self._index_files()
                 return f
         # just do nothing
         return None
     
+    def _index_files( self ):
+        """Indexes positions in self.files by (role, sha1[:10]); see file().
+        
+        The index is tagged with the FileList version so any change to
+        the list causes it to be rebuilt.
+        """
+        index = {}
+        for n,f in enumerate(self.files):
+            key = file_index_key(f)
+            if key not in index:  # first match wins, like the old linear scan
+                index[key] = n
+        self._files_idx = (getattr(self.files, 'version', None), len(self.files), index)
+        return index
+    
+    def _files_index( self ):
+        """Returns index from _index_files, rebuilding it if self.files has changed.
+        """
+        idx = getattr(self, '_files_idx', None)
+        version = getattr(self.files, 'version', None)
+        if idx and (version is not None) and (idx[0] == version) and (idx[1] == len(self.files)):
+            return idx[2]
+        return self._index_files()
+    
     def _addfile_log_path( self ):
         """Generates path to collection addfiles.log.
         
@@ -519,14 +667,13 @@ class DDRLocalEntity( DDREntity ):
         module it will be executed.
         """
         lv = []
-        for f in entitymodule.ENTITY_FIELDS:
-            if hasattr(self, f['name']) and f.get('form',None):
-                key = f['name']
+        display = schema.ENTITY.display
+        for f in schema.ENTITY.form_fields:
+            key = f['name']
+            if hasattr(self, key):
                 label = f['form']['label']
                 # run display_* functions on field data if present
-                value = module_function(entitymodule,
-                                        'display_%s' % key,
-                                        getattr(self, f['name']))
+                value = display[key](getattr(self, key))
                 lv.append( {'label':label, 'value':value,} )
         return lv
     
@@ -540,14 +687,12 @@ class DDRLocalEntity( DDREntity ):
         @returns data: dict object as used by Django Form object.
         """
         data = {}
-        for f in entitymodule.ENTITY_FIELDS:
-            if hasattr(self, f['name']) and f.get('form',None):
-                key = f['name']
+        formprep = schema.ENTITY.formprep
+        for f in schema.ENTITY.form_fields:
+            key = f['name']
+            if hasattr(self, key):
                 # run formprep_* functions on field data if present
-                value = module_function(entitymodule,
-                                        'formprep_%s' % key,
-                                        getattr(self, f['name']))
-                data[key] = value
+                data[key] = formprep[key](getattr(self, key))
         if not data.get('record_created', None):
             data['record_created'] = datetime.now()
         if not data.get('record_lastmod', None):
@@ -563,16 +708,44 @@ class DDRLocalEntity( DDREntity ):
         
         @param form
         """
-        for f in entitymodule.ENTITY_FIELDS:
-            if hasattr(self, f['name']) and f.get('form',None):
-                key = f['name']
+        formpost = schema.ENTITY.formpost
+        for f in schema.ENTITY.form_fields:
+            key = f['name']
+            if hasattr(self, key):
                 # run formpost_* functions on field data if present
-                cleaned_data = module_function(entitymodule,
-                                               'formpost_%s' % key,
-                                               form.cleaned_data[key])
-                setattr(self, key, cleaned_data)
-        # update record_lastmod
-        self.record_lastmod = datetime.now()
+                setattr(self, key, formpost[key](form.cleaned_data[key]))
+        # update record_lastmod if anything actually changed
+        if self.changed_fields():
+            self.record_lastmod = datetime.now()
+    
+    def changed_fields( self, output='json' ):
+        """Names of fields changed since the entity was loaded or output written.
+        
+        The file list only counts for entity.json.
+        
+        @param output: 'json' or 'mets'
+        @returns: list of fieldnames
+        """
+        snapshot = self._snapshots.get(output, None)
+        changed = schema.ENTITY.changed(self, snapshot)
+        if (output == 'json') \
+                and ((snapshot is None) or (snapshot['files'] != self._files_signature())):
+            changed.append('files')
+        return changed
+    
+    def _files_signature( self ):
+        return [entity_file_dict(f) for f in self.files]
+    
+    def _mark_clean( self, *outputs ):
+        """Records current field values as those in the output files.
+        """
+        snapshot = schema.ENTITY.snapshot(self)
+        snapshot['files'] = self._files_signature()
+        # new dict; cached copies of this object share the old one
+        snapshots = dict(self._snapshots)
+        for output in outputs:
+            snapshots[output] = snapshot
+        self._snapshots = snapshots
     
     def json( self ):
         if not os.path.exists(self.json_path):
@@ -583,73 +756,68 @@ class DDRLocalEntity( DDREntity ):
     def from_json(entity_abs):
         entity = None
         if os.path.exists(entity_abs):
+            signature = cache.entity_signature(entity_abs)
+            entity = cache.objects.get(DDRLocalEntity, entity_abs, signature)
+            if entity:
+                return entity
             entity = DDRLocalEntity(entity_abs)
             entity_uid = entity.id
             entity.load_json(entity.json_path)
             if not entity.id:
                 entity.id = entity_uid  # might get overwritten if entity.json is blank
+            cache.objects.put(DDRLocalEntity, entity_abs, signature, entity)
         return entity
     
     def _load_file_objects( self ):
         """Replaces list of file info dicts with list of DDRLocalFile objects
         
         IMPORTANT: original 
+        Objects are LazyFile proxies; each file's JSON is only loaded
+        when something other than the entity.json file info is needed.
         """
         # keep copy of the list for detect_file_duplicates()
         self._files = [f for f in self.files]
-        self.files = []
+        self.files = FileList()
         for f in self._files:
             path_abs = os.path.join(self.files_path, f['path_rel'])
-            self.files.append(DDRLocalFile(path_abs=path_abs))
+            self.files.append(LazyFile(DDRLocalFile, path_abs, f))
+        # built before the object is cached so copies share it
+        self._index_files()
     
     def load_json(self, path):
         """Populate Entity data from .json file.
         @param path: Absolute path to entity
         """
-        json_data = self.json().data
-        
-        for ff in entitymodule.ENTITY_FIELDS:
-            for f in json_data:
-                if hasattr(f, 'keys') and (f.keys()[0] == ff['name']):
-                    setattr(self, f.keys()[0], f.values()[0])
-        
-        def parsedt(txt):
-            d = datetime.now()
-            try:
-                d = datetime.strptime(txt, settings.DATETIME_FORMAT)
-            except:
-                try:
-                    d = datetime.strptime(txt, settings.TIME_FORMAT)
-                except:
-                    pass
-            return d
-            
-        # special cases
-        if hasattr(self, 'record_created') and self.record_created: self.record_created = parsedt(self.record_created)
-        if hasattr(self, 'record_lastmod') and self.record_lastmod: self.record_lastmod = parsedt(self.record_lastmod)
-        # end special cases
-        
-        # Ensure that every field in entitymodule.ENTITY_FIELDS is represented
-        # even if not present in json_data.
-        for ff in entitymodule.ENTITY_FIELDS:
-            if not hasattr(self, ff['name']):
-                setattr(self, ff['name'], ff.get('default',None))
+        # Sets fields, parses record_created/record_lastmod, and ensures that
+        # every field in ENTITY_FIELDS is represented even if not present
+        # in json_data.  See ddrlocal.models.schema.
+        schema.ENTITY.load(self, self.json().data)
         
         # replace list of file paths with list of DDRLocalFile objects
         self._load_file_objects()
+        self._mark_clean('json', 'mets')
     
     def dump_json(self, path=None, template=False):
         """Dump Entity data to .json file.
         
         TODO This should not actually write the JSON! It should return JSON to the code that calls it.
         
+        Does nothing if no field (or file) has changed since the entity was
+        loaded or its JSON was last written.
+        
         @param path: [optional] Alternate file path.
         @param template: [optional] Boolean. If true, write default values for fields.
+        @returns: True if the file was written.
         """
+        if not path:
+            path = self.json_path
+        own = (path == self.json_path) and not template
+        if own and os.path.exists(path) and not self.changed_fields('json'):
+            return False
         entity = [{'application': 'https://github.com/densho/ddr-local.git',
                    'commit': COMMIT,
                    'release': VERSION,
-                   'git': dvcs.git_version(self.parent_path),}]
+                   'git': git_version(self.parent_path),}]
         exceptions = ['files', 'filemeta']
         template_passthru = ['id', 'record_created', 'record_lastmod']
         for ff in entitymodule.ENTITY_FIELDS:
@@ -681,9 +849,13 @@ class DDRLocalEntity( DDREntity ):
                         fd[key] = getattr(f, key, None)
                 files.append(fd)
         entity.append( {'files':files} )
-        if not path:
-            path = self.json_path
         write_json(entity, path)
+        cache.objects.invalidate(self.path)
+        if own:
+            manifest.update_entity(self.parent_path, self.id, entity)
+            catalog.store_catalog().update_entity(self.parent_path, self.id, entity)
+            self._mark_clean('json')
+        return True
     
     def mets( self ):
         if not os.path.exists(self.mets_path):
@@ -695,23 +867,18 @@ class DDRLocalEntity( DDREntity ):
         
         TODO render a Django/Jinja template instead of using lxml
         TODO This should not actually write the XML! It should return XML to the code that calls it.
+        
+        Does nothing if no field has changed since the entity was loaded
+        or its METS was last written.
+        
+        @returns: True if the file was written.
         """
-        NAMESPACES = {
-            'mets':  'http://www.loc.gov/METS/',
-            'mix':   'http://www.loc.gov/mix/v10',
-            'mods':  'http://www.loc.gov/mods/v3',
-            'rts':   'http://cosimo.stanford.edu/sdr/metsrights/',
-            'xlink': 'http://www.w3.org/1999/xlink',
-            'xsi':   'http://www.w3.org/2001/XMLSchema-instance',
-        }
-        NAMESPACES_TAGPREFIX = {}
-        for k,v in NAMESPACES.iteritems():
-            NAMESPACES_TAGPREFIX[k] = '{%s}' % v
-        NAMESPACES_XPATH = {'mets': NAMESPACES['mets'],}
-        NSMAP = {None : NAMESPACES['mets'],}
-        NS = NAMESPACES_TAGPREFIX
-        ns = NAMESPACES_XPATH
-        tree = etree.parse(StringIO(self.mets().xml))
+        # copy of cached parse of mets.xml (see xml.TreeCache)
+        if not os.path.exists(self.mets_path):
+            METS.create(self.mets_path)
+        elif not self.changed_fields('mets'):
+            return False
+        tree = xmltrees.parse(self.mets_path)
         for f in entitymodule.ENTITY_FIELDS:
             key = f['name']
             value = ''
@@ -720,13 +887,16 @@ class DDRLocalEntity( DDREntity ):
                 # run mets_* functions on field data if present
                 tree = module_xml_function(entitymodule,
                                            'mets_%s' % key,
-                                           tree, NAMESPACES, f,
+                                           tree, METS_NAMESPACES, f,
                                            value)
         xml_pretty = etree.tostring(tree, pretty_print=True)
         with open(self.mets_path, 'w') as f:
             f.write(xml_pretty)
+        xmltrees.put(self.mets_path)
+        self._mark_clean('mets')
+        return True
     
-    def add_file( self, git_name, git_mail, src_path, role, data, agent='' ):
+    def add_file( self, git_name, git_mail, src_path, role, data, agent='', progress=None ):
         """Add file to entity
         
         This method breaks out of OOP and manipulates entity.json directly.
@@ -739,6 +909,7 @@ class DDRLocalEntity( DDREntity ):
         @param git_name: Username of git committer.
         @param git_mail: Email of git committer.
         @param agent: (optional) Name of software making the change.
+        @param progress: (optional) function(bytes_done, bytes_total) called while copying.
         @return file_ DDRLocalFile object
         """
         def crash(msg):
@@ -781,21 +952,21 @@ class DDRLocalEntity( DDREntity ):
         else:
             self.files_log(1, 'no XMP here')
         
-        self.files_log(1, 'Copying to work dir')
+        self.files_log(1, 'Copying to work dir and checksumming')
         size = os.path.getsize(src_path)
         self.files_log(1, 'size: %s' % size)
         tmp_path = os.path.join(tmp_dir, src_basename)
         self.files_log(1, 'cp %s %s' % (src_path, tmp_path))
-        shutil.copy(src_path, tmp_path)
+        # single read of the source: copy and all checksums in one pass
+        checksums = hashing.copy_and_hash(src_path, tmp_path, ['sha1', 'md5', 'sha256'], progress)
         os.chmod(tmp_path, 0644)
         if not os.path.exists(tmp_path):
             crash('Copy to work dir failed %s %s' % (src_path, tmp_path))
         
-        self.files_log(1, 'Checksumming')
-        sha1   = file_hash(tmp_path, 'sha1');   self.files_log(1, 'sha1: %s' % sha1)
-        md5    = file_hash(tmp_path, 'md5');    self.files_log(1, 'md5: %s' % md5)
-        sha256 = file_hash(tmp_path, 'sha256'); self.files_log(1, 'sha256: %s' % sha256)
-        if not sha1 and md5 and sha256:
+        sha1   = checksums['sha1'];   self.files_log(1, 'sha1: %s' % sha1)
+        md5    = checksums['md5'];    self.files_log(1, 'md5: %s' % md5)
+        sha256 = checksums['sha256']; self.files_log(1, 'sha256: %s' % sha256)
+        if not (sha1 and md5 and sha256):
             crash('Could not calculate checksums')
         
         # rename file now that we have checksum
@@ -880,6 +1051,7 @@ class DDRLocalEntity( DDREntity ):
                 self.files_log(0, 'FAIL')
                 failures.append(tmp)
                 break
+        cache.payloads.invalidate(self.files_path)
         # one of new_files failed to copy, so move all back to tmp
         if failures:
             self.files_log(0, '%s failures: %s' % (len(failures), failures))
@@ -1031,6 +1203,7 @@ class DDRLocalEntity( DDREntity ):
                 self.files_log(0, 'FAIL')
                 failures.append(tmp)
                 break
+        cache.payloads.invalidate(self.files_path)
         # one of new_files failed to copy, so move all back to tmp
         if failures:
             self.files_log(0, '%s failures: %s' % (len(failures), failures))
@@ -1088,42 +1261,102 @@ class DDRLocalEntity( DDREntity ):
             shutil.copy(file_json_backup, f.json_path)
             self.files_log(0, 'finished cleanup. good luck...')
             raise
-        return f.__dict__
+        return f.dict()
     
-    def checksums( self, algo ):
+    def checksums( self, algo, verify=False ):
         """Calculates hash checksums for the Entity's files.
         
         Gets hashes from FILE.json metadata if the file(s) are absent
         from the filesystem (i.e. git-annex file symlinks).
         Overrides DDR.models.Entity.checksums.
+        See checksums_multi.
         """
-        checksums = []
-        if algo not in self.checksum_algorithms():
-            raise Error('BAD ALGORITHM CHOICE: {}'.format(algo))
-        for f in self.file_paths():
-            cs = None
-            fpath = os.path.join(self.files_path, f)
-            # git-annex files are present
-            if os.path.exists(fpath) and not os.path.islink(fpath):
-                cs = file_hash(fpath, algo)
-            # git-annex files NOT present - get checksum from entity._files
-            # WARNING: THIS MODULE SHOULD NOT KNOW ANYTHING ABOUT HIGHER-LEVEL CODE!
-            elif os.path.islink(fpath) and hasattr(self, '_files'):
-                for fdict in self._files:
-                    if os.path.basename(fdict['path_rel']) == os.path.basename(fpath):
-                        cs = fdict[algo]
-            if cs:
-                checksums.append( (cs, fpath) )
+        return self.checksums_multi([algo], verify=verify)[algo]
+    
+    def checksums_multi( self, algos, threads=None, verify=False ):
+        """Calculates several hash checksums for the Entity's files at once.
+        
+        Each present file is read once for all algorithms.
+        Hashes for absent git-annex files (symlinks) are looked up by
+        basename in entity._files.
+        
+        @param algos: list of algorithm names (see checksum_algorithms).
+        @param threads: int (optional) Hash files in a pool of this many threads.
+        @param verify: Boolean Read files even if hashes are cached (see hashing.HashCache).
+        @returns: dict of algo:[(checksum, fpath), ...] in file_paths order,
+                  i.e. same structure as checksums(algo) for each algo.
+        """
+        for algo in algos:
+            if algo not in self.checksum_algorithms():
+                raise Error('BAD ALGORITHM CHOICE: {}'.format(algo))
+        # git-annex files NOT present - get checksum from entity._files
+        # WARNING: THIS MODULE SHOULD NOT KNOW ANYTHING ABOUT HIGHER-LEVEL CODE!
+        by_basename = {}
+        if hasattr(self, '_files'):
+            for fdict in self._files:
+                by_basename[os.path.basename(fdict['path_rel'])] = fdict
+        fpaths = [os.path.join(self.files_path, f) for f in self.file_paths()]
+        present = [fpath for fpath in fpaths
+                   if os.path.exists(fpath) and not os.path.islink(fpath)]
+        hash_one = lambda fpath: hashing.hash_file(fpath, algos, verify=verify)
+        if threads and (len(present) > 1):
+            pool = ThreadPool(threads)
+            try:
+                hashes = dict(zip(present, pool.map(hash_one, present)))
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            hashes = dict([(fpath, hash_one(fpath)) for fpath in present])
+        checksums = dict([(algo, []) for algo in algos])
+        for fpath in fpaths:
+            found = hashes.get(fpath, None)
+            if (found == None) and os.path.islink(fpath):
+                found = by_basename.get(os.path.basename(fpath), None)
+            if found:
+                for algo in algos:
+                    cs = found.get(algo, None)
+                    if cs:
+                        checksums[algo].append( (cs, fpath) )
         return checksums
 
 
+def file_duplicate_key( f ):
+    """Key used to detect duplicate files: (path_rel, role, sha1).
+    
+    @param f: file dict (entity._files) or file object (entity.files)
+    """
+    if isinstance(f, dict):
+        return (f.get('path_rel'), f.get('role'), f.get('sha1'))
+    return (getattr(f, 'path_rel', None), getattr(f, 'role', None), getattr(f, 'sha1', None))
+
+def file_index_key( f ):
+    """Key used by Entity.file() to find files: (role, sha1[:10]).
+    """
+    return (f.role, (f.sha1 or '')[:10])
 
+def entity_file_dict( f ):
+    """The ENTITY_FILE_KEYS of a file, as used to tell if entity.json is out of date.
+    
+    An unloaded LazyFile cannot have been modified so its entity.json
+    file dict is used as-is; this does not load file JSONs.
+    """
+    if isinstance(f, LazyFile) and not f.loaded():
+        return dict([(key, f._fdict[key]) for key in ENTITY_FILE_KEYS if key in f._fdict])
+    return dict([(key, getattr(f, key, None)) for key in ENTITY_FILE_KEYS if hasattr(f, key)])
+
+
+
+# keys of each file dict in entity.json 'files'
+# NOTE: sort was added so that files can be sorted without loading their
+# JSON (see LAZY_FILE_KEYS); entity.json written from then on has it.
 ENTITY_FILE_KEYS = ['path_rel',
                     'role',
                     'sha1',
                     'sha256',
                     'md5',
-                    'public',]
+                    'public',
+                    'sort',]
 
 FILE_KEYS = ['path_rel',
              'basename', 
@@ -1189,6 +1422,8 @@ class DDRLocalFile( object ):
         probably get it wrong and fail silently!
         TODO refactor and simplify this horrible code!
         """
+        # field values as of last load/write; see schema.FieldSchema.snapshot
+        self._snapshots = {}
         # accept either path_abs or path_rel
         if kwargs and kwargs.get('path_abs',None):
             self.path_abs = kwargs['path_abs']
@@ -1302,14 +1537,13 @@ class DDRLocalFile( object ):
         module it will be executed.
         """
         lv = []
-        for f in filemodule.FILE_FIELDS:
-            if hasattr(self, f['name']) and f.get('form',None):
-                key = f['name']
+        display = schema.FILE.display
+        for f in schema.FILE.form_fields:
+            key = f['name']
+            if hasattr(self, key):
                 label = f['form']['label']
                 # run display_* functions on field data if present
-                value = module_function(filemodule,
-                                        'display_%s' % key,
-                                        getattr(self, f['name']))
+                value = display[key](getattr(self, key))
                 lv.append( {'label':label, 'value':value,} )
         return lv
     
@@ -1323,14 +1557,12 @@ class DDRLocalFile( object ):
         @returns data: dict object as used by Django Form object.
         """
         data = {}
-        for f in filemodule.FILE_FIELDS:
-            if hasattr(self, f['name']) and f.get('form',None):
-                key = f['name']
+        formprep = schema.FILE.formprep
+        for f in schema.FILE.form_fields:
+            key = f['name']
+            if hasattr(self, key):
                 # run formprep_* functions on field data if present
-                value = module_function(filemodule,
-                                        'formprep_%s' % key,
-                                        getattr(self, f['name']))
-                data[key] = value
+                data[key] = formprep[key](getattr(self, key))
         return data
     
     def form_post(self, form):
@@ -1342,14 +1574,27 @@ class DDRLocalFile( object ):
         
         @param form
         """
-        for f in filemodule.FILE_FIELDS:
-            if hasattr(self, f['name']) and f.get('form',None):
-                key = f['name']
+        formpost = schema.FILE.formpost
+        for f in schema.FILE.form_fields:
+            key = f['name']
+            if hasattr(self, key):
                 # run formpost_* functions on field data if present
-                cleaned_data = module_function(filemodule,
-                                               'formpost_%s' % key,
-                                               form.cleaned_data[key])
-                setattr(self, key, cleaned_data)
+                setattr(self, key, formpost[key](form.cleaned_data[key]))
+    
+    def changed_fields( self, output='json' ):
+        """Names of fields changed since the file JSON was loaded or written.
+        
+        @returns: list of fieldnames
+        """
+        return schema.FILE.changed(self, self._snapshots.get(output, None))
+    
+    def _mark_clean( self, *outputs ):
+        snapshot = schema.FILE.snapshot(self)
+        # new dict; cached copies of this object share the old one
+        snapshots = dict(self._snapshots)
+        for output in outputs:
+            snapshots[output] = snapshot
+        self._snapshots = snapshots
     
     @staticmethod
     def from_json(file_json):
@@ -1358,17 +1603,19 @@ class DDRLocalFile( object ):
         """
         # This is complicated: The file object has to be created with
         # the path to the file to which the JSON metadata file refers.
-        file_abs = None
+        # Payload filenames come from a per-directory index; see cache.PayloadIndex.
         fid = os.path.splitext(os.path.basename(file_json))[0]
-        fstub = '%s.' % fid
-        for filename in os.listdir(os.path.dirname(file_json)):
-            if (fstub in filename) and not ('json' in filename):
-                file_abs = os.path.join(os.path.dirname(file_json), filename)
+        file_abs = cache.payloads.payload(os.path.dirname(file_json), fid)
         # Now load the object
         file_ = None
         if os.path.exists(file_abs) or os.path.islink(file_abs):
+            signature = cache.file_signature(file_json)
+            file_ = cache.objects.get(DDRLocalFile, file_json, signature)
+            if file_:
+                return file_
             file_ = DDRLocalFile(path_abs=file_abs)
             file_.load_json()
+            cache.objects.put(DDRLocalFile, file_json, signature, file_)
         return file_
     
     def load_json(self):
@@ -1376,27 +1623,33 @@ class DDRLocalFile( object ):
         @param path: Absolute path to file
         """
         if os.path.exists(self.json_path):
-            data = read_json(self.json_path)
-            # everything else
-            for ff in filemodule.FILE_FIELDS:
-                for f in data:
-                    if hasattr(f, 'keys') and (f.keys()[0] == ff['name']):
-                        setattr(self, f.keys()[0], f.values()[0])
+            schema.FILE.load(self, read_json(self.json_path))
+            self._mark_clean('json')
     
     def dump_json(self, path=None):
         """Dump File data to .json file.
         
         TODO This should not actually write the JSON! It should return JSON to the code that calls it.
         
+        Does nothing if no field has changed since the file JSON was
+        loaded or last written.  Writing the file's own JSON also updates
+        its dict in entity.json; the paths written are left in
+        self.updated_files so that callers can commit all of them.
+        
         @param path: Absolute path to .json file.
+        @returns: True if the file was written.
         """
         if not path:
             path = self.json_path
+        own = (path == self.json_path)
+        self.updated_files = []
+        if own and os.path.exists(path) and not self.changed_fields('json'):
+            return False
         # TODO DUMP FILE AND FILEMETA PROPERLY!!!
         file_ = [{'application': 'https://github.com/densho/ddr-local.git',
                   'commit': COMMIT,
                   'release': VERSION,
-                  'git': dvcs.git_version(self.collection_path),},
+                  'git': git_version(self.collection_path),},
                  {'path_rel': self.path_rel},]
         for ff in filemodule.FILE_FIELDS:
             item = {}
@@ -1407,6 +1660,24 @@ class DDRLocalFile( object ):
             item[key] = val
             file_.append(item)
         write_json(file_, path)
+        self.updated_files.append(path)
+        cache.objects.invalidate(self.json_path, self.entity_path)
+        if own:
+            linkgraph.update_file(self.entity_path, self.json_path,
+                                  self.path_rel, getattr(self, 'links', None))
+            entity_id = os.path.basename(os.path.normpath(self.entity_path))
+            fdict = entity_file_dict(self)
+            catalog.store_catalog().update_file(
+                self.collection_path, entity_id, fdict, file_)
+            # keep the entity.json file dict (e.g. sort, public) in step
+            entity_json_path = os.path.join(self.entity_path, 'entity.json')
+            changed,entity = patch_json_file_dict(entity_json_path, fdict)
+            if changed:
+                self.updated_files.append(entity_json_path)
+                manifest.update_entity(self.collection_path, entity_id, entity)
+                catalog.store_catalog().update_entity(self.collection_path, entity_id, entity)
+            self._mark_clean('json')
+        return True
     
     @staticmethod
     def file_name( entity, path_abs, role, sha1=None ):
@@ -1427,7 +1698,7 @@ class DDRLocalFile( object ):
         if os.path.exists and os.access(path_abs, os.R_OK):
             ext = os.path.splitext(path_abs)[1]
             if not sha1:
-                sha1 = file_hash(path_abs, 'sha1')
+                sha1 = hashing.hash_file(path_abs, ['sha1'])['sha1']
             if sha1:
                 base = '-'.join([
                     entity.repo, entity.org, entity.cid, entity.eid,
@@ -1493,29 +1764,10 @@ class DDRLocalFile( object ):
     
     def links_incoming( self ):
         """List of path_rels of files that link to this file.
+        
+        See ddrlocal.models.links.
         """
-        incoming = []
-        cmd = 'find {} -name "*.json" -print'.format(self.entity_files_path)
-        r = envoy.run(cmd)
-        jsons = []
-        if r.std_out:
-            jsons = r.std_out.strip().split('\n')
-        for fn in jsons:
-            with open(fn, 'r') as f:
-                raw = f.read()
-            data = json.loads(raw)
-            path_rel = None
-            for field in data:
-                if field.get('path_rel',None):
-                    path_rel = field['path_rel']
-            for field in data:
-                linksraw = field.get('links', None)
-                if linksraw:
-                    for link in linksraw.strip().split(';'):
-                        link = link.strip()
-                        if self.basename in link:
-                            incoming.append(path_rel)
-        return incoming
+        return linkgraph.incoming(self.entity_path, self.basename)
     
     def links_outgoing( self ):
         """List of path_rels of files this file links to.
@@ -1532,3 +1784,118 @@ class DDRLocalFile( object ):
             if l not in links:
                 links.append(l)
         return links
+
+
+
+# file info available from entity.json without loading the file's own JSON
+# sort is here so that Entity.files_master/files_mezzanine can sort
+# without loading file JSONs; entity.json written before sort was
+# added to ENTITY_FILE_KEYS lacks it, and those files are loaded.
+LAZY_FILE_KEYS = ['path_rel',
+                  'role',
+                  'sha1',
+                  'sha256',
+                  'md5',
+                  'sort',]
+
+class LazyFile( object ):
+    """Stand-in for a DDRLocalFile (or subclass) that loads it on demand.
+    
+    Holds only the entity.json file dict.  Attributes in LAZY_FILE_KEYS,
+    basename and path_abs are answered from that; anything else (including
+    methods) loads the real object, which reads the file's JSON, and
+    delegates to it from then on.  Setting an attribute loads the object.
+    
+    >>> f = LazyFile(DDRLocalFile, '/PATH/files/ddr-testing-123-1-master-abc.jpg', fdict)
+    >>> f.role      # no file JSON read
+    'master'
+    >>> f.label     # reads file JSON
+    """
+    
+    def __init__( self, cls, path_abs, fdict ):
+        self.__dict__['_cls'] = cls
+        self.__dict__['_path_abs'] = path_abs
+        self.__dict__['_fdict'] = fdict
+        self.__dict__['_obj'] = None
+    
+    def __repr__( self ):
+        return repr(self._object())
+    
+    def __copy__( self ):
+        # Copies are never loaded.  Entity entries in cache.objects are
+        # validated only by entity.json and files/, not by each file JSON,
+        # so file data must be read again rather than copied from the cache.
+        return LazyFile(self._cls, self._path_abs, dict(self._fdict))
+    
+    def _object( self ):
+        if self._obj is None:
+            self.__dict__['_obj'] = self._cls(path_abs=self._path_abs)
+        return self._obj
+    
+    def loaded( self ):
+        """Indicates whether the file's JSON has been loaded.
+        """
+        return self._obj is not None
+    
+    def __getattr__( self, name ):
+        # only called for names not found in __dict__ or the class
+        if name.startswith('__'):
+            raise AttributeError(name)
+        if self._obj is None:
+            if (name in LAZY_FILE_KEYS) and (name in self._fdict):
+                return self._fdict[name]
+            if name == 'basename':
+                return os.path.basename(self._path_abs)
+            if name == 'path_abs':
+                return self._path_abs
+        return getattr(self._object(), name)
+    
+    def __setattr__( self, name, value ):
+        setattr(self._object(), name, value)
+
+
+class FileList( list ):
+    """List of file objects whose slices are also FileLists.
+    
+    Slicing does not touch the items, so Paginator(files, n).page(x)
+    only loads the LazyFiles on the page that is actually rendered.
+    
+    FileList.version is incremented whenever the list is modified;
+    Entity uses it to know when its file index is stale.
+    """
+    version = 0
+    
+    def _changed( self ):
+        self.version = self.version + 1
+    
+    def _mutator( name ):
+        method = getattr(list, name)
+        def mutate( self, *args, **kwargs ):
+            result = method(self, *args, **kwargs)
+            self._changed()
+            return result
+        mutate.__name__ = name
+        return mutate
+    
+    append = _mutator('append')
+    extend = _mutator('extend')
+    insert = _mutator('insert')
+    remove = _mutator('remove')
+    pop = _mutator('pop')
+    sort = _mutator('sort')
+    reverse = _mutator('reverse')
+    __setitem__ = _mutator('__setitem__')
+    __delitem__ = _mutator('__delitem__')
+    __setslice__ = _mutator('__setslice__')
+    __delslice__ = _mutator('__delslice__')
+    __iadd__ = _mutator('__iadd__')
+    __imul__ = _mutator('__imul__')
+    del _mutator
+    
+    def __getslice__( self, i, j ):
+        return FileList(list.__getslice__(self, i, j))
+    
+    def __getitem__( self, key ):
+        if isinstance(key, slice):
+            return FileList(list.__getitem__(self, key))
+        return list.__getitem__(self, key)
@@ -0,0 +1,200 @@
+"""Process-wide cache of objects loaded from JSON.
+
+Views call Collection.from_json and Entity.from_json several times per
+request, each time re-reading and re-parsing JSON and rebuilding one
+file object per file.  ObjectCache keeps recently loaded objects in a
+size-bounded LRU keyed by (class, path).
+
+Entries are validated against a signature made from (mtime, size, inode)
+of the object's JSON file (plus the entity files/ directory for entities)
+so changes made outside the process (git pull, other workers) are seen.
+Code that writes JSON calls invalidate() explicitly.  An edit of a file
+JSON in place changes neither entity.json nor files/, so entity entries
+hold their files only as unloaded LazyFiles (see LazyFile.__copy__);
+file data is always read from the file JSON.
+
+get() never hands out the cached object itself; it returns a copy that
+the caller can modify freely.  Copying is cheap compared to reading and
+parsing the JSON: object attributes are copied one level deep and file
+objects in lists are copied the same way.
+"""
+from collections import OrderedDict
+import copy
+import logging
+logger = logging.getLogger(__name__)
+import os
+import threading
+
+
+OBJECT_CACHE_SIZE = 250
+
+
+def stat_signature(*paths):
+    """Returns tuple of (mtime, size, inode) for each path (None if missing).
+    """
+    sig = []
+    for path in paths:
+        try:
+            s = os.stat(path)
+            sig.append((s.st_mtime, s.st_size, s.st_ino))
+        except OSError:
+            sig.append(None)
+    return tuple(sig)
+
+def collection_signature(collection_path):
+    return stat_signature(os.path.join(collection_path, 'collection.json'))
+
+def entity_signature(entity_path):
+    """entity.json plus files/ dir, which changes when file JSONs are replaced
+    """
+    return stat_signature(os.path.join(entity_path, 'entity.json'),
+                          os.path.join(entity_path, 'files'))
+
+def file_signature(json_path):
+    return stat_signature(json_path)
+
+def _copy_item(item):
+    if isinstance(item, dict):
+        return dict(item)
+    if hasattr(item, '__dict__') and not isinstance(item, type):
+        return copy_object(item)
+    return item
+
+def _copy_value(value):
+    if isinstance(value, list):
+        # keep list subclasses and their state (i.e. FileList.version)
+        new = value.__class__([_copy_item(v) for v in value])
+        if hasattr(value, '__dict__'):
+            new.__dict__.update(value.__dict__)
+        return new
+    if isinstance(value, dict):
+        return dict(value)
+    return value
+
+def copy_object(obj):
+    """Returns a copy of obj that can be modified without affecting obj.
+    
+    Objects that know how to copy themselves (i.e. LazyFile) are left to do so.
+    """
+    if hasattr(type(obj), '__copy__'):
+        return copy.copy(obj)
+    new = copy.copy(obj)
+    for key,value in obj.__dict__.iteritems():
+        new.__dict__[key] = _copy_value(value)
+    return new
+
+
+class ObjectCache( object ):
+    """Size-bounded LRU cache of loaded objects.
+    """
+
+    def __init__( self, size=OBJECT_CACHE_SIZE ):
+        self.size = size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get( self, cls, path, signature ):
+        """Returns a copy of the cached object or None.
+
+        @param cls: Class of the object (Collection, Entity, etc)
+        @param path: Absolute path used to load the object.
+        @param signature: Current signature (see stat_signature).
+        """
+        key = (cls, path)
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if (entry is None) or (entry[0] != signature):
+                self.misses += 1
+                return None
+            # move to most-recently-used end
+            self._data[key] = entry
+            self.hits += 1
+            obj = entry[1]
+        return copy_object(obj)
+
+    def put( self, cls, path, signature, obj ):
+        """Caches a copy of obj; the caller keeps the original.
+
+        @param signature: Signature taken *before* the object was loaded.
+        """
+        if obj is None:
+            return
+        entry = (signature, copy_object(obj))
+        key = (cls, path)
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = entry
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+    def invalidate( self, *paths ):
+        """Drops all entries for the specified paths (any class).
+        """
+        paths = [os.path.normpath(p) for p in paths if p]
+        with self._lock:
+            for key in self._data.keys():
+                if os.path.normpath(key[1]) in paths:
+                    del self._data[key]
+
+    def clear( self ):
+        with self._lock:
+            self._data.clear()
+
+
+class PayloadIndex( object ):
+    """Per-directory index of file ID -> payload filename.
+    
+    DDRLocalFile.from_json has to find the payload file (i.e. the .jpg)
+    that a file JSON describes.  Listing the entity files/ dir for every
+    file made exporting an entity with N files cost O(N^2).  Each
+    directory is listed once (Python 2 has no scandir) and the index is
+    reused until the directory mtime changes or invalidate() is called.
+    """
+
+    def __init__( self, size=OBJECT_CACHE_SIZE ):
+        self.size = size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _build( self, dir_path ):
+        index = {}
+        for filename in os.listdir(dir_path):
+            if 'json' not in filename:
+                index[filename.split('.')[0]] = filename
+        return index
+
+    def payload( self, dir_path, fid ):
+        """Returns absolute path to the payload file for fid, or None.
+        
+        @param dir_path: Absolute path to directory (entity files/ dir).
+        @param fid: File ID (basename of the JSON file minus extension).
+        """
+        dir_path = os.path.normpath(dir_path)
+        mtime = os.path.getmtime(dir_path)
+        with self._lock:
+            entry = self._data.pop(dir_path, None)
+        if (entry is None) or (entry[0] != mtime):
+            entry = (mtime, self._build(dir_path))
+        with self._lock:
+            self._data[dir_path] = entry
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+        filename = entry[1].get(fid, None)
+        if filename:
+            return os.path.join(dir_path, filename)
+        return None
+
+    def invalidate( self, *dir_paths ):
+        """Drops indexes for directories in which files were added or removed.
+        """
+        with self._lock:
+            for dir_path in dir_paths:
+                if dir_path:
+                    self._data.pop(os.path.normpath(dir_path), None)
+
+
+# one per process
+objects = ObjectCache()
+payloads = PayloadIndex()
@@ -0,0 +1,583 @@
+"""Store-wide sqlite catalog of collection, entity, and file summaries.
+
+Browsing a collection used to mean either walking its JSON files or
+asking Elasticsearch, which is often down or stale on workstations.  The
+catalog (STORE/tmp/catalog.db) keeps one summary row per collection,
+entity, and file so that lists can be paged, sorted, and filtered with
+indexed queries.
+
+Rows are written by the models' dump_json methods and by sync_collection,
+which compares mtimes (via the collection's entity manifest, see
+ddrlocal.models.manifest) so that changes made outside of ddr-local
+(git pull, etc) are picked up.  scan() syncs every collection; it runs
+in the background (webui.tasks.catalog_scan), at most once every
+CATALOG_SCAN_INTERVAL seconds, never in a request.  The catalog can always be
+rebuilt from the JSON files; it is never the only copy of anything.
+
+The catalog also has a full-text index (sqlite FTS4) of collection,
+entity, and file JSON, which webui.views.search uses when there is no
+Elasticsearch index.  Documents are (re)indexed along with their rows;
+file JSONs are re-read only when their mtimes change.  Hits are ranked
+by how many of the query's words they contain, weighted by column (see
+rank), then collections, entities, files.
+
+    >>> from ddrlocal.models import catalog
+    >>> cat = catalog.store_catalog()
+    >>> cat.sync_collection('/var/www/media/base/ddr-testing-123')
+    >>> entities = cat.entities('ddr-testing-123', sort='title', q='camp')
+    >>> entities.count()
+    12
+    >>> entities[0:10]
+    [<EntityRow ddr-testing-123-4>, ...]
+    >>> hits = cat.search('manzanar')
+"""
+from array import array
+import logging
+logger = logging.getLogger(__name__)
+import os
+import sqlite3
+import threading
+import time
+
+from django.conf import settings
+
+from ddrlocal.models import manifest
+from ddrlocal.models.meta import read_json
+
+
+CATALOG_FILENAME = 'catalog.db'
+
+COLLECTION_FILES_PREFIX = 'files'
+
+TABLES = [
+    """CREATE TABLE IF NOT EXISTS collections (
+        id TEXT PRIMARY KEY, path TEXT, title TEXT, record_lastmod TEXT,
+        public INTEGER, status TEXT, mtime REAL)""",
+    """CREATE TABLE IF NOT EXISTS entities (
+        id TEXT PRIMARY KEY, collection_id TEXT, eid INTEGER, title TEXT,
+        record_lastmod TEXT, public INTEGER, status TEXT, files INTEGER,
+        mtime REAL)""",
+    'CREATE INDEX IF NOT EXISTS entities_eid ON entities (collection_id, eid, id)',
+    'CREATE INDEX IF NOT EXISTS entities_title ON entities (collection_id, title COLLATE NOCASE)',
+    'CREATE INDEX IF NOT EXISTS entities_lastmod ON entities (collection_id, record_lastmod)',
+    """CREATE TABLE IF NOT EXISTS files (
+        id TEXT PRIMARY KEY, entity_id TEXT, collection_id TEXT,
+        role TEXT, sha1 TEXT, path_rel TEXT, public INTEGER)""",
+    'CREATE INDEX IF NOT EXISTS files_entity ON files (entity_id)',
+    # full-text search; search.docid = documents.docid
+    """CREATE TABLE IF NOT EXISTS documents (
+        docid INTEGER PRIMARY KEY, id TEXT UNIQUE, model TEXT,
+        collection_id TEXT, entity_id TEXT, title TEXT, description TEXT,
+        mtime REAL)""",
+    'CREATE INDEX IF NOT EXISTS documents_collection ON documents (collection_id)',
+    'CREATE INDEX IF NOT EXISTS documents_entity ON documents (entity_id)',
+    'CREATE VIRTUAL TABLE IF NOT EXISTS search USING fts4(title, description, body)',
+    'CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)',
+]
+
+# sort param -> ORDER BY
+ENTITY_SORTS = {
+    'id': 'eid, id',
+    '-id': 'eid DESC, id DESC',
+    'title': 'title COLLATE NOCASE, eid',
+    '-title': 'title COLLATE NOCASE DESC, eid',
+    'lastmod': 'record_lastmod, eid',
+    '-lastmod': 'record_lastmod DESC, eid',
+}
+
+ENTITY_COLUMNS = ['id', 'title', 'record_lastmod', 'public', 'status', 'files']
+
+SEARCH_COLUMNS = ['documents.id', 'documents.model', 'documents.title', 'documents.description']
+# collections first, then entities, then files
+SEARCH_ORDER = "CASE documents.model WHEN 'collection' THEN 0 WHEN 'entity' THEN 1 ELSE 2 END, documents.id"
+# best matches first (see rank)
+SEARCH_RANK_ORDER = "rank(matchinfo(search, 'pcx')) DESC, %s" % SEARCH_ORDER
+# rank weights of the search table's columns: title, description, body
+SEARCH_WEIGHTS = [4.0, 2.0, 1.0]
+
+# JSON fields not worth indexing
+UNINDEXED_FIELDS = ['files', 'filemeta', 'application', 'commit', 'release', 'git']
+
+
+def _mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+def _fields(data, names):
+    """Picks fields out of JSON data (list of single-key dicts).
+    """
+    values = {}
+    # read_json returns a dict if the file could not be read
+    if isinstance(data, list):
+        for item in data:
+            if hasattr(item, 'keys') and item:
+                key = item.keys()[0]
+                if key in names:
+                    values[key] = item[key]
+    return values
+
+def _eid(entity_id):
+    """Entity number for natural sorting; None if not numeric.
+    """
+    try:
+        return int(entity_id.split('-')[3])
+    except (IndexError, ValueError):
+        return None
+
+def file_id(path_rel):
+    return os.path.splitext(os.path.basename(path_rel))[0]
+
+def file_json_path(collection_path, entity_id, path_rel):
+    return os.path.join(collection_path, COLLECTION_FILES_PREFIX, entity_id,
+                        COLLECTION_FILES_PREFIX, '%s.json' % file_id(path_rel))
+
+def _text(value):
+    """Flattens a JSON value into a list of strings.
+    """
+    if isinstance(value, basestring):
+        return [value]
+    if isinstance(value, (int, long, float)) and not isinstance(value, bool):
+        return [unicode(value)]
+    if isinstance(value, dict):
+        return [text for v in value.values() for text in _text(v)]
+    if isinstance(value, (list, tuple)):
+        return [text for v in value for text in _text(v)]
+    return []
+
+def document_text(data):
+    """All the indexable text in JSON data (list of single-key dicts).
+    """
+    texts = []
+    if isinstance(data, list):
+        for item in data:
+            if hasattr(item, 'keys') and item:
+                key = item.keys()[0]
+                if key not in UNINDEXED_FIELDS:
+                    texts.extend(_text(item[key]))
+    return u' '.join(texts)
+
+def match_expression(query):
+    """FTS MATCH expression for a user query: every word, as a phrase.
+
+    Quoting each word keeps FTS operators and punctuation in user input
+    from being interpreted (or from raising syntax errors).
+    """
+    words = [word.replace('"', '') for word in query.split()]
+    return ' '.join(['"%s"' % word for word in words if word])
+
+def rank(matchinfo):
+    """Relevance of an FTS4 hit, from matchinfo(search, 'pcx').
+
+    For each phrase and column, hits in this row divided by hits in all
+    rows (rare words count for more), times the column's weight.
+    """
+    info = array('I', str(matchinfo))
+    phrases,columns = info[0],info[1]
+    score = 0.0
+    for p in range(phrases):
+        for c in range(columns):
+            x = 2 + 3 * (c + p * columns)
+            if info[x]:
+                score = score + SEARCH_WEIGHTS[c] * info[x] / float(info[x + 1])
+    return score
+
+def search_hit(row):
+    """Search result in the shape webui.views.search.results expects.
+    """
+    hit = dict(zip(['id', 'model', 'title', 'description'], row))
+    if hit['model'] == 'file':
+        hit['label'] = hit['title']
+    return hit
+
+
+class EntityRow( object ):
+    """Just enough of an Entity for lists (see DDRLocalCollection.entities).
+    """
+
+    def __init__( self, row ):
+        for key,value in zip(ENTITY_COLUMNS, row):
+            setattr(self, key, value)
+        self.uid = self.id
+        self.repo,self.org,self.cid,self.eid = self.id.split('-')
+        self.file_count = self.files
+
+    def __repr__( self ):
+        return "<EntityRow %s>" % (self.id)
+
+
+class Query( object ):
+    """Lazy query that django.core.paginator.Paginator can page.
+
+    count() runs COUNT(*) once; slices run LIMIT/OFFSET queries and pass
+    each row to make().
+    """
+
+    def __init__( self, catalog, tables, columns, where, params, order, make ):
+        self.catalog = catalog
+        self.tables = tables
+        self.columns = columns
+        self.where = where
+        self.params = params
+        self.order = order
+        self.make = make
+        self._count = None
+
+    def count( self ):
+        if self._count is None:
+            self._count = self.catalog._connection().execute(
+                'SELECT COUNT(*) FROM %s WHERE %s' % (self.tables, self.where),
+                self.params).fetchone()[0]
+        return self._count
+
+    def __len__( self ):
+        return self.count()
+
+    def __iter__( self ):
+        return iter(self[0:self.count()])
+
+    def __getitem__( self, key ):
+        if isinstance(key, slice):
+            start = key.start or 0
+            stop = self.count() if key.stop is None else key.stop
+            if (start < 0) or (stop < 0) or key.step:
+                raise ValueError('Query slices must be non-negative and without step')
+            if stop <= start:
+                return []
+            rows = self.catalog._connection().execute(
+                'SELECT %s FROM %s WHERE %s ORDER BY %s LIMIT ? OFFSET ?' % (
+                    ', '.join(self.columns), self.tables, self.where, self.order),
+                self.params + [stop - start, start]).fetchall()
+            return [self.make(row) for row in rows]
+        items = self[key:key+1]
+        if not items:
+            raise IndexError(key)
+        return items[0]
+
+
+class Catalog( object ):
+    """sqlite catalog; one connection per thread, like hashing.HashCache.
+
+    Writes log sqlite errors and carry on (the catalog is rebuilt from the
+    JSON files by sync_collection); queries raise them.
+    """
+    path = None
+
+    def __init__( self, path ):
+        self.path = path
+        self._local = threading.local()
+
+    def _connection( self ):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            if not os.path.exists(os.path.dirname(self.path)):
+                os.makedirs(os.path.dirname(self.path))
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.create_function('rank', 1, rank)
+            for statement in TABLES:
+                conn.execute(statement)
+            conn.commit()
+            self._local.conn = conn
+        return conn
+
+    def _write( self, function, *args ):
+        """Runs function(conn, *args) in a transaction; logs errors.
+        """
+        try:
+            conn = self._connection()
+            with conn:
+                return function(conn, *args)
+        except (sqlite3.Error, OSError, IOError) as err:
+            logger.error('Catalog %s: %s' % (self.path, err))
+
+    # writers ----------------------------------------------------------
+
+    def _put_collection( self, conn, collection_path, data, mtime ):
+        collection_id = os.path.basename(os.path.normpath(collection_path))
+        values = _fields(data, ['title', 'record_lastmod', 'public', 'status'])
+        conn.execute(
+            'INSERT OR REPLACE INTO collections'
+            ' (id, path, title, record_lastmod, public, status, mtime)'
+            ' VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (collection_id, collection_path, values.get('title', ''),
+             values.get('record_lastmod', ''), values.get('public', None),
+             values.get('status', None), mtime))
+        self._put_document(conn, collection_id, 'collection', collection_id, None, data, mtime)
+
+    def _put_document( self, conn, doc_id, model, collection_id, entity_id, data, mtime,
+                       title=None, description=None ):
+        values = _fields(data, ['title', 'description', 'label', 'basename_orig'])
+        if title is None:
+            title = values.get('title', None) or values.get('label', None) or ''
+        if description is None:
+            description = values.get('description', None) or values.get('basename_orig', None) or ''
+        row = conn.execute('SELECT docid FROM documents WHERE id=?', (doc_id,)).fetchone()
+        if row:
+            docid = row[0]
+            conn.execute(
+                'UPDATE documents SET model=?, collection_id=?, entity_id=?,'
+                ' title=?, description=?, mtime=? WHERE docid=?',
+                (model, collection_id, entity_id, title, description, mtime, docid))
+            conn.execute('DELETE FROM search WHERE docid=?', (docid,))
+        else:
+            docid = conn.execute(
+                'INSERT INTO documents'
+                ' (id, model, collection_id, entity_id, title, description, mtime)'
+                ' VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (doc_id, model, collection_id, entity_id, title, description, mtime)).lastrowid
+        conn.execute('INSERT INTO search (docid, title, description, body) VALUES (?, ?, ?, ?)',
+                     (docid, title, description, document_text(data)))
+
+    def _delete_documents( self, conn, where, params ):
+        docids = [row[0] for row in conn.execute(
+            'SELECT docid FROM documents WHERE %s' % where, params).fetchall()]
+        for docid in docids:
+            conn.execute('DELETE FROM search WHERE docid=?', (docid,))
+            conn.execute('DELETE FROM documents WHERE docid=?', (docid,))
+
+    def _index_files( self, conn, collection_path, entity_id, fdicts ):
+        """(Re)indexes file JSONs that changed; drops documents of removed files.
+        """
+        collection_id = os.path.basename(os.path.normpath(collection_path))
+        known = dict(conn.execute(
+            "SELECT id, mtime FROM documents WHERE entity_id=? AND model='file'",
+            (entity_id,)).fetchall())
+        for f in fdicts:
+            fid = file_id(f['path_rel'])
+            json_path = file_json_path(collection_path, entity_id, f['path_rel'])
+            mtime = _mtime(json_path)
+            if (mtime is not None) and (known.pop(fid, None) != mtime):
+                self._put_document(conn, fid, 'file', collection_id, entity_id,
+                                   read_json(json_path), mtime)
+        for fid in known.keys():
+            self._delete_documents(conn, 'id=?', (fid,))
+
+    def _put_entity( self, conn, collection_path, entity_id, data, mtime ):
+        collection_id = os.path.basename(os.path.normpath(collection_path))
+        e = manifest.entry(entity_id, data, mtime)
+        conn.execute(
+            'INSERT OR REPLACE INTO entities'
+            ' (id, collection_id, eid, title, record_lastmod, public, status, files, mtime)'
+            ' VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (entity_id, collection_id, _eid(entity_id), e['title'],
+             e['record_lastmod'], e['public'], e['status'], e['files'], mtime))
+        conn.execute('DELETE FROM files WHERE entity_id=?', (entity_id,))
+        fdicts = [f for f in _fields(data, ['files']).get('files', None) or []
+                  if hasattr(f, 'get') and f.get('path_rel', None)]
+        for f in fdicts:
+            self._put_file(conn, collection_id, entity_id, f)
+        self._put_document(conn, entity_id, 'entity', collection_id, entity_id, data, mtime)
+        self._index_files(conn, collection_path, entity_id, fdicts)
+
+    def _put_file( self, conn, collection_id, entity_id, f ):
+        conn.execute(
+            'INSERT OR REPLACE INTO files'
+            ' (id, entity_id, collection_id, role, sha1, path_rel, public)'
+            ' VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (file_id(f['path_rel']), entity_id, collection_id, f.get('role', None),
+             f.get('sha1', None), f['path_rel'], f.get('public', None)))
+
+    def _delete_entities( self, conn, entity_ids ):
+        for entity_id in entity_ids:
+            conn.execute('DELETE FROM entities WHERE id=?', (entity_id,))
+            conn.execute('DELETE FROM files WHERE entity_id=?', (entity_id,))
+            self._delete_documents(conn, 'id=? OR entity_id=?', (entity_id, entity_id))
+
+    def update_collection( self, collection_path, data=None ):
+        """Updates a collection's row after collection.json was written.
+
+        @param collection_path: Absolute path to collection
+        @param data: (optional) list of dicts as written to collection.json
+        """
+        json_path = os.path.join(collection_path, 'collection.json')
+        if data is None:
+            data = read_json(json_path)
+        self._write(self._put_collection, collection_path, data, _mtime(json_path))
+
+    def update_entity( self, collection_path, entity_id, data=None ):
+        """Updates an entity's row and its file rows after entity.json was written.
+
+        @param collection_path: Absolute path to collection
+        @param entity_id: str
+        @param data: (optional) list of dicts as written to entity.json
+        """
+        json_path = manifest.entity_json_path(collection_path, entity_id)
+        if data is None:
+            data = read_json(json_path)
+        self._write(self._put_entity, collection_path, entity_id, data, _mtime(json_path))
+
+    def remove_entity( self, entity_id ):
+        """Removes rows for a deleted entity and its files.
+        """
+        self._write(self._delete_entities, [entity_id])
+
+    def update_file( self, collection_path, entity_id, fdict, data=None ):
+        """Updates a file's row and document after its file JSON was written.
+
+        @param collection_path: Absolute path to collection
+        @param entity_id: str
+        @param fdict: dict with path_rel, role, sha1, public
+        @param data: (optional) list of dicts as written to the file JSON
+        """
+        collection_id = os.path.basename(os.path.normpath(collection_path))
+        json_path = file_json_path(collection_path, entity_id, fdict['path_rel'])
+        if data is None:
+            data = read_json(json_path)
+        def put(conn):
+            self._put_file(conn, collection_id, entity_id, fdict)
+            self._put_document(conn, file_id(fdict['path_rel']), 'file',
+                               collection_id, entity_id, data, _mtime(json_path))
+        self._write(put)
+
+    def _sync_collection( self, conn, collection_path ):
+        collection_id = os.path.basename(os.path.normpath(collection_path))
+        json_path = os.path.join(collection_path, 'collection.json')
+        mtime = _mtime(json_path)
+        row = conn.execute('SELECT mtime FROM collections WHERE id=?',
+                           (collection_id,)).fetchone()
+        if (mtime is not None) and ((row is None) or (row[0] != mtime)):
+            self._put_collection(conn, collection_path, read_json(json_path), mtime)
+        known = dict(conn.execute('SELECT id, mtime FROM entities WHERE collection_id=?',
+                                  (collection_id,)).fetchall())
+        updated = 0
+        for e in manifest.entities(collection_path):
+            if known.pop(e['id'], None) != e['mtime']:
+                # the manifest only has counts; the file list is in entity.json
+                json_path = manifest.entity_json_path(collection_path, e['id'])
+                self._put_entity(conn, collection_path, e['id'], read_json(json_path), e['mtime'])
+                updated = updated + 1
+        self._delete_entities(conn, known.keys())
+        return updated,len(known)
+
+    def sync_collection( self, collection_path ):
+        """Brings a collection's rows up to date with its JSON files.
+
+        Only entities whose entity.json mtime differs from the catalog's
+        are read.
+
+        @param collection_path: Absolute path to collection
+        @returns: (number of entities updated, number removed)
+        """
+        return self._write(self._sync_collection, collection_path) or (0,0)
+
+    def has_collection( self, collection_id ):
+        """True if the catalog has rows for the collection or its entities.
+        """
+        return self._connection().execute(
+            'SELECT 1 FROM collections WHERE id=?'
+            ' UNION ALL SELECT 1 FROM entities WHERE collection_id=? LIMIT 1',
+            (collection_id, collection_id)).fetchone() is not None
+
+    def scanned( self ):
+        """Time (seconds since the epoch) of the last completed scan, or None.
+        """
+        row = self._connection().execute(
+            "SELECT value FROM meta WHERE key='scanned'").fetchone()
+        if row:
+            return float(row[0])
+        return None
+
+    def scan_if_due( self, base_dir, interval ):
+        """Runs scan() unless the last one finished less than interval seconds ago.
+
+        @param base_dir: Absolute path to Store (i.e. settings.MEDIA_BASE)
+        @param interval: int (seconds)
+        @returns: True if the Store was scanned
+        """
+        try:
+            scanned = self.scanned()
+        except sqlite3.Error as err:
+            logger.error('Catalog %s: %s' % (self.path, err))
+            return False
+        if (scanned is not None) and (time.time() - scanned < interval):
+            return False
+        self.scan(base_dir)
+        return True
+
+    def scan( self, base_dir ):
+        """Syncs every collection in the Store and drops rows for missing ones.
+
+        Reads every JSON file the first time; after that stats every
+        collection and entity.  Too slow for a request; see scan_if_due.
+
+        @param base_dir: Absolute path to Store (i.e. settings.MEDIA_BASE)
+        """
+        collection_ids = []
+        for name in sorted(os.listdir(base_dir)):
+            path = os.path.join(base_dir, name)
+            if os.path.exists(os.path.join(path, 'collection.json')):
+                collection_ids.append(name)
+                self.sync_collection(path)
+        def drop(conn):
+            for (collection_id,) in conn.execute('SELECT id FROM collections').fetchall():
+                if collection_id not in collection_ids:
+                    conn.execute('DELETE FROM collections WHERE id=?', (collection_id,))
+                    conn.execute('DELETE FROM entities WHERE collection_id=?', (collection_id,))
+                    conn.execute('DELETE FROM files WHERE collection_id=?', (collection_id,))
+                    self._delete_documents(conn, 'collection_id=?', (collection_id,))
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('scanned', ?)",
+                         (repr(time.time()),))
+        self._write(drop)
+
+    # queries ----------------------------------------------------------
+
+    def entities( self, collection_id, sort='id', q=None, public=None, status=None ):
+        """Entities in a collection, as a Query of EntityRows.
+
+        @param collection_id: str
+        @param sort: str One of ENTITY_SORTS (default 'id', natural order).
+        @param q: (optional) str Substring of entity ID or title.
+        @param public: (optional) Filter on public.
+        @param status: (optional) Filter on status.
+        @returns: Query
+        """
+        where = ['collection_id=?']
+        params = [collection_id]
+        if q:
+            where.append("(id LIKE ? ESCAPE '\\' OR title LIKE ? ESCAPE '\\')")
+            pattern = '%%%s%%' % q.replace('\\','\\\\').replace('%','\\%').replace('_','\\_')
+            params = params + [pattern, pattern]
+        if public is not None:
+            where.append('public=?')
+            params.append(public)
+        if status:
+            where.append('status=?')
+            params.append(status)
+        order = ENTITY_SORTS.get(sort, ENTITY_SORTS['id'])
+        return Query(self, 'entities', ENTITY_COLUMNS, ' AND '.join(where), params, order,
+                     EntityRow)
+
+    def search( self, query, models=None ):
+        """Full-text search of collection, entity, and file JSON.
+
+        @param query: str Words to look for; results contain all of them,
+                      best matches first.
+        @param models: (optional) list of 'collection', 'entity', 'file'.
+        @returns: Query of dicts with id, model, title, description (and label for files)
+        """
+        tables = 'search JOIN documents ON documents.docid = search.docid'
+        match = match_expression(query)
+        if not match:
+            return Query(self, tables, SEARCH_COLUMNS, '0', [], SEARCH_ORDER, search_hit)
+        where = ['search MATCH ?']
+        params = [match]
+        if models:
+            where.append('documents.model IN (%s)' % ', '.join(['?'] * len(models)))
+            params = params + list(models)
+        return Query(self, tables, SEARCH_COLUMNS, ' AND '.join(where), params,
+                     SEARCH_RANK_ORDER, search_hit)
+
+
+_STORE_CATALOG = None
+_STORE_CATALOG_LOCK = threading.Lock()
+
+def store_catalog():
+    """Catalog for the Store (settings.MEDIA_BASE).
+    """
+    global _STORE_CATALOG
+    with _STORE_CATALOG_LOCK:
+        if _STORE_CATALOG is None:
+            _STORE_CATALOG = Catalog(
+                os.path.join(settings.MEDIA_BASE, 'tmp', CATALOG_FILENAME))
+    return _STORE_CATALOG
@@ -5,6 +5,8 @@ logger = logging.getLogger(__name__)
 
 from lxml import etree
 
+from ddrlocal.models.xml import compiled_xpath
+
 
 
 DEFAULT_PERMISSION_COLLECTION = 1
@@ -755,13 +757,13 @@ def _getval(tree, namespaces, xpath):
     """Gets the first value; yes this is probably suboptimal
     """
     val = None
-    vals = tree.xpath(xpath, namespaces=namespaces)
+    vals = compiled_xpath(xpath, namespaces)(tree)
     if vals:
         val = vals[0]
     return val
 
 def _set_attr(tree, namespaces, xpath, attr, value):
-    tags = tree.xpath(xpath, namespaces=namespaces)
+    tags = compiled_xpath(xpath, namespaces)(tree)
     if tags:
         tag = tags[0]
         tag.set(attr, value)
@@ -774,8 +776,8 @@ def _set_tag_text(tree, namespaces, xpath, value):
     return tree
 
 def _duplicate(tree, namespaces, src_xpath, dest_xpath):
-    i = tree.xpath( src_xpath,  namespaces=namespaces )[0]
-    tag = tree.xpath( dest_xpath, namespaces=namespaces )[0]
+    i = compiled_xpath(src_xpath, namespaces)(tree)[0]
+    tag = compiled_xpath(dest_xpath, namespaces)(tree)[0]
     tag.text = i
     return tree
 
@@ -789,7 +791,7 @@ def _ead_simple(tree, namespaces, field, value):
 
 def _find_existing_ancestor(tree, xpath):
     frag = xpath
-    while not tree.xpath(frag):
+    while not compiled_xpath(frag)(tree):
         frag = frag.rsplit('/', 1)[0]
     return frag
 
@@ -803,7 +805,7 @@ def _next_tag(frag, xpath):
 
 def _graft(tree, frag, tag):
     if ('@' not in tag):
-        parent = tree.xpath(frag)[0]
+        parent = compiled_xpath(frag)(tree)[0]
         t = etree.Element(tag)
         parent.append(t)
 
@@ -823,7 +825,7 @@ def _mktagp(tree, COLLECTION_FIELDS):
     for f in COLLECTION_FIELDS:
         x = f['xpath']
         if x:
-            something = tree.xpath(x)
+            something = compiled_xpath(x)(tree)
             if ('@' not in x) and (not something):
                 _grow(tree, x)
 
@@ -7,6 +7,8 @@ logger = logging.getLogger(__name__)
 
 import tematres
 
+from ddrlocal.models.xml import compiled_xpath
+
 
 
 DEFAULT_PERMISSION_ENTITY = 1
@@ -1017,10 +1019,10 @@ def _expand_attrib_namespace(attr, namespaces):
 def _getval(tree, namespaces, xpath):
     """Gets the first value; yes this is probably suboptimal
     """
-    return tree.xpath(xpath, namespaces=namespaces)[0]
+    return compiled_xpath(xpath, namespaces)(tree)[0]
 
 def _set_attr(tree, namespaces, xpath, attr, value):
-    tag = tree.xpath(xpath, namespaces=namespaces)[0]
+    tag = compiled_xpath(xpath, namespaces)(tree)[0]
     tag.set(attr, value)
     return tree
 
@@ -1030,8 +1032,8 @@ def _set_tag_text(tree, namespaces, xpath, value):
     return tree
 
 def _duplicate(tree, namespaces, src_xpath, dest_xpath):
-    i = tree.xpath( src_xpath,  namespaces=namespaces )[0]
-    tag = tree.xpath( dest_xpath, namespaces=namespaces )[0]
+    i = compiled_xpath(src_xpath, namespaces)(tree)[0]
+    tag = compiled_xpath(dest_xpath, namespaces)(tree)[0]
     tag.text = i
     return tree
 
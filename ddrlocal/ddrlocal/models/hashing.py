@@ -0,0 +1,184 @@
+"""Checksumming for ingest and fixity.
+
+Master files can be multi-GB videos on USB storage, so the goal here is
+to read each file as few times as possible: copy_and_hash copies a file
+and computes all of its digests in a single pass, and digests are kept
+in a HashCache (STORE/tmp/hashes.db) keyed on the file's
+(device, inode, size, mtime) so unchanged files are not read again.
+Fixity checks should pass verify=True to bypass the cache.
+"""
+import hashlib
+import logging
+logger = logging.getLogger(__name__)
+import os
+import sqlite3
+import threading
+
+from django.conf import settings
+
+
+# Read/write in large blocks; a multiple of the page size and of disk sectors.
+BLOCKSIZE = 1024 * 1024
+
+ALGORITHMS = ['sha1', 'md5', 'sha256']
+
+HASH_CACHE_FILENAME = 'hashes.db'
+
+
+class HashCache( object ):
+    """sqlite cache of file digests.
+    
+    Rows are keyed on (dev, ino); size and mtime must also match or the
+    row is ignored.  Python 2 has no st_mtime_ns so mtime is the float
+    st_mtime, which has sub-second resolution on ext4 and most other
+    filesystems in use.
+    
+    Each thread gets its own connection.  sqlite errors (e.g. read-only
+    Store) are logged and treated as cache misses.
+    """
+    path = None
+    
+    def __init__( self, path ):
+        self.path = path
+        self._local = threading.local()
+    
+    def _connection( self ):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            if not os.path.exists(os.path.dirname(self.path)):
+                os.makedirs(os.path.dirname(self.path))
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("""CREATE TABLE IF NOT EXISTS hashes (
+                dev INTEGER, ino INTEGER, size INTEGER, mtime REAL,
+                sha1 TEXT, md5 TEXT, sha256 TEXT,
+                PRIMARY KEY (dev, ino))""")
+            conn.commit()
+            self._local.conn = conn
+        return conn
+    
+    def get( self, st ):
+        """Cached digests for a file.
+        
+        @param st: os.stat_result
+        @returns: dict of algorithm:hexdigest (may be empty)
+        """
+        try:
+            row = self._connection().execute(
+                'SELECT sha1, md5, sha256 FROM hashes'
+                ' WHERE dev=? AND ino=? AND size=? AND mtime=?',
+                (st.st_dev, st.st_ino, st.st_size, st.st_mtime)).fetchone()
+        except (sqlite3.Error, OSError, IOError) as err:
+            logger.error('HashCache.get %s: %s' % (self.path, err))
+            return {}
+        if not row:
+            return {}
+        return dict([(algo, value) for algo,value in zip(ALGORITHMS, row) if value])
+    
+    def put( self, st, digests, merge=True ):
+        """Caches digests for a file.
+        
+        @param st: os.stat_result
+        @param digests: dict of algorithm:hexdigest
+        @param merge: Boolean Keep other cached digests if still valid.
+        """
+        values = {}
+        if merge:
+            values = self.get(st)
+        values.update(digests)
+        try:
+            conn = self._connection()
+            conn.execute(
+                'INSERT OR REPLACE INTO hashes'
+                ' (dev, ino, size, mtime, sha1, md5, sha256)'
+                ' VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (st.st_dev, st.st_ino, st.st_size, st.st_mtime,
+                 values.get('sha1'), values.get('md5'), values.get('sha256')))
+            conn.commit()
+        except (sqlite3.Error, OSError, IOError) as err:
+            logger.error('HashCache.put %s: %s' % (self.path, err))
+
+_STORE_CACHE = None
+_STORE_CACHE_LOCK = threading.Lock()
+
+def store_cache():
+    """HashCache for the Store (settings.MEDIA_BASE).
+    """
+    global _STORE_CACHE
+    with _STORE_CACHE_LOCK:
+        if _STORE_CACHE is None:
+            _STORE_CACHE = HashCache(
+                os.path.join(settings.MEDIA_BASE, 'tmp', HASH_CACHE_FILENAME))
+    return _STORE_CACHE
+
+
+def copy_and_hash( src_path, dest_path, algorithms=ALGORITHMS, progress=None, cache=None, blocksize=BLOCKSIZE ):
+    """Copies src_path to dest_path, computing digests in the same pass.
+
+    Replaces shutil.copy followed by one DDR.models.file_hash per algorithm,
+    each of which read the whole file again.  Digests are cached for dest_path.
+
+    @param src_path: Absolute path to source file.
+    @param dest_path: Absolute path to destination file.
+    @param algorithms: list of hashlib algorithm names.
+    @param progress: (optional) function(bytes_done, bytes_total) called after each block.
+    @param cache: HashCache (default: store_cache()).
+    @param blocksize: int Size of read/write buffer.
+    @returns: dict of algorithm:hexdigest
+    """
+    hashes = [(algo, hashlib.new(algo)) for algo in algorithms]
+    total = os.path.getsize(src_path)
+    done = 0
+    with open(src_path, 'rb') as src:
+        with open(dest_path, 'wb') as dest:
+            while True:
+                block = src.read(blocksize)
+                if not block:
+                    break
+                dest.write(block)
+                for algo,h in hashes:
+                    h.update(block)
+                done = done + len(block)
+                if progress:
+                    progress(done, total)
+    digests = dict([(algo, h.hexdigest()) for algo,h in hashes])
+    (cache or store_cache()).put(os.stat(dest_path), digests)
+    return digests
+
+def hash_file( path, algorithms=ALGORITHMS, verify=False, cache=None, blocksize=BLOCKSIZE ):
+    """Computes several digests of a file in a single read.
+    
+    Cached digests are used if the file's device, inode, size, and mtime
+    are unchanged.  Freshly computed digests are written to the cache.
+
+    @param path: Absolute path to file.
+    @param algorithms: list of hashlib algorithm names.
+    @param verify: Boolean Always read the file (i.e. fixity checks).
+    @param cache: HashCache (default: store_cache()).
+    @param blocksize: int Size of read buffer.
+    @returns: dict of algorithm:hexdigest
+    """
+    cache = cache or store_cache()
+    st = os.stat(path)
+    if not verify:
+        cached = cache.get(st)
+        if not [algo for algo in algorithms if algo not in cached]:
+            return dict([(algo, cached[algo]) for algo in algorithms])
+    hashes = [(algo, hashlib.new(algo)) for algo in algorithms]
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(blocksize)
+            if not block:
+                break
+            for algo,h in hashes:
+                h.update(block)
+    digests = dict([(algo, h.hexdigest()) for algo,h in hashes])
+    # don't cache if the file changed while being read
+    if same_file(st, os.stat(path)):
+        cache.put(st, digests, merge=not verify)
+    return digests
+
+def same_file( st0, st1 ):
+    """Compares the HashCache key fields of two os.stat_results.
+    """
+    return (st0.st_dev, st0.st_ino, st0.st_size, st0.st_mtime) \
+        == (st1.st_dev, st1.st_ino, st1.st_size, st1.st_mtime)
@@ -0,0 +1,185 @@
+"""Propagation of inheritable field values to child objects.
+
+When an inheritable field (i.e. rights, public, status) is edited in a
+Collection or Entity the new value is copied to all of its children.
+This used to mean running find for every JSON under the parent and then
+loading each child as a full object (reloading the entity for every one
+of its files) and dumping it again.
+
+Here the parent directory is walked once, child JSONs are grouped by
+entity and each group is handled by a worker in a thread pool.  Only the
+inheritable keys of each JSON file are patched (see meta.patch_json);
+objects are never built.  The catalog rows and search documents of the
+patched JSONs are updated afterwards (see catalog).
+
+    >>> from ddrlocal.models import inheritance
+    >>> child_ids,changed_files = inheritance.propagate(
+    ...     collection.path, [('rights','cc'), ('public',1)])
+"""
+import logging
+logger = logging.getLogger(__name__)
+from multiprocessing.pool import ThreadPool
+import os
+
+from ddrlocal.models import DDRLocalFile
+from ddrlocal.models import ENTITY_FILES_PREFIX
+from ddrlocal.models import entity as entitymodule
+from ddrlocal.models import files as filemodule
+from ddrlocal.models import cache
+from ddrlocal.models import catalog
+from ddrlocal.models.meta import patch_json, read_json
+
+
+INHERITANCE_THREADS = 4
+
+# Value an object would have for a field that is absent from its JSON.
+# Entities get every field (see schema.ENTITY); files only those that
+# DDRLocalFile has as class attributes.
+ENTITY_IMPLICIT = dict([(f['name'], f.get('default',None))
+                        for f in entitymodule.ENTITY_FIELDS])
+FILE_IMPLICIT = dict([(f['name'], getattr(DDRLocalFile, f['name']))
+                      for f in filemodule.FILE_FIELDS
+                      if hasattr(DDRLocalFile, f['name'])])
+ENTITY_NAMES = set([f['name'] for f in entitymodule.ENTITY_FIELDS])
+FILE_NAMES = set([f['name'] for f in filemodule.FILE_FIELDS])
+# Field order of the JSON written by dump_json; fields added by patch_json
+# go in their place so a later dump_json does not move them.
+ENTITY_ORDER = [f['name'] for f in entitymodule.ENTITY_FIELDS
+                if f['name'] not in ['files', 'filemeta']] + ['files']
+FILE_ORDER = ['path_rel'] + [f['name'] for f in filemodule.FILE_FIELDS]
+
+
+def is_entity_json( path ):
+    return os.path.basename(path) == 'entity.json'
+
+def is_file_json( path ):
+    basename = os.path.basename(path)
+    return (os.path.splitext(basename)[1] == '.json') \
+        and (('master' in basename) or ('mezzanine' in basename))
+
+def child_jsons( path ):
+    """Entity and file JSONs under path, grouped by entity.
+
+    JSON files in path itself (i.e. the parent's own JSON) are excluded,
+    as are .git directories.
+
+    @param path: Absolute path to Collection or Entity.
+    @returns: list of (entity_path, [json_path, ...]); entity.json first, then file JSONs.
+    """
+    path = os.path.normpath(path)
+    groups = {}
+    for dirpath,dirnames,filenames in os.walk(path):
+        if '.git' in dirnames:
+            dirnames.remove('.git')
+        if dirpath == path:
+            continue
+        for filename in filenames:
+            json_path = os.path.join(dirpath, filename)
+            if is_entity_json(json_path):
+                groups.setdefault(dirpath, [None, []])[0] = json_path
+            elif is_file_json(json_path) and (os.path.basename(dirpath) == ENTITY_FILES_PREFIX):
+                groups.setdefault(os.path.dirname(dirpath), [None, []])[1].append(json_path)
+    grouped = []
+    for entity_path in sorted(groups.keys()):
+        entity_json,file_jsons = groups[entity_path]
+        jsons = sorted(file_jsons)
+        if entity_json:
+            jsons.insert(0, entity_json)
+        grouped.append( (entity_path, jsons) )
+    return grouped
+
+def _field(data, name):
+    for item in data:
+        if hasattr(item, 'keys') and (name in item):
+            return item[name]
+    return None
+
+def _propagate_entity( args ):
+    """Patches one entity's JSON and file JSONs; runs in a worker thread.
+
+    @returns: (child_ids, changed_files)
+    """
+    entity_path,jsons,field_values = args
+    child_ids = []
+    changed_files = []
+    for json_path in jsons:
+        try:
+            if is_entity_json(json_path):
+                changed,data = patch_json(json_path, field_values, ENTITY_NAMES, ENTITY_IMPLICIT, ENTITY_ORDER)
+                if changed:
+                    # the collection's entity manifest notices the new mtime
+                    cache.objects.invalidate(entity_path)
+                    child_ids.append(_field(data, 'id') or os.path.basename(entity_path))
+            else:
+                changed,data = patch_json(json_path, field_values, FILE_NAMES, FILE_IMPLICIT, FILE_ORDER)
+                if changed:
+                    cache.objects.invalidate(json_path, entity_path)
+                    path_rel = _field(data, 'path_rel')
+                    if path_rel:
+                        child_ids.append(os.path.basename(path_rel))
+                    else:
+                        child_ids.append(os.path.basename(json_path))
+            if changed:
+                changed_files.append(json_path)
+            elif isinstance(data, dict):
+                logger.error(data.get('error', 'could not read %s' % json_path))
+        except (IOError, OSError, ValueError) as err:
+            logger.error('could not update %s: %s' % (json_path, err))
+    return child_ids,changed_files
+
+def update_catalog( changed_files, store_catalog=None ):
+    """Updates catalog rows and search documents for patched JSON files.
+
+    Files are reindexed along with their entity if its entity.json changed
+    too (see Catalog.update_entity); otherwise one by one.
+
+    @param changed_files: list of entity and file JSON paths
+    @param store_catalog: (optional) catalog.Catalog (default: the Store's)
+    """
+    if not changed_files:
+        return
+    if store_catalog is None:
+        store_catalog = catalog.store_catalog()
+    entity_paths = [os.path.dirname(path) for path in changed_files if is_entity_json(path)]
+    for entity_path in entity_paths:
+        collection_path = os.path.dirname(os.path.dirname(entity_path))
+        store_catalog.update_entity(collection_path, os.path.basename(entity_path))
+    for json_path in changed_files:
+        entity_path = os.path.dirname(os.path.dirname(json_path))
+        if is_entity_json(json_path) or (entity_path in entity_paths):
+            continue
+        data = read_json(json_path)
+        fdict = dict([(name, _field(data, name)) for name in ['path_rel', 'role', 'sha1', 'public']])
+        if fdict['path_rel']:
+            collection_path = os.path.dirname(os.path.dirname(entity_path))
+            store_catalog.update_file(collection_path, os.path.basename(entity_path), fdict, data)
+
+def propagate( parent_path, field_values, threads=INHERITANCE_THREADS, store_catalog=None ):
+    """Copies field values to all the entities and files under parent_path.
+
+    @param parent_path: Absolute path to Collection or Entity.
+    @param field_values: list of (fieldname, value) tuples.
+    @param threads: int Number of worker threads.
+    @param store_catalog: (optional) catalog.Catalog to update (default: the Store's)
+    @returns: tuple containing list of changed object Ids and list of changed objects' JSON files.
+    """
+    child_ids = []
+    changed_files = []
+    if not field_values:
+        return child_ids,changed_files
+    work = [(entity_path, jsons, field_values)
+            for entity_path,jsons in child_jsons(parent_path)]
+    if threads and (len(work) > 1):
+        pool = ThreadPool(threads)
+        try:
+            results = pool.map(_propagate_entity, work)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_propagate_entity(w) for w in work]
+    for ids,files in results:
+        child_ids.extend(ids)
+        changed_files.extend(files)
+    update_catalog(changed_files, store_catalog)
+    return child_ids,changed_files
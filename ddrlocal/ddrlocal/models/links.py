@@ -0,0 +1,190 @@
+"""Per-entity graph of links between files.
+
+A File's `links` field is a semicolon-separated list of other files.
+Finding the files that link *to* a file used to mean running find over
+the entity's files/ directory and parsing every file JSON.  The link
+graph keeps each file's path_rel and outgoing links in a single file
+next to entity.json, so incoming links are found without reading any
+file JSON.  As before, a link points to a file if the file's basename
+appears anywhere in it (e.g. with a path in front).  It is rebuilt when the mtime of
+the entity's files/ directory changes (file JSONs added or removed, git
+checkouts) and updated by DDRLocalFile.dump_json when a file's links
+change.  Rebuilds and updates hold an exclusive lock on
+file-links.json.lock so that concurrent writers (e.g. two celery workers
+saving files in the same entity) do not lose each other's changes.
+
+Format:
+    {
+        "files_mtime": 1400000000.0,
+        "files": {
+            "ddr-testing-123-1-master-a1b2c3d4e5.json": {
+                "path_rel": "ddr-testing-123-1-master-a1b2c3d4e5.jpg",
+                "links": ["ddr-testing-123-1-mezzanine-f6e5d4c3b2.jpg"]
+            },
+            ...
+        }
+    }
+"""
+from contextlib import contextmanager
+import fcntl
+import json
+import logging
+logger = logging.getLogger(__name__)
+import os
+
+from ddrlocal.models.meta import read_json, git_exclude
+
+LINKS_FILENAME = 'file-links.json'
+LOCK_FILENAME = 'file-links.json.lock'
+ENTITY_FILES_PREFIX = 'files'
+
+
+def graph_path(entity_path):
+    return os.path.join(entity_path, LINKS_FILENAME)
+
+def lock_path(entity_path):
+    return os.path.join(entity_path, LOCK_FILENAME)
+
+@contextmanager
+def locked(entity_path):
+    """Holds an exclusive lock on the entity's link graph.
+    """
+    path = lock_path(entity_path)
+    collection_path = os.path.dirname(os.path.dirname(entity_path))
+    git_exclude(collection_path, LOCK_FILENAME)
+    with open(path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def _mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+def parse_links(linksraw):
+    """Splits a File.links value into a list.
+    """
+    if not linksraw:
+        return []
+    return [link.strip() for link in linksraw.strip().split(';')]
+
+def _read_file(json_path):
+    """Gets path_rel and links from a file JSON.
+
+    @returns: dict with path_rel, links
+    """
+    entry = {'path_rel': None, 'links': []}
+    data = read_json(json_path)
+    # read_json returns a dict if the file could not be read
+    if isinstance(data, list):
+        for field in data:
+            if not hasattr(field, 'keys') or not field:
+                continue
+            if field.get('path_rel', None):
+                entry['path_rel'] = field['path_rel']
+            if field.get('links', None):
+                entry['links'] = parse_links(field['links'])
+    return entry
+
+def read(entity_path):
+    """Returns graph data or None if absent/unreadable.
+    """
+    path = graph_path(entity_path)
+    data = None
+    if os.path.exists(path):
+        data = read_json(path)
+    if isinstance(data, dict) and ('files' in data):
+        return data
+    return None
+
+def write(entity_path, data):
+    """Writes graph; write to temp file and rename so readers never see a partial file.
+    """
+    path = graph_path(entity_path)
+    tmp = '%s.%s.tmp' % (path, os.getpid())
+    with open(tmp, 'w') as f:
+        f.write(json.dumps(data, indent=4, separators=(',', ': '), sort_keys=True))
+    os.rename(tmp, path)
+    collection_path = os.path.dirname(os.path.dirname(entity_path))
+    git_exclude(collection_path, LINKS_FILENAME)
+
+def build(entity_path):
+    """Reads every file JSON in the entity and writes a new graph.
+
+    @param entity_path: Absolute path to entity
+    @returns: graph data
+    """
+    files_path = os.path.join(entity_path, ENTITY_FILES_PREFIX)
+    data = None
+    try:
+        with locked(entity_path):
+            data = _build(files_path)
+            write(entity_path, data)
+    except (IOError, OSError):
+        logger.error('could not write link graph %s' % graph_path(entity_path))
+        if data is None:
+            data = _build(files_path)
+    return data
+
+def _build(files_path):
+    data = {'files_mtime': _mtime(files_path), 'files': {}}
+    if data['files_mtime'] is not None:
+        for name in os.listdir(files_path):
+            if os.path.splitext(name)[1] == '.json':
+                data['files'][name] = _read_file(os.path.join(files_path, name))
+    return data
+
+def graph(entity_path):
+    """Returns graph data, rebuilding it if files/ has changed.
+    """
+    data = read(entity_path)
+    files_mtime = _mtime(os.path.join(entity_path, ENTITY_FILES_PREFIX))
+    if (data is None) or (data['files_mtime'] != files_mtime):
+        data = build(entity_path)
+    return data
+
+def incoming(entity_path, basename):
+    """List of path_rels of files that link to the file.
+
+    A link matches if basename is a substring of it, so links with a
+    path are found; a file with several matching links is listed once
+    for each.
+
+    @param entity_path: Absolute path to entity
+    @param basename: Basename of the file
+    """
+    files = graph(entity_path)['files']
+    return [files[name]['path_rel']
+            for name in sorted(files.keys())
+            for link in files[name]['links']
+            if basename in link]
+
+def update_file(entity_path, json_path, path_rel, linksraw):
+    """Updates a file's links after its JSON was written.
+
+    Does nothing if there is no graph yet (it will be built when needed)
+    or if the file's links have not changed.  The graph is re-read and
+    written under the lock (see locked).
+
+    @param entity_path: Absolute path to entity
+    @param json_path: Absolute path to file JSON
+    @param path_rel: File path_rel
+    @param linksraw: File.links value
+    """
+    if read(entity_path) is None:
+        return
+    name = os.path.basename(json_path)
+    entry = {'path_rel': path_rel, 'links': parse_links(linksraw)}
+    try:
+        with locked(entity_path):
+            data = read(entity_path)
+            if (data is None) or (data['files'].get(name) == entry):
+                return
+            data['files'][name] = entry
+            write(entity_path, data)
+    except (IOError, OSError):
+        logger.error('could not write link graph %s' % graph_path(entity_path))
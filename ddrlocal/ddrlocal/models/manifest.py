@@ -0,0 +1,219 @@
+"""Per-collection manifest of entity summaries.
+
+Listing a collection's entities used to mean listing files/ and opening
+every entity.json.  The manifest keeps a small summary of each entity
+(id, title, record_lastmod, number of files, public, status) in a single
+file next to collection.json.  It is updated incrementally when an entity
+is written or deleted, and validated against the mtimes of the files/
+directory and of each entity.json so that edits made outside of ddr-local
+(e.g. git pull) are picked up.  Writers hold an exclusive lock on
+entities-manifest.json.lock while they re-read, change and write the
+manifest, so concurrent updates (inheritance workers, celery tasks) are
+not lost.
+
+Format:
+    {
+        "files_mtime": 1400000000.0,
+        "entities": {
+            "ddr-testing-123-1": {
+                "id": "ddr-testing-123-1",
+                "title": "...",
+                "record_lastmod": "2014-01-01T00:00:00",
+                "files": 3,
+                "public": 1,
+                "status": "completed",
+                "mtime": 1400000000.0
+            },
+            ...
+        }
+    }
+"""
+from contextlib import contextmanager
+import fcntl
+import json
+import logging
+logger = logging.getLogger(__name__)
+import os
+
+from DDR import natural_sort
+from ddrlocal.models.meta import read_json, git_exclude
+
+MANIFEST_FILENAME = 'entities-manifest.json'
+LOCK_FILENAME = 'entities-manifest.json.lock'
+COLLECTION_FILES_PREFIX = 'files'
+
+
+def manifest_path(collection_path):
+    return os.path.join(collection_path, MANIFEST_FILENAME)
+
+def lock_path(collection_path):
+    return os.path.join(collection_path, LOCK_FILENAME)
+
+@contextmanager
+def locked(collection_path):
+    """Holds an exclusive lock on the collection's manifest.
+    """
+    git_exclude(collection_path, LOCK_FILENAME)
+    with open(lock_path(collection_path), 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def entity_json_path(collection_path, entity_id):
+    return os.path.join(collection_path, COLLECTION_FILES_PREFIX, entity_id, 'entity.json')
+
+def _mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+def entry(entity_id, data, mtime):
+    """Make a manifest entry from entity.json data.
+
+    @param entity_id: str
+    @param data: list of dicts, as read from entity.json
+    @param mtime: float entity.json modification time
+    @returns: dict
+    """
+    e = {'id': entity_id,
+         'title': '',
+         'record_lastmod': '',
+         'files': 0,
+         'public': None,
+         'status': None,
+         'mtime': mtime,}
+    # read_json returns a dict if the file could not be read
+    if isinstance(data, list):
+        for field in data:
+            if not hasattr(field, 'keys') or not field:
+                continue
+            key = field.keys()[0]
+            if key == 'files':
+                e['files'] = len(field[key] or [])
+            elif key in ['title', 'record_lastmod', 'public', 'status']:
+                e[key] = field[key]
+    return e
+
+def _read_entry(collection_path, entity_id):
+    path = entity_json_path(collection_path, entity_id)
+    mtime = _mtime(path)
+    if mtime is None:
+        return None
+    return entry(entity_id, read_json(path), mtime)
+
+def read(collection_path):
+    """Returns manifest data or a blank manifest if none/unreadable.
+    """
+    path = manifest_path(collection_path)
+    data = None
+    if os.path.exists(path):
+        data = read_json(path)
+    if not (isinstance(data, dict) and ('entities' in data)):
+        data = {'files_mtime': None, 'entities': {}}
+    return data
+
+def write(collection_path, data):
+    """Writes manifest; write to temp file and rename so readers never see a partial file.
+    """
+    path = manifest_path(collection_path)
+    tmp = '%s.%s.tmp' % (path, os.getpid())
+    with open(tmp, 'w') as f:
+        f.write(json.dumps(data, indent=4, separators=(',', ': '), sort_keys=True))
+    os.rename(tmp, path)
+    git_exclude(collection_path, MANIFEST_FILENAME)
+
+def entities(collection_path):
+    """Returns validated list of manifest entries, in natural order of entity ID.
+
+    The files/ dir is only listed if its mtime has changed since the manifest
+    was written.  Entries are re-read from entity.json only if entity.json
+    mtime has changed.  Manifest is rewritten only if something changed,
+    in which case it is re-read and validated again under the lock.
+
+    @param collection_path: Absolute path to collection
+    @returns: list of dicts
+    """
+    if _mtime(os.path.join(collection_path, COLLECTION_FILES_PREFIX)) is None:
+        return []
+    data = read(collection_path)
+    if _validate(collection_path, data):
+        try:
+            with locked(collection_path):
+                data = read(collection_path)
+                if _validate(collection_path, data):
+                    write(collection_path, data)
+        except (IOError, OSError):
+            logger.error('could not write manifest %s' % manifest_path(collection_path))
+    return [data['entities'][eid] for eid in natural_sort(data['entities'].keys())]
+
+def _validate(collection_path, data):
+    """Brings manifest data up to date with files/ and the entity.json files.
+
+    @returns: True if data was changed
+    """
+    files_path = os.path.join(collection_path, COLLECTION_FILES_PREFIX)
+    files_mtime = _mtime(files_path)
+    if files_mtime is None:
+        data['files_mtime'] = None
+        data['entities'] = {}
+        return False
+    dirty = False
+    if files_mtime != data['files_mtime']:
+        entity_ids = os.listdir(files_path)
+        for eid in data['entities'].keys():
+            if eid not in entity_ids:
+                data['entities'].pop(eid)
+        data['files_mtime'] = files_mtime
+        dirty = True
+    else:
+        entity_ids = data['entities'].keys()
+    for eid in entity_ids:
+        e = data['entities'].get(eid)
+        mtime = _mtime(entity_json_path(collection_path, eid))
+        if e and (mtime == e['mtime']):
+            continue
+        e = None
+        if mtime is not None:
+            e = _read_entry(collection_path, eid)
+        if e:
+            data['entities'][eid] = e
+        elif eid in data['entities']:
+            data['entities'].pop(eid)
+        dirty = True
+    return dirty
+
+def update_entity(collection_path, entity_id, data=None):
+    """Updates manifest entry for one entity after its entity.json was written.
+
+    @param collection_path: Absolute path to collection
+    @param entity_id: str
+    @param data: (optional) list of dicts as written to entity.json
+    """
+    path = entity_json_path(collection_path, entity_id)
+    try:
+        with locked(collection_path):
+            mtime = _mtime(path)
+            manifest = read(collection_path)
+            if mtime is None:
+                manifest['entities'].pop(entity_id, None)
+            elif data is not None:
+                manifest['entities'][entity_id] = entry(entity_id, data, mtime)
+            else:
+                manifest['entities'][entity_id] = _read_entry(collection_path, entity_id)
+            write(collection_path, manifest)
+    except (IOError, OSError):
+        logger.error('could not write manifest %s' % manifest_path(collection_path))
+
+def remove_entity(collection_path, entity_id):
+    """Removes manifest entry for a deleted entity.
+    """
+    try:
+        with locked(collection_path):
+            manifest = read(collection_path)
+            if manifest['entities'].pop(entity_id, None):
+                write(collection_path, manifest)
+    except (IOError, OSError):
+        logger.error('could not write manifest %s' % manifest_path(collection_path))
@@ -5,6 +5,9 @@ logger = logging.getLogger(__name__)
 import os
 
 
+# Files hashed in parallel by EntityJSON.update_checksums.
+# hashlib releases the GIL on large blocks so threads help on multi-disk/SSD stores.
+CHECKSUM_THREADS = 4
 
 #MODULE_PATH   = os.path.dirname(os.path.abspath(__file__))
 #TEMPLATE_PATH = os.path.join(MODULE_PATH, 'templates')
@@ -49,6 +52,132 @@ def read_json(filename):
         data = {"error": diagnose_json_read_error(filename)}
     return data
 
+def format_json(data):
+    """JSON text formatted exactly as DDR.models.write_json writes it.
+    """
+    return json.dumps(data, indent=4, separators=(',', ': '), sort_keys=True)
+
+def patch_json(path, field_values, names=None, implicit=None, order=None):
+    """Sets fields in a list-of-dicts JSON file in place.
+    
+    Only the dicts holding the specified keys are modified; if none of the
+    values differ from what is already in the file the file is not written.
+    Output uses write_json formatting so unchanged parts of a file written
+    by write_json stay byte-identical and git diffs show only the patched
+    keys.  The file is rewritten in place (not renamed) so directory
+    mtimes, which several indexes use for validation, do not change.
+    
+    @param path: Absolute path to JSON file.
+    @param field_values: list of (fieldname, value) tuples.
+    @param names: (optional) Set of fieldnames that may be patched if present;
+                  default is all.
+    @param implicit: (optional) dict of fieldname:value for fields absent from
+                     the file; if value differs the field is added.
+    @param order: (optional) list of fieldnames in the order the object's
+                  dump_json writes them; added fields are inserted at their
+                  place in it rather than appended.
+    @returns: (changed, data) changed is Boolean, data the list of dicts,
+              or (False, dict) if the file could not be read.
+    """
+    try:
+        with open(path, 'r') as f:
+            raw = f.read()
+        data = json.loads(raw)
+    except:
+        return False,{"error": diagnose_json_read_error(path)}
+    if not isinstance(data, list):
+        return False,data
+    implicit = implicit or {}
+    rank = dict([(name,n) for n,name in enumerate(order or [])])
+    changed = False
+    for field,value in field_values:
+        item = None
+        if (names is None) or (field in names):
+            # later items win, as when objects are loaded
+            for i in data:
+                if hasattr(i, 'keys') and (field in i):
+                    item = i
+        if item is not None:
+            if item[field] != value:
+                item[field] = value
+                changed = True
+        elif (field in implicit) and (implicit[field] != value):
+            data.insert(_position(data, field, rank), {field: value})
+            changed = True
+    if changed:
+        text = format_json(data)
+        if text == raw:
+            changed = False
+        else:
+            with open(path, 'w') as f:
+                f.write(text)
+    return changed,data
+
+def _position(data, field, rank):
+    """Index before the first dict whose key comes after field in rank.
+    """
+    if field in rank:
+        for n,item in enumerate(data):
+            if hasattr(item, 'keys') and item:
+                key = item.keys()[0]
+                if (key in rank) and (rank[key] > rank[field]):
+                    return n
+    return len(data)
+
+def patch_json_file_dict(path, fdict):
+    """Updates one file's dict in the 'files' list of an entity.json in place.
+    
+    The dict with the same path_rel gets the keys and values of fdict.
+    As with patch_json the file is written only if something differs.
+    
+    @param path: Absolute path to entity.json.
+    @param fdict: dict with path_rel (see models.ENTITY_FILE_KEYS)
+    @returns: (changed, data) as for patch_json
+    """
+    try:
+        with open(path, 'r') as f:
+            raw = f.read()
+        data = json.loads(raw)
+    except:
+        return False,{"error": diagnose_json_read_error(path)}
+    if not isinstance(data, list):
+        return False,data
+    changed = False
+    for item in data:
+        if hasattr(item, 'keys') and isinstance(item.get('files', None), list):
+            for fd in item['files']:
+                if hasattr(fd, 'keys') and (fd.get('path_rel', None) == fdict['path_rel']):
+                    for key,value in fdict.iteritems():
+                        if (key not in fd) or (fd[key] != value):
+                            fd[key] = value
+                            changed = True
+    if changed:
+        text = format_json(data)
+        if text == raw:
+            changed = False
+        else:
+            with open(path, 'w') as f:
+                f.write(text)
+    return changed,data
+
+def git_exclude(repo_path, pattern):
+    """Adds pattern to the repo's .git/info/exclude if not already present.
+
+    Used for locally-generated files (caches, indexes) that live inside
+    a repository but must never show up in git status or be committed.
+    """
+    info_dir = os.path.join(repo_path, '.git', 'info')
+    if not os.path.exists(info_dir):
+        return
+    exclude = os.path.join(info_dir, 'exclude')
+    lines = []
+    if os.path.exists(exclude):
+        with open(exclude, 'r') as f:
+            lines = [line.strip() for line in f.readlines()]
+    if pattern not in lines:
+        with open(exclude, 'a') as f:
+            f.write('%s\n' % pattern)
+
 
 
 
@@ -89,7 +218,7 @@ class CollectionJSON():
         logger.debug('    CollectionJSON.update_files({})'.format(collection))
         
         fdict = {}
-        for entity in collection.entities():
+        for entity in collection.entities(quick=True):
             fdict[entity.uid] = {'eid':entity.uid,}
         
         # has to be sorted list so can meaningfully version
@@ -160,18 +289,21 @@ class EntityJSON():
                 entity_path = '{}/'.format(entity_path)
             return payload_file.replace(entity_path, '')
         
+        # each file read once for all three algorithms
+        checksums = entity.checksums_multi(['sha1', 'sha256', 'md5'],
+                                           threads=CHECKSUM_THREADS)
         fdict = {}
-        for sha1,path in entity.checksums('sha1'):
+        for sha1,path in checksums['sha1']:
             relpath = relative_path(entity.path, path)
             size = os.path.getsize(path)
             fdict[relpath] = {'path':relpath,
                               'basename':os.path.basename(path),
                               'sha1':sha1,
                               'size':size,}
-        for sha256,path in entity.checksums('sha256'):
+        for sha256,path in checksums['sha256']:
             relpath = relative_path(entity.path, path)
             fdict[relpath]['sha256'] = sha256
-        for md5,path in entity.checksums('md5'):
+        for md5,path in checksums['md5']:
             relpath = relative_path(entity.path, path)
             fdict[relpath]['md5'] = md5
         
@@ -0,0 +1,193 @@
+"""Compiled field schemas for the Collection, Entity, and File models.
+
+The *_FIELDS lists in the model modules are lists of field dicts and the
+JSON files are lists of single-key dicts.  Matching them up with nested
+loops costs O(fields x items) per object.  A FieldSchema is built once
+per model module; it precomputes the set of field names, the default
+values and the datetime parsers so that load() populates an object in a
+single pass over the JSON data.
+
+It also holds the display_/formprep_/formpost_/csvexport_ hooks as
+tables of fieldname:function, resolved once instead of looking each
+function up by name (DDR.models.module_function) for every field of
+every object.  Fields without a hook get identity().
+
+snapshot() and changed() are used for dirty-field tracking: objects keep
+a snapshot of their field values per output file (JSON, METS, EAD) taken
+when they are loaded or the file is written, so dump_* can skip writing
+files whose contents would not change.
+
+    >>> from ddrlocal.models import schema
+    >>> schema.ENTITY.load(entity, json_data)
+    >>> schema.ENTITY.display['creators'](entity.creators)
+    >>> schema.ENTITY.changed(entity, entity._snapshots['json'])
+    ['title']
+"""
+import copy
+from datetime import datetime
+import logging
+logger = logging.getLogger(__name__)
+
+from django.conf import settings
+
+from ddrlocal.models import collection as collectionmodule
+from ddrlocal.models import entity as entitymodule
+from ddrlocal.models import files as filemodule
+
+
+HOOK_PREFIXES = ['display', 'formprep', 'formpost', 'csvexport']
+
+def identity( value ):
+    return value
+
+def compile_hooks( module, fields, prefix ):
+    """Table of fieldname:function for "{prefix}_{fieldname}" functions in module.
+    
+    Same lookup as DDR.models.module_function, done once per field.
+    """
+    table = {}
+    for f in fields:
+        function = getattr(module, '%s_%s' % (prefix, f['name']), None)
+        if callable(function):
+            table[f['name']] = function
+        else:
+            table[f['name']] = identity
+    return table
+
+def _frozen( value ):
+    """Copy of value that later in-place edits to value won't affect.
+    """
+    if isinstance(value, (list, dict, set)):
+        return copy.deepcopy(value)
+    return value
+
+
+class FieldSchema( object ):
+    """Precomputed view of a model module's *_FIELDS list.
+    """
+    module = None
+    fields = []
+    form_fields = []
+    names = set()
+    tracked = []
+    defaults = []
+    parsers = []
+    display = {}
+    formprep = {}
+    formpost = {}
+    csvexport = {}
+
+    def __init__( self, module, fields, parsers=None, fill_defaults=True, tracked=None ):
+        """
+        @param module: Model module (collectionmodule, entitymodule, filemodule).
+        @param fields: The module's *_FIELDS list.
+        @param parsers: dict of fieldname:function; function gets the raw value
+                        (None if absent) and returns the value to set.
+                        If it returns the value unchanged nothing is set.
+        @param fill_defaults: Boolean. Set defaults for fields absent from JSON.
+        @param tracked: list of attribute names covered by snapshot() (default: all fields).
+        """
+        self.module = module
+        self.fields = fields
+        # fields that appear in forms, labels_values, and entity CSV exports
+        self.form_fields = [f for f in fields if f.get('form',None)]
+        self.names = set([f['name'] for f in fields])
+        if tracked is None:
+            tracked = [f['name'] for f in fields]
+        self.tracked = list(tracked)
+        self.defaults = []
+        if fill_defaults:
+            self.defaults = [(f['name'], f.get('default',None)) for f in fields]
+        self.parsers = []
+        if parsers:
+            self.parsers = [(f['name'], parsers[f['name']])
+                            for f in fields if f['name'] in parsers]
+        for prefix in HOOK_PREFIXES:
+            setattr(self, prefix, compile_hooks(module, fields, prefix))
+
+    def load( self, obj, json_data ):
+        """Populate obj attributes from JSON data in one pass.
+
+        Equivalent to the old nested loops: later items win, items for
+        fields not in the schema are ignored, parsers run on the result,
+        then defaults fill in whatever is still missing.
+
+        @param obj: Collection, Entity, or File object.
+        @param json_data: list of single-key dicts (i.e. from read_json).
+        """
+        names = self.names
+        for item in json_data:
+            if hasattr(item, 'keys') and item:
+                key = item.keys()[0]
+                if key in names:
+                    setattr(obj, key, item[key])
+        for name,parse in self.parsers:
+            value = getattr(obj, name, None)
+            parsed = parse(value)
+            if parsed is not value:
+                setattr(obj, name, parsed)
+        for name,default in self.defaults:
+            if not hasattr(obj, name):
+                setattr(obj, name, default)
+
+    def snapshot( self, obj ):
+        """Copy of obj's tracked field values.
+        
+        @param obj: Collection, Entity, or File object.
+        @returns: dict of fieldname:value
+        """
+        return dict([(name, _frozen(getattr(obj, name, None))) for name in self.tracked])
+
+    def changed( self, obj, snapshot ):
+        """Names of tracked fields whose values differ from the snapshot.
+        
+        @param obj: Collection, Entity, or File object.
+        @param snapshot: dict from snapshot() or None (everything has changed).
+        @returns: list of fieldnames
+        """
+        if snapshot is None:
+            return list(self.tracked)
+        return [name for name in self.tracked
+                if getattr(obj, name, None) != snapshot.get(name, None)]
+
+
+def parse_collection_datetime( value ):
+    """Collections: parse with DATETIME_FORMAT; blank means now.
+    """
+    if value:
+        return datetime.strptime(value, settings.DATETIME_FORMAT)
+    return datetime.now()
+
+def parse_entity_datetime( value ):
+    """Entities: try DATETIME_FORMAT then TIME_FORMAT, fall back to now; blanks left alone.
+    """
+    if not value:
+        return value
+    try:
+        return datetime.strptime(value, settings.DATETIME_FORMAT)
+    except:
+        try:
+            return datetime.strptime(value, settings.TIME_FORMAT)
+        except:
+            pass
+    return datetime.now()
+
+
+COLLECTION = FieldSchema(
+    collectionmodule, collectionmodule.COLLECTION_FIELDS,
+    parsers={'record_created': parse_collection_datetime,
+             'record_lastmod': parse_collection_datetime,})
+
+ENTITY = FieldSchema(
+    entitymodule, entitymodule.ENTITY_FIELDS,
+    parsers={'record_created': parse_entity_datetime,
+             'record_lastmod': parse_entity_datetime,},
+    # Entity tracks its file list separately (see DDRLocalEntity.changed_fields)
+    tracked=[f['name'] for f in entitymodule.ENTITY_FIELDS
+             if f['name'] not in ['files', 'filemeta']])
+
+FILE = FieldSchema(
+    filemodule, filemodule.FILE_FIELDS,
+    fill_defaults=False,
+    # path_rel is written to file JSONs but is not in FILE_FIELDS
+    tracked=['path_rel'] + [f['name'] for f in filemodule.FILE_FIELDS])
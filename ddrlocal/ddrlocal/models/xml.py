@@ -1,11 +1,16 @@
+from collections import OrderedDict
+import copy
 import logging
 logger = logging.getLogger(__name__)
 import os
+import threading
 
 from lxml import etree
 
 from django.conf import settings
 
+from ddrlocal.models.cache import stat_signature
+
 
 
 NAMESPACES = {
@@ -33,6 +38,91 @@ def load_template(filename):
     return template
 
 
+# compiled XPath -------------------------------------------------------
+#
+# The mets_* and ead_* functions in ddrlocal.models.entity/collection
+# evaluate the same handful of XPath expressions every time an entity or
+# collection is saved.  Compile each expression once and reuse it.
+# etree.XPath objects are not shared between threads.
+
+_XPATHS = threading.local()
+
+def compiled_xpath(expr, namespaces=None):
+    """Returns etree.XPath for expr and namespaces, compiled once per thread.
+    
+    >>> compiled_xpath('/mets:mets', {'mets': 'http://www.loc.gov/METS/'})(tree)
+    """
+    xpaths = getattr(_XPATHS, 'xpaths', None)
+    if xpaths is None:
+        xpaths = _XPATHS.xpaths = {}
+    key = (expr, None)
+    if namespaces:
+        key = (expr, tuple(sorted(namespaces.items())))
+    xpath = xpaths.get(key, None)
+    if xpath is None:
+        xpath = xpaths[key] = etree.XPath(expr, namespaces=namespaces)
+    return xpath
+
+
+# parsed trees ---------------------------------------------------------
+
+XML_TREE_CACHE_SIZE = 100
+
+class TreeCache( object ):
+    """Size-bounded LRU of parsed XML files (i.e. mets.xml, ead.xml).
+    
+    Entries are validated against the file's stat signature so a changed
+    file is re-parsed.  Callers get a deep copy they can modify; the
+    cached tree is never handed out.  Note that the cache holds the
+    object's own XML file, not the blank template, so anything in the
+    file that the mets_/ead_ functions do not write is preserved.
+    Writers put() the file they just wrote.  It is parsed there and
+    then, rather than caching the in-memory tree it was serialized from
+    (whitespace and tail text can differ), so cached and uncached reads
+    of a file are the same.
+    """
+    
+    def __init__( self, size=XML_TREE_CACHE_SIZE ):
+        self.size = size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def parse( self, path ):
+        """Returns copy of etree.ElementTree for the file at path.
+        """
+        signature = stat_signature(path)
+        with self._lock:
+            entry = self._data.pop(path, None)
+        if (entry is None) or (entry[0] != signature):
+            entry = (signature, etree.parse(path))
+        with self._lock:
+            self._data[path] = entry
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+        return copy.deepcopy(entry[1])
+    
+    def put( self, path ):
+        """Parses and caches path, which was just written.
+        
+        @param path: Absolute path to XML file.
+        """
+        signature = stat_signature(path)
+        tree = etree.parse(path)
+        with self._lock:
+            self._data.pop(path, None)
+            self._data[path] = (signature, tree)
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+    
+    def invalidate( self, *paths ):
+        with self._lock:
+            for path in paths:
+                self._data.pop(path, None)
+
+# one per process
+trees = TreeCache()
+
+
 
 class EAD( object ):
     """Encoded Archival Description (EAD) file.
@@ -89,7 +179,7 @@ class EAD( object ):
         head = etree.SubElement(dsc, 'head')
         head.text = 'Inventory'
         n = 0
-        for entity in collection.entities():
+        for entity in collection.entities(quick=True):
             n = n + 1
             # add c01, did, unittitle
             c01 = etree.SubElement(dsc, 'c01')
@@ -118,10 +118,10 @@ from django.conf import settings
 from DDR import commands
 from DDR.models import metadata_files
 from webui.models import Collection, Entity
-from ddrlocal.models import module_function
 from ddrlocal.models import DDRLocalEntity, DDRLocalFile
 from ddrlocal.models import entity as entitymodule
 from ddrlocal.models import files as filemodule
+from ddrlocal.models import schema
 from ddrlocal.models.entity import ENTITY_FIELDS
 from ddrlocal.models.entity import STATUS_CHOICES, PERMISSIONS_CHOICES, RIGHTS_CHOICES
 from ddrlocal.models.entity import LANGUAGE_CHOICES, GENRE_CHOICES, FORMAT_CHOICES
@@ -785,17 +785,14 @@ def export_entities( collection_path, csv_path ):
             entity_dir = os.path.dirname(path)
             entity_id = os.path.basename(entity_dir)
             entity = DDRLocalEntity.from_json(entity_dir)
-            # seealso ddrlocal.models.__init__.module_function()
+            # seealso ddrlocal.models.schema.compile_hooks()
             values = []
             for f in entitymodule.ENTITY_FIELDS:
                 value = ''
                 if hasattr(entity, f['name']) and f.get('form',None):
                     key = f['name']
-                    label = f['form']['label']
                     # run csvexport_* functions on field data if present
-                    val = module_function(entitymodule,
-                                          'csvexport_%s' % key,
-                                          getattr(entity, f['name']))
+                    val = schema.ENTITY.csvexport[key](getattr(entity, key))
                     if not (isinstance(val, str) or isinstance(val, unicode)):
                         val = unicode(val)
                     if val:
@@ -846,16 +843,14 @@ def export_files( collection_path, csv_path ):
             file_id = os.path.splitext(filename)[0]
             file_ = DDRLocalFile.from_json(path)
             if file_:
-                # seealso ddrlocal.models.__init__.module_function()
+                # seealso ddrlocal.models.schema.compile_hooks()
                 values = []
                 for f in filemodule.FILE_FIELDS:
                     value = ''
                     if hasattr(file_, f['name']):
                         key = f['name']
                         # run csvexport_* functions on field data if present
-                        val = module_function(filemodule,
-                                              'csvexport_%s' % key,
-                                              getattr(file_, f['name']))
+                        val = schema.FILE.csvexport[key](getattr(file_, key))
                         if not (isinstance(val, str) or isinstance(val, unicode)):
                             val = unicode(val)
                         if val:
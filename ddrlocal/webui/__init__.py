@@ -38,6 +38,7 @@ WEBUI_MESSAGES = {
     'VIEWS_COLL_ERR_CREATE': 'Error: Could not create new collection.',
     'VIEWS_COLL_UPDATED': 'Collection updated',
     'VIEWS_COLL_LOCKED': 'Collection is locked: <strong>{}</strong>', # collection_id
+    'VIEWS_COLL_GITSTATUS_REFRESH': 'Refreshing git status for <strong>{}</strong>. Reload this page in a few seconds.', # collection_id
     'VIEWS_COLL_BEHIND': 'Collection <strong>{}</strong> is behind and needs to be synced.', # collection_id
     'VIEWS_COLL_CONFLICTED': 'Collection <strong>{}</strong> is in a conflicted state. <a href="{}">Click here to resolve.</a>', # collection_id, url
     
@@ -22,23 +22,65 @@ they are replaced.  The user is informed when the files were last
 updated and (TODO) can request an update if they want.
 
 
-Queue file
+Queue
 
 List of collection_ids and timestamps, arranged in timestamp order (ASCENDING)
 Collections that have not been updated are timestamped with past date (epoch)
-First line contains date of last queue_generate().
+Queue also records date of last queue_generate().
 Timestamps represent next earliest update datetime.
 After running gitstatus on collection, next update time is scheduled.
 Time is slightly randomized so updates gradually spread out.
+With GITSTATUS_MAX_INTERVAL each collection's interval adapts to how
+often it changes, how long git-status takes on it, and whether it is
+ahead or behind; per-collection stats are kept in the database and
+shown at /ui/collections/gitstatus/ (see adaptive_interval).
+
+The queue is a sqlite table indexed on timestamp (STORE/tmp/gitstatus.db,
+see Queue) so that taking the next collections and rescheduling one are
+O(log n) rather than parsing, sorting and rewriting a text file every
+tick.  The text format (queue_dumps/queue_loads) is kept for debugging:
+queue_export() writes it to STORE/tmp/gitstatus-queue, and an existing
+text queue is imported when the database is first created.
+
+With GITSTATUS_CONCURRENCY > 1 each update_store run takes the most
+overdue collections (up to GITSTATUS_BATCH) from the queue and checks them in a pool of worker
+threads until GITSTATUS_TIME_BUDGET runs out; each result is written to
+the queue as soon as it completes.
+
+
+Statuses
+
+The results for each collection are written to STORE/tmp/COLLECTION.status
+and to a status table in the same database (see StatusStore).  Pages read
+statuses from the table: read_many() gets the statuses of all the
+collections on a page in one query, and each web process keeps them in
+memory until a generation counter, bumped by every write of a new status,
+changes.  Existing .status files are imported when the table is created.
+
+
+Fingerprints
+
+Most collections are idle most of the time.  Before running git-status
+and git-annex-status, update() fingerprints the repository's .git/index,
+HEAD, packed-refs and refs/ (local and remote-tracking branches) by
+mtime and size.  If the fingerprint matches the one saved with the last
+.status write (STORE/tmp/COLLECTION.fingerprint) only the timestamps in
+the .status file are rewritten.  Pass force=True to always run git (as
+the post-sync task and the collection git-status Refresh button do).
 """
 
 from datetime import datetime, timedelta
+import hashlib
 import json
 import logging
 logger = logging.getLogger(__name__)
+from multiprocessing.pool import ThreadPool
 import os
 import random
 import re
+import sqlite3
+import threading
+import time
 
 from django.conf import settings
 from django.core.cache import cache
@@ -70,6 +112,15 @@ def tmp_dir( base_dir ):
         os.makedirs(path)
     return path
     
+def db_path( base_dir ):
+    """
+    - STORE/tmp/gitstatus.db (queue and statuses)
+    """
+    return os.path.join(
+        tmp_dir(base_dir),
+        'gitstatus.db'
+    )
+
 def queue_path( base_dir ):
     return os.path.join(
         tmp_dir(base_dir),
@@ -91,6 +142,60 @@ def path( base_dir, collection_path ):
         '%s.status' % os.path.basename(collection_path)
     )
 
+def fingerprint_path( base_dir, collection_path ):
+    """
+    - STORE/tmp/ddr-test-123.fingerprint
+    """
+    return os.path.join(
+        tmp_dir(base_dir),
+        '%s.fingerprint' % os.path.basename(collection_path)
+    )
+
+# Files in .git whose mtimes/sizes change when git-status output might.
+FINGERPRINT_FILES = ['index', 'HEAD', 'packed-refs']
+FINGERPRINT_DIRS = ['refs']
+
+def fingerprint( collection_path ):
+    """Cheap digest of the repository state that git-status depends on.
+    
+    Covers .git/index, HEAD, packed-refs, and every ref under .git/refs
+    (including refs/remotes, i.e. tracking branches updated by fetch).
+    Changes to the working tree that have not touched the index are not
+    seen; ddr-local commits through git so this is not normally an issue.
+    
+    @param collection_path: Absolute path to collection repo
+    @returns: str hex digest, or None if not a git repo
+    """
+    git_dir = os.path.join(collection_path, '.git')
+    if not os.path.isdir(git_dir):
+        return None
+    stats = []
+    def add( path ):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return
+        stats.append('%s %r %s' % (os.path.relpath(path, git_dir), st.st_mtime, st.st_size))
+    for name in FINGERPRINT_FILES:
+        add(os.path.join(git_dir, name))
+    for name in FINGERPRINT_DIRS:
+        for dirpath,dirnames,filenames in os.walk(os.path.join(git_dir, name)):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                add(os.path.join(dirpath, filename))
+    return hashlib.sha1('\n'.join(stats)).hexdigest()
+
+def read_fingerprint( base_dir, collection_path ):
+    path = fingerprint_path(base_dir, collection_path)
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            return f.read().strip()
+    return None
+
+def write_fingerprint( base_dir, collection_path, digest ):
+    with open(fingerprint_path(base_dir, collection_path), 'w') as f:
+        f.write('%s\n' % digest)
+
 def status_paths( base_dir ):
     """Returns list of collection_ids for which there are gitstatus files.
     """
@@ -152,23 +257,190 @@ def loads( text ):
         'sync_status': syncstatus,
     }
 
-def write( base_dir, collection_path, timestamp, elapsed, status, annex_status, syncstatus ):
-    """Writes .gitstatus for the collection; see format.
+class StatusStore( object ):
+    """Status of all the collections in a Store, with an in-process cache.
+    
+    Rows hold the same text as the .status files (see dumps).  Each put()
+    of a new status increments a generation counter in the meta table.
+    Readers compare it with the generation of their cache, which is
+    emptied when the two differ, so a page costs one small query plus at
+    most one batch query.  Puts that only refresh timestamps (see update)
+    do not bump the generation; cached copies keep the older timestamps.
+    
+    >>> store = status_db(base_dir)
+    >>> store.put('ddr-test-123', text)
+    >>> store.read_many(['ddr-test-123', 'ddr-test-124'])
+    {'ddr-test-123': {'timestamp': ..., 'status': ..., ...}}
+    """
+    path = None
+    # sqlite limits the number of host parameters in a query
+    batch_size = 500
+    
+    def __init__( self, path ):
+        self.path = path
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._cache = {}
+        self._generation = None
+    
+    def _connection( self ):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = _connect(self.path)
+            self._local.conn = conn
+        return conn
+    
+    def __len__( self ):
+        return self._connection().execute('SELECT COUNT(*) FROM status').fetchone()[0]
+    
+    def generation( self ):
+        row = self._connection().execute(
+            "SELECT value FROM meta WHERE key='status_generation'").fetchone()
+        if row:
+            return int(row[0])
+        return 0
+    
+    def put( self, collection_id, text, bump=True ):
+        """Saves the status text for the collection.
+        
+        @param collection_id
+        @param text: str (see dumps)
+        @param bump: Boolean Increment the generation (invalidates readers' caches).
+        """
+        self.load([(collection_id, text)], bump=bump)
+    
+    def load( self, statuses, replace=True, bump=True ):
+        """Saves several statuses in one transaction.
+        
+        @param statuses: list of (collection_id, text)
+        @param replace: Boolean Overwrite existing rows.
+        @param bump: Boolean Increment the generation.
+        """
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.executemany(
+                'INSERT OR %s INTO status (collection_id, text) VALUES (?, ?)' % (
+                    'REPLACE' if replace else 'IGNORE'),
+                statuses)
+            if bump:
+                conn.execute("""INSERT OR REPLACE INTO meta (key, value)
+                    SELECT 'status_generation', COALESCE(MAX(CAST(value AS INTEGER)), 0) + 1
+                    FROM meta WHERE key='status_generation'""")
+            conn.execute('COMMIT')
+        except:
+            conn.execute('ROLLBACK')
+            raise
+    
+    def read_many( self, collection_ids ):
+        """Parsed status for each of the collections that has one.
+        
+        @param collection_ids: list
+        @returns: dict of collection_id: dict (see loads)
+        """
+        generation = self.generation()
+        with self._lock:
+            if generation != self._generation:
+                self._cache = {}
+                self._generation = generation
+            cached = self._cache
+        missing = [cid for cid in collection_ids if cid not in cached]
+        fetched = dict([(cid, None) for cid in missing])
+        conn = self._connection()
+        for n in range(0, len(missing), self.batch_size):
+            chunk = missing[n:n+self.batch_size]
+            rows = conn.execute(
+                'SELECT collection_id, text FROM status WHERE collection_id IN (%s)' % (
+                    ','.join(['?'] * len(chunk))),
+                chunk)
+            for cid,text in rows:
+                fetched[cid] = loads(text)
+        if fetched:
+            with self._lock:
+                # a write since generation() was read empties the cache anyway
+                if self._generation == generation:
+                    self._cache.update(fetched)
+        data = {}
+        for cid in collection_ids:
+            if cid in fetched:
+                status = fetched[cid]
+            else:
+                status = cached.get(cid, None)
+            if status:
+                # callers get copies; cached dicts are shared between threads
+                data[cid] = dict(status)
+        return data
+
+_STATUS_STORES = {}
+_STATUS_STORES_LOCK = threading.Lock()
+
+def status_db( base_dir ):
+    """StatusStore for the Store; imports .status files if the database is new.
+    """
+    path = db_path(base_dir)
+    with _STATUS_STORES_LOCK:
+        store = _STATUS_STORES.get(path, None)
+        if (store is None) or (not os.path.exists(path)):
+            store = StatusStore(path)
+            if not len(store):
+                statuses = []
+                for status_path in status_paths(base_dir):
+                    try:
+                        with open(status_path, 'r') as f:
+                            statuses.append(
+                                (os.path.splitext(os.path.basename(status_path))[0], f.read()))
+                    except IOError as err:
+                        logger.error('gitstatus: %s' % err)
+                if statuses:
+                    store.load(statuses, replace=False)
+                    log('imported %s .status files' % len(statuses))
+            _STATUS_STORES[path] = store
+    return store
+
+def write( base_dir, collection_path, timestamp, elapsed, status, annex_status, syncstatus, changed=True ):
+    """Writes .gitstatus for the collection to file and StatusStore; see format.
+    
+    @param changed: Boolean False if only the timestamps differ from the
+                    last write (see StatusStore).
     """
     text = dumps(timestamp, elapsed, status, annex_status, syncstatus) + '\n'
     with open(path(base_dir, collection_path), 'w') as f:
         f.write(text)
+    try:
+        status_db(base_dir).put(os.path.basename(collection_path), text, bump=changed)
+    except sqlite3.Error as err:
+        logger.error('gitstatus db: %s' % err)
     return text
 
+def read_many( base_dir, collection_ids ):
+    """Reads status for several collections at once and returns parsed data.
+    
+    Statuses come from the StatusStore (existing .status files are
+    imported when it is created, see status_db).  If the database cannot
+    be read the .status files are read instead.
+    
+    @param base_dir: Absolute path to Store.
+    @param collection_ids: list
+    @returns: dict of collection_id: dict (see loads); collections without status are omitted
+    """
+    if not os.path.exists(tmp_dir(base_dir)):
+        return {}
+    try:
+        return status_db(base_dir).read_many(collection_ids)
+    except sqlite3.Error as err:
+        logger.error('gitstatus db: %s' % err)
+    data = {}
+    for collection_id in collection_ids:
+        if os.path.exists(path(base_dir, collection_id)):
+            with open(path(base_dir, collection_id), 'r') as f:
+                data[collection_id] = loads(f.read())
+    return data
+
 def read( base_dir, collection_path ):
     """Reads .gitstatus for the collection and returns parsed data.
     """
-    if os.path.exists(path(base_dir, collection_path)):
-        with open(path(base_dir, collection_path), 'r') as f:
-            text = f.read()
-        data = loads(text)
-        return data
-    return None
+    collection_id = os.path.basename(collection_path)
+    return read_many(base_dir, [collection_id]).get(collection_id, None)
 
 COLLECTION_SYNC_STATUS_CACHE_KEY = 'webui:collection:%s:sync-status'
 
@@ -208,22 +480,50 @@ def sync_status( collection_path, git_status, timestamp, cache_set=False, force=
         cache.set(key, data, COLLECTION_STATUS_TIMEOUT)
     return data
 
-def update( base_dir, collection_id ):
+def _without_timestamp( syncstatus ):
+    """Copy of a sync_status dict minus its timestamp, for comparisons.
+    """
+    return dict([(key,value) for key,value in (syncstatus or {}).items() if key != 'timestamp'])
+
+def update( base_dir, collection_id, force=False ):
     """Gets a bunch of status info for the collection; refreshes if forced
     
     timestamp, elapsed, status, annex_status, syncstatus
     
+    If the repository fingerprint has not changed since the last update
+    git is not run; the previous status is rewritten with a new timestamp
+    (and a new sync status, which can change if the collection was locked
+    or unlocked).
+    
     @param force: Boolean Forces refresh of status
-    @returns: dict
+    @returns: dict (plus 'unchanged': True if git was not run)
     """
     start = datetime.now()
     collection_path = os.path.join(base_dir, collection_id)
+    # taken before git runs so that changes made meanwhile are seen next time
+    digest = fingerprint(collection_path)
+    if (not force) and digest and (digest == read_fingerprint(base_dir, collection_path)):
+        previous = read(base_dir, collection_path)
+        if previous:
+            status = previous['status']
+            annex_status = previous['annex_status']
+            timestamp = datetime.now()
+            syncstatus = sync_status(collection_path, git_status=status, timestamp=timestamp, force=True)
+            # sync status also depends on the collection lock
+            changed = _without_timestamp(syncstatus) != _without_timestamp(previous['sync_status'])
+            text = write(base_dir, collection_path, timestamp, previous['elapsed'],
+                         status, annex_status, syncstatus, changed=changed)
+            data = loads(text)
+            data['unchanged'] = True
+            return data
     status = dvcs.repo_status(collection_path, short=True)
     annex_status = dvcs.annex_status(collection_path)
     timestamp = datetime.now()
     syncstatus = sync_status(collection_path, git_status=status, timestamp=timestamp, force=True)
     elapsed = timestamp - start
     text = write(base_dir, collection_path, timestamp, elapsed, status, annex_status, syncstatus)
+    if digest:
+        write_fingerprint(base_dir, collection_path, digest)
     return loads(text)
 
 
@@ -319,6 +619,18 @@ def unlock( base_dir, task_id ):
             os.remove(LOCK)
     return lockfile_text
 
+def collection_locked( collection_path ):
+    """Checks a collection's per-collection lock without loading the collection.
+    
+    The lock is a file in the collection repo; Collection(path) knows where
+    it is without reading collection.json, so this costs a stat (plus a
+    read of the lockfile if there is one).
+    
+    @param collection_path: Absolute path to collection repo.
+    @returns: task_id of the locking task or False
+    """
+    return Collection(path=collection_path).locked()
+
 def locked_global( base_dir ):
     """Indicates whether gitstatus global lock is in effect.
     
@@ -422,6 +734,344 @@ def queue_generate( base_dir, repos_orgs ):
     queue['generated'] = datetime.now()
     return queue
 
+def _connect( path ):
+    """Opens the gitstatus database, creating tables as needed.
+    
+    Connections are in autocommit mode; transactions are explicit.
+    """
+    conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+    conn.execute("""CREATE TABLE IF NOT EXISTS queue (
+        collection_id TEXT PRIMARY KEY, next_run TEXT NOT NULL)""")
+    conn.execute('CREATE INDEX IF NOT EXISTS queue_next_run ON queue (next_run)')
+    conn.execute("""CREATE TABLE IF NOT EXISTS status (
+        collection_id TEXT PRIMARY KEY, text TEXT NOT NULL)""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS stats (
+        collection_id TEXT PRIMARY KEY,
+        runs INTEGER NOT NULL DEFAULT 0,
+        git_runs INTEGER NOT NULL DEFAULT 0,
+        elapsed REAL,
+        change_rate REAL,
+        state TEXT,
+        last_run TEXT)""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS meta (
+        key TEXT PRIMARY KEY, value TEXT)""")
+    return conn
+
+def _ts_dumps( timestamp ):
+    return timestamp.strftime(settings.TIMESTAMP_FORMAT)
+
+def _ts_loads( text ):
+    return datetime.strptime(text, settings.TIMESTAMP_FORMAT)
+
+class Queue( object ):
+    """Persistent priority queue of collection_ids by next update time.
+    
+    Rows live in a sqlite table with an index on next_run; TIMESTAMP_FORMAT
+    strings sort in time order.  Each thread gets its own connection.
+    Rescheduling runs in an IMMEDIATE transaction so that concurrent
+    workers (see update_many) and processes get distinct times.
+    
+    >>> queue = queue_db(base_dir)
+    >>> queue.load(queue_generate(base_dir, repos_orgs))
+    >>> [cid for timestamp,cid in queue.ready()][:2]
+    ['ddr-test-123', 'ddr-test-124']
+    >>> queue.reschedule('ddr-test-123', delta=60, minimum=3600)
+    """
+    path = None
+    
+    def __init__( self, path ):
+        self.path = path
+        self._local = threading.local()
+    
+    def _connection( self ):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = _connect(self.path)
+            self._local.conn = conn
+        return conn
+    
+    def __len__( self ):
+        return self._connection().execute('SELECT COUNT(*) FROM queue').fetchone()[0]
+    
+    def generated( self ):
+        row = self._connection().execute(
+            "SELECT value FROM meta WHERE key='generated'").fetchone()
+        if row:
+            return _ts_loads(row[0])
+        return None
+    
+    def load( self, queue ):
+        """Replaces the contents of the queue.
+        
+        @param queue: dict as from queue_generate() or queue_loads()
+        """
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute('DELETE FROM queue')
+            conn.executemany(
+                'INSERT OR REPLACE INTO queue (collection_id, next_run) VALUES (?, ?)',
+                [(cid, _ts_dumps(ts)) for ts,cid in queue['collections']])
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('generated', ?)",
+                         (_ts_dumps(queue.get('generated', None) or datetime.now()),))
+            conn.execute('COMMIT')
+        except:
+            conn.execute('ROLLBACK')
+            raise
+    
+    def export( self ):
+        """Queue as a dict understood by queue_dumps.
+        """
+        rows = self._connection().execute(
+            'SELECT next_run, collection_id FROM queue ORDER BY next_run, collection_id').fetchall()
+        return {
+            'generated': self.generated() or datetime.now(),
+            'collections': [[_ts_loads(ts), cid] for ts,cid in rows],
+        }
+    
+    def ready( self, now=None ):
+        """Yields (timestamp, collection_id) due before now, most overdue first.
+        
+        Rows are fetched as they are consumed.
+        """
+        if now is None:
+            now = datetime.now()
+        cursor = self._connection().execute(
+            'SELECT next_run, collection_id FROM queue WHERE next_run < ? ORDER BY next_run, collection_id',
+            (_ts_dumps(now),))
+        for ts,cid in cursor:
+            yield _ts_loads(ts),cid
+    
+    def next_available( self ):
+        row = self._connection().execute('SELECT MIN(next_run) FROM queue').fetchone()
+        if row and row[0]:
+            return _ts_loads(row[0])
+        return None
+    
+    def reschedule( self, collection_id, delta, minimum ):
+        """Sets the collection's next update time; same rules as next_time().
+        
+        @param collection_id
+        @param delta: int (seconds) Delta added to highest available timestamp
+        @param minimum: int (seconds) Minimum delta
+        @returns: datetime
+        """
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            latest = conn.execute('SELECT MAX(next_run) FROM queue').fetchone()[0]
+            earliest = datetime.now() + timedelta(seconds=minimum)
+            timestamp = earliest
+            if latest:
+                timestamp = max(_ts_loads(latest) + timedelta(seconds=delta), earliest)
+            conn.execute(
+                'INSERT OR REPLACE INTO queue (collection_id, next_run) VALUES (?, ?)',
+                (collection_id, _ts_dumps(timestamp)))
+            conn.execute('COMMIT')
+        except:
+            conn.execute('ROLLBACK')
+            raise
+        return timestamp
+    
+    def schedule( self, collection_id, timestamp ):
+        """Sets the collection's next update time.
+        """
+        self._connection().execute(
+            'INSERT OR REPLACE INTO queue (collection_id, next_run) VALUES (?, ?)',
+            (collection_id, _ts_dumps(timestamp)))
+    
+    def record( self, collection_id, elapsed, changed, state ):
+        """Adds an update to the collection's stats.
+        
+        elapsed and change_rate are exponentially weighted moving averages
+        (see STATS_ALPHA) of git run time and of whether the repository
+        fingerprint changed.
+        
+        @param collection_id
+        @param elapsed: float (seconds) or None if git was not run
+        @param changed: Boolean Repository fingerprint changed
+        @param state: str Sync status (e.g. 'synced', 'ahead', 'behind')
+        @returns: dict (see STATS_FIELDS)
+        """
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute(
+                'SELECT %s FROM stats WHERE collection_id=?' % ', '.join(STATS_FIELDS),
+                (collection_id,)).fetchone()
+            if row:
+                stats = dict(zip(STATS_FIELDS, row))
+            else:
+                stats = dict([(field, None) for field in STATS_FIELDS])
+                stats.update({'collection_id': collection_id, 'runs': 0, 'git_runs': 0})
+            stats['runs'] += 1
+            if elapsed is not None:
+                stats['git_runs'] += 1
+                stats['elapsed'] = _ewma(stats['elapsed'], elapsed)
+            stats['change_rate'] = _ewma(stats['change_rate'], float(bool(changed)))
+            stats['state'] = state
+            stats['last_run'] = _ts_dumps(datetime.now())
+            conn.execute(
+                'INSERT OR REPLACE INTO stats (%s) VALUES (%s)' % (
+                    ', '.join(STATS_FIELDS), ', '.join(['?'] * len(STATS_FIELDS))),
+                [stats[field] for field in STATS_FIELDS])
+            conn.execute('COMMIT')
+        except:
+            conn.execute('ROLLBACK')
+            raise
+        return stats
+    
+    def stats( self ):
+        """Queued collections with their stats, in next_run order.
+        
+        @returns: list of dicts (see STATS_FIELDS, plus next_run)
+        """
+        fields = ['next_run'] + STATS_FIELDS[1:]
+        rows = self._connection().execute(
+            """SELECT queue.collection_id, %s FROM queue
+            LEFT JOIN stats ON stats.collection_id = queue.collection_id
+            ORDER BY next_run, queue.collection_id""" % ', '.join(fields)).fetchall()
+        collections = []
+        for row in rows:
+            stats = dict(zip(['collection_id'] + fields, row))
+            stats['next_run'] = _ts_loads(stats['next_run'])
+            if stats['last_run']:
+                stats['last_run'] = _ts_loads(stats['last_run'])
+            collections.append(stats)
+        return collections
+
+_QUEUES = {}
+_QUEUES_LOCK = threading.Lock()
+
+def queue_db( base_dir ):
+    """Queue for the Store; imports the text queue file if the database is new.
+    """
+    path = db_path(base_dir)
+    with _QUEUES_LOCK:
+        queue = _QUEUES.get(path, None)
+        if (queue is None) or (not os.path.exists(path)):
+            queue = Queue(path)
+            if (not len(queue)) and os.path.exists(queue_path(base_dir)):
+                queue.load(queue_read(base_dir))
+                log('imported text queue %s' % queue_path(base_dir))
+            _QUEUES[path] = queue
+    return queue
+
+def queue_exists( base_dir ):
+    """Indicates whether the Store has a non-empty queue.
+    """
+    return len(queue_db(base_dir)) > 0
+
+def queue_export( base_dir ):
+    """Writes the queue to the text queue file (for debugging).
+    """
+    queue_write(base_dir, queue_db(base_dir).export())
+    return queue_path(base_dir)
+
+# Adaptive scheduling
+#
+# Collections are rescheduled after GITSTATUS_INTERVAL (minimum) times
+# a factor for how rarely the repository changes (up to IDLE_FACTOR) and
+# for how long git-status takes (sqrt of elapsed/COST_TARGET, at least 1),
+# up to GITSTATUS_MAX_INTERVAL (maximum).  Ahead/behind/conflicted
+# collections, and those without enough history, get the minimum.
+
+STATS_FIELDS = ['collection_id', 'runs', 'git_runs', 'elapsed', 'change_rate', 'state', 'last_run']
+# weight of the latest update in the moving averages
+STATS_ALPHA = 0.3
+IDLE_FACTOR = 8
+COST_TARGET = 10.0
+ATTENTION_STATES = ['ahead', 'behind', 'conflicted']
+
+def _ewma( average, value, alpha=STATS_ALPHA ):
+    if average is None:
+        return value
+    return alpha * value + (1 - alpha) * average
+
+def elapsed_seconds( elapsed ):
+    """Converts elapsed (timedelta, or str as in .status files) to seconds.
+    
+    >>> elapsed_seconds('0:00:01.234567')
+    1.234567
+    >>> elapsed_seconds('1 day, 0:00:01')
+    86401.0
+    """
+    if isinstance(elapsed, timedelta):
+        return elapsed.days * 86400 + elapsed.seconds + elapsed.microseconds / 1000000.0
+    days = 0
+    if 'day' in elapsed:
+        d,elapsed = elapsed.split(',')
+        days = int(d.split()[0])
+    h,m,sec = elapsed.strip().split(':')
+    return days * 86400 + int(h) * 3600 + int(m) * 60 + float(sec)
+
+def adaptive_interval( stats, minimum, maximum ):
+    """Seconds until the collection should next be updated.
+    
+    @param stats: dict from Queue.record() or Queue.stats()
+    @param minimum: int (seconds) Interval for busy or out-of-sync repos
+    @param maximum: int (seconds) Interval for idle repos that are slow to check
+    @returns: int
+    """
+    if (not stats) or (not stats.get('runs')) or (stats['runs'] < 2) \
+            or (stats.get('state', None) in ATTENTION_STATES):
+        return minimum
+    change_rate = stats.get('change_rate', None)
+    if change_rate is None:
+        change_rate = 1.0
+    change_factor = 1 + (1 - change_rate) * (IDLE_FACTOR - 1)
+    cost_factor = max(1.0, ((stats.get('elapsed', None) or 0) / COST_TARGET) ** 0.5)
+    return int(min(maximum, max(minimum, minimum * change_factor * cost_factor)))
+
+def schedule_next( queue, collection_id, data, delta, minimum, maximum=None ):
+    """Records an update and sets the collection's next update time.
+    
+    Without maximum the collection goes to the back of the queue as
+    before (see Queue.reschedule).  Otherwise the next time is now plus
+    adaptive_interval(), plus up to delta seconds so that collections do
+    not bunch up.  If the update failed (no data) the next time is now
+    plus minimum (plus jitter): the back of the queue may be as far
+    away as maximum.
+    
+    @param queue: Queue
+    @param collection_id
+    @param data: dict from update() or None
+    @param delta: int (seconds)
+    @param minimum: int (seconds)
+    @param maximum: int (seconds)
+    @returns: datetime
+    """
+    if not data:
+        timestamp = datetime.now() + timedelta(seconds=minimum + random.uniform(0, delta))
+        queue.schedule(collection_id, timestamp)
+        return timestamp
+    if not maximum:
+        return queue.reschedule(collection_id, delta, minimum)
+    unchanged = data.get('unchanged', False)
+    elapsed = None
+    if not unchanged:
+        elapsed = elapsed_seconds(data['elapsed'])
+    state = (data.get('sync_status', None) or {}).get('status', None)
+    stats = queue.record(collection_id, elapsed, not unchanged, state)
+    interval = adaptive_interval(stats, minimum, maximum)
+    timestamp = datetime.now() + timedelta(seconds=interval + random.uniform(0, delta))
+    queue.schedule(collection_id, timestamp)
+    return timestamp
+
+def _ready( queue, now ):
+    """(timestamp, collection_id) of ready collections from a Queue or queue dict.
+    """
+    if isinstance(queue, Queue):
+        return queue.ready(now)
+    return ((ts,cid) for ts,cid in sorted(queue['collections']) if now > ts)
+
+def _next_available( queue ):
+    if isinstance(queue, Queue):
+        return queue.next_available()
+    if queue['collections']:
+        return min([ts for ts,cid in queue['collections']])
+    return None
+
 def queue_mark_updated( queue, collection_id, delta, minimum ):
     """Resets or adds collection timestamp and returns queue
     
@@ -466,38 +1116,93 @@ def next_time( queue, delta, minimum ):
 def next_repo( queue, local=False ):
     """Gets next collection_path or time til next ready to be updated
         
-    @param queue: 
+    @param queue: Queue (or queue dict)
     @param local: Boolean Use local per-collection locks or global lock.
     @returns: collection_path or (msg,timedelta)
     """
-    collection_path = None
-    message = None
-    next_available = None
-    # sorts collections in ascending order by timestamp
-    collections = sorted(queue['collections'])
-    # now choose
-    if local:
-        # choose first collection that is not locked
-        for timestamp,cid in collections:
-            if datetime.now() > timestamp:
-                cpath = os.path.join(settings.MEDIA_BASE, cid)
-                collection = Collection.from_json(cpath)
-                if not collection.locked():
-                    collection_path = cpath
-                    return collection_path
-            if (not next_available) or (timestamp < next_available):
-                next_available = timestamp
-    else:
-        # global lock - just take the first collection
-        for timestamp,cid in collections:
-            if datetime.now() > timestamp:
-                collection_path = os.path.join(settings.MEDIA_BASE, cid)
-                return collection_path
-            if (not next_available) or (timestamp < next_available):
-                next_available = timestamp
-    return ('notready',next_available)
+    collection_paths = next_repos(queue, limit=1, local=local)
+    if collection_paths:
+        return collection_paths[0]
+    return ('notready',_next_available(queue))
 
-def update_store( base_dir, delta, minimum, local=False ):
+def next_repos( queue, limit=None, local=False ):
+    """Gets the collection_paths that are ready to be updated, most overdue first.
+    
+    @param queue: Queue (or queue dict)
+    @param limit: int Maximum number of paths (default: all that are ready).
+    @param local: Boolean Skip collections with per-collection locks.
+    @returns: list of collection_paths (may be empty)
+    """
+    collection_paths = []
+    for timestamp,cid in _ready(queue, datetime.now()):
+        if limit and (len(collection_paths) >= limit):
+            break
+        cpath = os.path.join(settings.MEDIA_BASE, cid)
+        if local and collection_locked(cpath):
+            continue
+        collection_paths.append(cpath)
+    return collection_paths
+
+def update_many( base_dir, queue, collection_paths, delta, minimum, concurrency, time_budget=None, local=False, maximum=None ):
+    """Updates collections in a pool of threads, writing each result to the queue as it completes.
+    
+    No new update is started once time_budget has run out or (if not
+    local) once another process has set the global lock; those collections
+    are left in the queue for the next run.
+    
+    @param base_dir: 
+    @param queue: Queue
+    @param collection_paths: list of collection_paths, i.e. from next_repos()
+    @param delta: int (seconds) Delta added to highest available timestamp
+    @param minimum: int (seconds) Minimum delta
+    @param concurrency: int Number of worker threads.
+    @param time_budget: int (seconds) Don't start updates after this.
+    @param local: boolean Use per-collection locks
+    @param maximum: int (seconds) Maximum interval; enables adaptive scheduling (see schedule_next).
+    @returns: list of messages
+    """
+    deadline = None
+    if time_budget:
+        deadline = time.time() + time_budget
+    queue_lock = threading.Lock()
+    
+    def work( collection_path ):
+        if deadline and (time.time() > deadline):
+            return '%s skipped (time budget)' % collection_path
+        if local:
+            if collection_locked(collection_path):
+                return '%s skipped (locked)' % collection_path
+        elif locked_global(base_dir):
+            return '%s skipped (locked)' % collection_path
+        data = None
+        try:
+            data = update(base_dir, collection_path)
+            if data.get('unchanged', False):
+                message = '%s unchanged' % collection_path
+            else:
+                message = '%s updated' % collection_path
+        except Exception as err:
+            # reschedule anyway so a broken repo doesn't hog the queue
+            message = '%s failed: %s' % (collection_path, err)
+            log(message)
+        with queue_lock:
+            schedule_next(queue, os.path.basename(collection_path), data, delta, minimum, maximum)
+        return message
+    
+    messages = []
+    pool = ThreadPool(concurrency)
+    try:
+        for message in pool.imap_unordered(work, collection_paths):
+            messages.append(message)
+    finally:
+        pool.close()
+        pool.join()
+    counts = dict([(outcome, len([m for m in messages if m.endswith(outcome)]))
+                   for outcome in ['updated', 'unchanged']])
+    log('fingerprint: %s unchanged (git skipped), %s updated' % (counts['unchanged'], counts['updated']))
+    return messages
+
+def update_store( base_dir, delta, minimum, local=False, concurrency=1, time_budget=None, maximum=None, batch=None ):
     """
     
     - Ensures only one gitstatus_update task running at a time
@@ -514,6 +1219,11 @@ def update_store( base_dir, delta, minimum, local=False ):
     @param delta: int (seconds) Delta added to highest available timestamp
     @param minimum: int (seconds) Minimum delta
     @param local: boolean Use per-collection locks
+    @param concurrency: int Update this many collections at a time (see update_many).
+    @param time_budget: int (seconds) Used if concurrency > 1.
+    @param maximum: int (seconds) Maximum interval; enables adaptive scheduling (see schedule_next).
+    @param batch: int Take at most this many collections from the queue
+                  (default: concurrency * 4).  Used if concurrency > 1.
     @returns: success/fail message
     """
     if not os.path.exists(base_dir):
@@ -538,20 +1248,35 @@ def update_store( base_dir, delta, minimum, local=False ):
             if locked:
                 messages.append('locked: %s' % locked)
             
-            if writable and not locked:
+            if writable and not locked and (concurrency > 1):
+                queue = queue_db(base_dir)
+                collection_paths = next_repos(queue, limit=(batch or concurrency * 4), local=local)
+                if collection_paths:
+                    messages.extend(update_many(
+                        base_dir, queue, collection_paths, delta, minimum,
+                        concurrency, time_budget, local=local, maximum=maximum))
+                    log('%s' % '; '.join(messages))
+                else:
+                    messages.append('next_repo %s' % str(next_repo(queue, local=local)))
+            
+            elif writable and not locked:
                 collection_path = None
-                queue = queue_read(base_dir)
+                queue = queue_db(base_dir)
                 response = next_repo(queue, local=local)
                 if isinstance(response, list) or isinstance(response, tuple):
                     messages.append('next_repo %s' % str(response))
                 elif isinstance(response, basestring) and os.path.exists(response):
                     collection_path = response
                 if collection_path:
-                    timestamp,elapsed,status,annex_status,syncstatus = update(base_dir, collection_path)
+                    data = update(base_dir, collection_path)
                     collection_id = os.path.basename(collection_path)
-                    queue = queue_mark_updated(queue, collection_id, delta, minimum)
-                    queue_write(base_dir, queue)
-                    messages.append('%s updated' % (collection_path))
+                    schedule_next(queue, collection_id, data, delta, minimum, maximum)
+                    if data.get('unchanged', False):
+                        messages.append('%s unchanged' % (collection_path))
+                        log('fingerprint: %s unchanged (git skipped)' % collection_id)
+                    else:
+                        messages.append('%s updated' % (collection_path))
+                        log('fingerprint: %s changed' % collection_id)
             
         finally:
             release_lock()
@@ -4,7 +4,6 @@ import logging
 logger = logging.getLogger(__name__)
 import os
 
-import envoy
 import requests
 
 from django.conf import settings
@@ -18,10 +17,13 @@ from DDR import dvcs
 from DDR import models
 
 from ddrlocal.models import DDRLocalCollection, DDRLocalEntity, DDRLocalFile
+from ddrlocal.models import cache as objcache
 from ddrlocal.models import COLLECTION_FILES_PREFIX, ENTITY_FILES_PREFIX
+from ddrlocal.models import FileList, LazyFile
 from ddrlocal.models import collection as collectionmodule
 from ddrlocal.models import entity as entitymodule
 from ddrlocal.models import files as filemodule
+from ddrlocal.models import inheritance
 
 from webui import gitstatus
 
@@ -36,20 +38,6 @@ from webui import COLLECTION_ANNEX_STATUS_TIMEOUT
 
 # functions relating to inheritance ------------------------------------
 
-def _child_jsons( path ):
-    """List all the .json files under path directory; excludes specified dir.
-    
-    @param path: Absolute directory path.
-    @return list of paths
-    """
-    paths = []
-    r = envoy.run('find %s -name "*.json" ! -name ".git" -print' % path)
-    if not r.status_code:
-        for p in r.std_out.strip().split('\n'):
-            if os.path.dirname(p) != path:
-                paths.append(p)
-    return paths
-
 def _selected_inheritables( inheritables, cleaned_data ):
     """Indicates which inheritable fields from the list were selected in the form.
     
@@ -81,55 +69,18 @@ def _selected_field_values( parent_object, inheritables ):
         field_values.append( (field,value) )
     return field_values
 
-def _load_object( json_path ):
-    """Loads File, Entity, or Collection from JSON file
-    
-    @param json_path
-    """
-    dirname = os.path.dirname(json_path)
-    basename = os.path.basename(json_path)
-    if ('master' in basename) or ('mezzanine' in basename):  # file
-        entity = Entity.from_json(os.path.dirname(dirname))
-        fname = os.path.splitext(basename)[0]
-        repo,org,cid,eid,role,sha1 = fname.split('-')
-        return entity.file(repo, org, cid, eid, role, sha1)
-    elif basename == 'entity.json':
-        return Entity.from_json(dirname)
-    elif basename == 'collection.json':
-        return Collection.from_json(dirname)
-    return None
-    
 def _update_inheritables( parent_object, objecttype, inheritables, cleaned_data ):
     """Update specified inheritable fields of child objects using form data.
     
+    Child JSON files are patched in place; see ddrlocal.models.inheritance.
+    
     @param parent_object: A Collection, Entity, or File
     @param cleaned_data: Form cleaned_data from POST.
     @returns: tuple containing list of changed object Ids and list of changed objects' JSON files.
     """
-    child_ids = []
-    changed_files = []
     # values of selected inheritable fields from parent
     field_values = _selected_field_values(parent_object, inheritables)
-    # load child objects and apply the change
-    if field_values:
-        for child_json in _child_jsons(parent_object.path):
-            child = _load_object(child_json)
-            if child:
-                # set field if exists in child and doesn't already match parent value
-                changed = False
-                for field,value in field_values:
-                    if hasattr(child, field):
-                        existing_value = getattr(child,field)
-                        if existing_value != value:
-                            setattr(child, field, value)
-                            changed = True
-                # write json and add to list of changed IDs/files
-                if changed:
-                    child.dump_json()
-                    if hasattr(child, 'id'):         child_ids.append(child.id)
-                    elif hasattr(child, 'basename'): child_ids.append(child.basename)
-                    changed_files.append(child_json)
-    return child_ids,changed_files
+    return inheritance.propagate(parent_object.path, field_values)
 
 
 
@@ -183,12 +134,17 @@ class Collection( DDRLocalCollection ):
     def from_json(collection_abs):
         """Instantiates a Collection object, loads data from collection.json.
         """
+        signature = objcache.collection_signature(collection_abs)
+        collection = objcache.objects.get(Collection, collection_abs, signature)
+        if collection:
+            return collection
         collection = Collection(collection_abs)
         collection_uid = collection.id  # save this just in case
         collection.load_json(collection.json_path)
         if not collection.id:
             # id gets overwritten if collection.json is blank
             collection.id = collection_uid
+        objcache.objects.put(Collection, collection_abs, signature, collection)
         return collection
     
     def repo_fetch( self ):
@@ -321,11 +277,16 @@ class Entity( DDRLocalEntity ):
     def from_json(entity_abs):
         entity = None
         if os.path.exists(entity_abs):
+            signature = objcache.entity_signature(entity_abs)
+            entity = objcache.objects.get(Entity, entity_abs, signature)
+            if entity:
+                return entity
             entity = Entity(entity_abs)
             entity_uid = entity.id
             entity.load_json(entity.json_path)
             if not entity.id:
                 entity.id = entity_uid  # might get overwritten if entity.json is blank
+            objcache.objects.put(Entity, entity_abs, signature, entity)
         return entity
     
     def selected_inheritables(self, cleaned_data ):
@@ -343,10 +304,11 @@ class Entity( DDRLocalEntity ):
         """
         # keep copy of the list for detect_file_duplicates()
         self._files = [f for f in self.files]
-        self.files = []
+        self.files = FileList()
         for f in self._files:
             path_abs = os.path.join(self.files_path, f['path_rel'])
-            self.files.append(DDRFile(path_abs=path_abs))
+            self.files.append(LazyFile(DDRFile, path_abs, f))
+        self._index_files()
     
     @staticmethod
     def create(collection, entity_id, git_name, git_mail, agent=settings.AGENT):
@@ -388,6 +350,7 @@ class Entity( DDRLocalEntity ):
         
         Write changes to disk; propagate inheritable values to child objects.
         These steps are relatively quick, can be done during request-response.
+        Files that did not change are not written and not returned.
         
         @param form: Django form object
         @returns: list of paths
@@ -395,9 +358,11 @@ class Entity( DDRLocalEntity ):
         # run module_functions on raw form data
         self.form_post(form)
         # write
-        self.dump_json()
-        self.dump_mets()
-        updated_files = [self.json_path, self.mets_path,]
+        updated_files = []
+        if self.dump_json():
+            updated_files.append(self.json_path)
+        if self.dump_mets():
+            updated_files.append(self.mets_path)
         inheritables = self.selected_inheritables(form.cleaned_data)
         modified_ids,modified_files = self.update_inheritables(inheritables, form.cleaned_data)
         if modified_files:
@@ -448,7 +413,7 @@ class DDRFile( DDRLocalFile ):
     def file_path(request, repo, org, cid, eid, role, sha1):
         return os.path.join(settings.MEDIA_BASE, '{}-{}-{}-{}-{}-{}'.format(repo, org, cid, eid, role, sha1))
     
-    def save( self, git_name, git_mail ):
+    def save( self, git_name, git_mail, updated_files=None ):
         """Perform file-save functions.
         
         Commit files, delete cache, update search index.
@@ -458,15 +423,21 @@ class DDRFile( DDRLocalFile ):
         @param file_id: str
         @param git_name: str
         @param git_mail: str
+        @param updated_files: list of paths written by dump_json (see
+                              DDRLocalFile.updated_files); default is the
+                              file JSON and entity.json.
         """
         collection = Collection.from_json(self.collection_path)
         entity_id = models.make_object_id(
             'entity', self.repo, self.org, self.cid, self.eid)
+        if not updated_files:
+            updated_files = [self.json_path,
+                             os.path.join(self.entity_path, 'entity.json')]
         
         exit,status = commands.entity_update(
             git_name, git_mail,
             collection.path, entity_id,
-            [self.json_path],
+            updated_files,
             agent=settings.AGENT)
         collection.cache_delete()
         with open(self.json_path, 'r') as f:
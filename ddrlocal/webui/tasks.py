@@ -8,6 +8,7 @@ from celery.utils.log import get_task_logger
 logger = get_task_logger(__name__)
 
 from celery import states
+from celery.signals import worker_process_init
 from celery.result import AsyncResult
 from celery.utils.encoding import safe_repr
 from celery.utils import get_full_cls_name
@@ -18,6 +19,10 @@ from django.contrib import messages
 from django.core.cache import cache
 from django.core.urlresolvers import reverse
 
+from ddrlocal.models import cache as objcache
+from ddrlocal.models import catalog
+from ddrlocal.models import git_version_clear
+from ddrlocal.models import manifest
 from migration.densho import export_entities, export_files, export_csv_path
 from webui import GITOLITE_INFO_CACHE_KEY
 from webui import gitolite
@@ -30,6 +35,14 @@ from DDR.commands import sync
 
 
 
+@worker_process_init.connect
+def worker_process_init_git_version( **kwargs ):
+    """Fresh git/git-annex version banner for each worker process.
+    """
+    git_version_clear()
+
+
+
 TASK_STATUSES = ['STARTED', 'PENDING', 'SUCCESS', 'FAILURE', 'RETRY', 'REVOKED',]
 TASK_STATUSES_DISMISSABLE = ['STARTED', 'SUCCESS', 'FAILURE', 'RETRY', 'REVOKED',]
 
@@ -40,6 +53,7 @@ TASK_STATUS_MESSAGES = {
     'webui-file-new-master': {
         #'STARTED': '',
         'PENDING': 'Uploading <b>{filename}</b> to <a href="{entity_url}">{entity_id}</a>.',
+        'PROGRESS': 'Uploading <b>{filename}</b> to <a href="{entity_url}">{entity_id}</a> ({percent}%).',
         'SUCCESS': 'Uploaded <a href="{file_url}">{filename}</a> to <a href="{entity_url}">{entity_id}</a>.',
         'FAILURE': 'Could not upload <b>{filename}</b> to <a href="{entity_url}">{entity_id}</a>.<br/>{result}',
         #'RETRY': '',
@@ -48,6 +62,7 @@ TASK_STATUS_MESSAGES = {
     'webui-file-new-mezzanine': {
         #'STARTED': '',
         'PENDING': 'Uploading <b>{filename}</b> to <a href="{entity_url}">{entity_id}</a>.',
+        'PROGRESS': 'Uploading <b>{filename}</b> to <a href="{entity_url}">{entity_id}</a> ({percent}%).',
         'SUCCESS': 'Uploaded <a href="{file_url}">{filename}</a> to <a href="{entity_url}">{entity_id}</a>.',
         'FAILURE': 'Could not upload <b>{filename}</b> to <a href="{entity_url}">{entity_id}</a>.<br/>{result}',
         #'RETRY': '',
@@ -162,6 +177,19 @@ def gitolite_info_refresh():
 
 
 
+@task(base=DebugTask, name='webui.tasks.catalog_scan')
+def catalog_scan():
+    """
+    Bring the local catalog/search index up to date with JSON files
+    changed outside of ddr-local (e.g. git pull).
+    Skipped if the last scan was less than CATALOG_SCAN_INTERVAL ago.
+    """
+    if not os.path.exists(settings.MEDIA_BASE):
+        return 'no Store mounted'
+    return catalog.store_catalog().scan_if_due(settings.MEDIA_BASE, settings.CATALOG_SCAN_INTERVAL)
+
+
+
 class GitStatusTask(Task):
     abstract = True
         
@@ -176,31 +204,35 @@ class GitStatusTask(Task):
         gitstatus.log('GitStatusTask.after_return(%s, %s, %s, %s, %s, %s)' % (status, retval, task_id, args, kwargs, einfo))
 
 @task(base=GitStatusTask, name='webui.tasks.gitstatus_update')
-def gitstatus_update( collection_path ):
+def gitstatus_update( collection_path, force=False ):
     if not os.path.exists(settings.MEDIA_BASE):
         raise Exception('base_dir does not exist. No Store mounted?: %s' % settings.MEDIA_BASE)
-    if not os.path.exists(gitstatus.queue_path(settings.MEDIA_BASE)):
+    if not gitstatus.queue_exists(settings.MEDIA_BASE):
         queue = gitstatus.queue_generate(
             settings.MEDIA_BASE,
             gitolite.get_repos_orgs()
         )
-        gitstatus.queue_write(settings.MEDIA_BASE, queue)
-    return gitstatus.update(settings.MEDIA_BASE, collection_path)
+        gitstatus.queue_db(settings.MEDIA_BASE).load(queue)
+    return gitstatus.update(settings.MEDIA_BASE, collection_path, force=force)
 
 @task(base=GitStatusTask, name='webui.tasks.gitstatus_update_store')
 def gitstatus_update_store():
     if not os.path.exists(settings.MEDIA_BASE):
         raise Exception('base_dir does not exist. No Store mounted?: %s' % settings.MEDIA_BASE)
-    if not os.path.exists(gitstatus.queue_path(settings.MEDIA_BASE)):
+    if not gitstatus.queue_exists(settings.MEDIA_BASE):
         queue = gitstatus.queue_generate(
             settings.MEDIA_BASE,
             gitolite.get_repos_orgs()
         )
-        gitstatus.queue_write(settings.MEDIA_BASE, queue)
+        gitstatus.queue_db(settings.MEDIA_BASE).load(queue)
     return gitstatus.update_store(
         base_dir=settings.MEDIA_BASE,
         delta=60,
         minimum=settings.GITSTATUS_INTERVAL,
+        concurrency=settings.GITSTATUS_CONCURRENCY,
+        time_budget=settings.GITSTATUS_TIME_BUDGET,
+        batch=settings.GITSTATUS_BATCH,
+        maximum=settings.GITSTATUS_MAX_INTERVAL,
     )
 
 
@@ -234,6 +266,27 @@ class FileAddDebugTask(Task):
         gitstatus.update(settings.MEDIA_BASE, collection_path)
         gitstatus.unlock(settings.MEDIA_BASE, 'entity_add_file')
 
+def progress_reporter( task ):
+    """Returns function that reports bytes copied as task state PROGRESS.
+    
+    State is only updated when the percentage changes, not on every block.
+    See session_tasks.
+    
+    @param task: Celery task (i.e. entity_add_file)
+    """
+    last = {'percent': None}
+    def progress(done, total):
+        percent = 100
+        if total:
+            percent = int(done * 100 / total)
+        if percent != last['percent']:
+            last['percent'] = percent
+            task.update_state(state='PROGRESS',
+                              meta={'bytes_done': done,
+                                    'bytes_total': total,
+                                    'percent': percent,})
+    return progress
+
 @task(base=FileAddDebugTask, name='entity-add-file')
 def entity_add_file( git_name, git_mail, entity, src_path, role, data, agent='' ):
     """
@@ -246,7 +299,8 @@ def entity_add_file( git_name, git_mail, entity, src_path, role, data, agent=''
     @param agent: (optional) Name of software making the change.
     """
     gitstatus.lock(settings.MEDIA_BASE, 'entity_add_file')
-    return entity.add_file(git_name, git_mail, src_path, role, data, agent)
+    return entity.add_file(git_name, git_mail, src_path, role, data, agent,
+                           progress=progress_reporter(entity_add_file))
 
 @task(base=FileAddDebugTask, name='entity-add-access')
 def entity_add_access( git_name, git_mail, entity, ddrfile, agent='' ):
@@ -465,7 +519,7 @@ def entity_file_edit(request, collection, file_, git_name, git_mail):
     file_id = models.make_object_id(
         'file', file_.repo, file_.org, file_.cid, file_.eid, file_.role, file_.sha1)
     result = file_edit.apply_async(
-        (collection.path, file_id, git_name, git_mail),
+        (collection.path, file_id, git_name, git_mail, getattr(file_, 'updated_files', None)),
         countdown=2)
     # lock collection
     lockstatus = collection.lock(result.task_id)
@@ -492,13 +546,14 @@ class FileEditTask(Task):
         gitstatus.unlock(settings.MEDIA_BASE, 'file_edit')
 
 @task(base=FileEditTask, name='webui-file-edit')
-def file_edit(collection_path, file_id, git_name, git_mail):
+def file_edit(collection_path, file_id, git_name, git_mail, updated_files=None):
     """The time-consuming parts of file-edit.
     
     @param collection_path: str Absolute path to collection
     @param file_id: str
     @param git_name: Username of git committer.
     @param git_mail: Email of git committer.
+    @param updated_files: list of paths written by File.dump_json
     """
     logger.debug('file_edit(%s,%s,%s,%s)' % (git_name, git_mail, collection_path, file_id))
     
@@ -507,7 +562,7 @@ def file_edit(collection_path, file_id, git_name, git_mail):
     file_ = entity.file(repo, org, cid, eid, role, sha1)
     
     gitstatus.lock(settings.MEDIA_BASE, 'file_edit')
-    exit,status = file_.save(git_name, git_mail)
+    exit,status = file_.save(git_name, git_mail, updated_files)
     gitstatus_update.apply_async((collection_path,), countdown=2)
     
     return status,collection_path,file_id
@@ -645,6 +700,8 @@ def delete_entity( git_name, git_mail, collection_path, entity_id, agent='' ):
     gitstatus.lock(settings.MEDIA_BASE, 'delete_entity')
     logger.debug('collection_delete_entity(%s,%s,%s,%s,%s)' % (git_name, git_mail, collection_path, entity_id, agent))
     status,message = entity_destroy(git_name, git_mail, collection_path, entity_id, agent)
+    manifest.remove_entity(collection_path, entity_id)
+    catalog.store_catalog().remove_entity(entity_id)
     return status,message,collection_path,entity_id
 
 
@@ -723,6 +780,7 @@ def delete_file( git_name, git_mail, collection_path, entity_id, file_basename,
     updated_files = ['entity.json']
     logger.debug('updated_files: %s' % updated_files)
     status,message = file_destroy(git_name, git_mail, collection_path, entity_id, rm_files, updated_files, agent)
+    objcache.payloads.invalidate(entity.files_path)
     return status,message,collection_path,file_basename
 
 
@@ -743,7 +801,9 @@ class CollectionSyncDebugTask(Task):
         #       starts in webui.views.collections.sync
         collection.unlock(task_id)
         collection.cache_delete()
-        gitstatus.update(settings.MEDIA_BASE, collection_path)
+        # pick up entities changed by the pull
+        catalog.store_catalog().sync_collection(collection_path)
+        gitstatus.update(settings.MEDIA_BASE, collection_path, force=True)
         gitstatus.unlock(settings.MEDIA_BASE, 'collection_sync')
 
 @task(base=CollectionSyncDebugTask, name='collection-sync')
@@ -843,6 +903,9 @@ def session_tasks( request ):
             ctask = tasks[task['id']]
             ctask['status'] = task.get('status', None)
             ctask['result'] = task.get('result', None)
+            # file uploads report bytes copied; see progress_reporter
+            if (ctask['status'] == 'PROGRESS') and (type(ctask['result']) == type({})):
+                ctask['percent'] = ctask['result'].get('percent', 0)
             # try to convert 'result' into a collection/entity/file URL
             if (ctask['status'] != 'FAILURE') and ctask['result']:
                 r = ctask['result']
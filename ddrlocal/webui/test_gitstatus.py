@@ -62,6 +62,141 @@ class GitstatusTests(TestCase):
         expected = os.path.join(BASEDIR, 'tmp', 'ddr-test-123.status')
         self.assertEqual(expected, out)
 
+    def test_collection_locked(self):
+        # only the lock check, so a stand-in Collection will do
+        locks = {}
+        class LockCollection(object):
+            def __init__(self, path):
+                self.path = path
+            def locked(self):
+                return locks.get(self.path, False)
+        real_collection = gitstatus.Collection
+        gitstatus.Collection = LockCollection
+        try:
+            repo = os.path.join(BASEDIR, 'ddr-test-123')
+            self.assertEqual(bool(gitstatus.collection_locked(repo)), False)
+            locks[repo] = 'abc123'
+            self.assertEqual(gitstatus.collection_locked(repo), 'abc123')
+        finally:
+            gitstatus.Collection = real_collection
+    
+    def test_fingerprint(self):
+        repo = os.path.join(BASEDIR, 'ddr-test-123')
+        self.assertEqual(gitstatus.fingerprint(repo), None)
+        os.makedirs(os.path.join(repo, '.git', 'refs', 'heads'))
+        with open(os.path.join(repo, '.git', 'HEAD'), 'w') as f:
+            f.write('ref: refs/heads/master\n')
+        with open(os.path.join(repo, '.git', 'refs', 'heads', 'master'), 'w') as f:
+            f.write('a' * 40)
+        before = gitstatus.fingerprint(repo)
+        self.assertEqual(before, gitstatus.fingerprint(repo))
+        # a fetch writes a remote-tracking ref
+        os.makedirs(os.path.join(repo, '.git', 'refs', 'remotes', 'origin'))
+        with open(os.path.join(repo, '.git', 'refs', 'remotes', 'origin', 'master'), 'w') as f:
+            f.write('b' * 40)
+        self.assertNotEqual(before, gitstatus.fingerprint(repo))
+        gitstatus.write_fingerprint(BASEDIR, repo, before)
+        self.assertEqual(gitstatus.read_fingerprint(BASEDIR, repo), before)
+    
+    def test_queue_db(self):
+        os.makedirs(BASEDIR)
+        queue = gitstatus.Queue(gitstatus.db_path(BASEDIR))
+        now = datetime.now().replace(microsecond=0)
+        queue.load({
+            'generated': now,
+            'collections': [
+                [now + timedelta(seconds=600), 'ddr-test-123'],
+                [datetime.fromtimestamp(0), 'ddr-test-124'],
+                [now - timedelta(seconds=60), 'ddr-test-136'],
+                [datetime.fromtimestamp(0), 'ddr-test-248'],
+            ]
+        })
+        self.assertEqual(len(queue), 4)
+        self.assertEqual(queue.generated(), now)
+        self.assertEqual(queue.next_available(), datetime.fromtimestamp(0))
+        out = [os.path.basename(p) for p in gitstatus.next_repos(queue)]
+        self.assertEqual(out, ['ddr-test-124', 'ddr-test-248', 'ddr-test-136'])
+        # rescheduled after the latest timestamp
+        timestamp = queue.reschedule('ddr-test-124', 60, 1)
+        self.assertEqual(timestamp > now + timedelta(seconds=600), True)
+        out = [os.path.basename(p) for p in gitstatus.next_repos(queue)]
+        self.assertEqual(out, ['ddr-test-248', 'ddr-test-136'])
+        exported = queue.export()
+        self.assertEqual(exported['collections'][-1], [timestamp, 'ddr-test-124'])
+        self.assertEqual(gitstatus.queue_loads(gitstatus.queue_dumps(exported)), exported)
+    
+    def test_elapsed_seconds(self):
+        self.assertEqual(gitstatus.elapsed_seconds('0:00:01.500000'), 1.5)
+        self.assertEqual(gitstatus.elapsed_seconds('1 day, 0:01:00'), 86460.0)
+        self.assertEqual(gitstatus.elapsed_seconds(timedelta(minutes=1, seconds=1.5)), 61.5)
+    
+    def test_adaptive_interval(self):
+        minimum = 3600
+        maximum = 86400
+        new = {'runs': 1, 'elapsed': 100.0, 'change_rate': 0.0, 'state': 'synced'}
+        busy = {'runs': 10, 'elapsed': 1.0, 'change_rate': 1.0, 'state': 'synced'}
+        idle = {'runs': 10, 'elapsed': 1.0, 'change_rate': 0.0, 'state': 'synced'}
+        huge_idle = {'runs': 10, 'elapsed': 250.0, 'change_rate': 0.0, 'state': 'synced'}
+        ahead = {'runs': 10, 'elapsed': 250.0, 'change_rate': 0.0, 'state': 'ahead'}
+        self.assertEqual(gitstatus.adaptive_interval(new, minimum, maximum), minimum)
+        self.assertEqual(gitstatus.adaptive_interval(busy, minimum, maximum), minimum)
+        self.assertEqual(gitstatus.adaptive_interval(idle, minimum, maximum), minimum * gitstatus.IDLE_FACTOR)
+        self.assertEqual(gitstatus.adaptive_interval(huge_idle, minimum, maximum), maximum)
+        self.assertEqual(gitstatus.adaptive_interval(ahead, minimum, maximum), minimum)
+    
+    def test_schedule_next(self):
+        os.makedirs(BASEDIR)
+        queue = gitstatus.Queue(gitstatus.db_path(BASEDIR))
+        queue.load({'generated': datetime.now(), 'collections': [
+            [datetime.fromtimestamp(0), cid] for cid in COLLECTIONS]})
+        data = {'elapsed': '0:00:02', 'sync_status': {'status': 'synced'}}
+        gitstatus.schedule_next(queue, COLLECTIONS[0], data, 60, 3600, 86400)
+        data['unchanged'] = True
+        timestamp = gitstatus.schedule_next(queue, COLLECTIONS[0], data, 60, 3600, 86400)
+        self.assertEqual(timestamp > datetime.now() + timedelta(seconds=3600), True)
+        stats = queue.stats()
+        self.assertEqual([row['collection_id'] for row in stats][-1], COLLECTIONS[0])
+        row = stats[-1]
+        self.assertEqual((row['runs'], row['git_runs'], row['elapsed'], row['state']), (2, 1, 2.0, 'synced'))
+        self.assertEqual(row['change_rate'], 1 - gitstatus.STATS_ALPHA)
+        self.assertEqual(stats[0]['runs'], None)
+        # failures are retried after minimum, not after the latest timestamp
+        queue.schedule(COLLECTIONS[1], datetime.now() + timedelta(days=1))
+        timestamp = gitstatus.schedule_next(queue, COLLECTIONS[2], None, 60, 3600, 86400)
+        self.assertEqual(timestamp < datetime.now() + timedelta(seconds=3600 + 61), True)
+    
+    def test_without_timestamp(self):
+        a = {'status': 'synced', 'color': 'success', 'timestamp': datetime.fromtimestamp(0)}
+        b = {'status': 'synced', 'color': 'success', 'timestamp': datetime.now()}
+        c = {'status': 'locked', 'color': 'warning', 'timestamp': datetime.fromtimestamp(0)}
+        self.assertEqual(gitstatus._without_timestamp(a), gitstatus._without_timestamp(b))
+        self.assertNotEqual(gitstatus._without_timestamp(a), gitstatus._without_timestamp(c))
+        self.assertEqual(gitstatus._without_timestamp(None), {})
+    
+    def test_read_many(self):
+        os.makedirs(os.path.join(BASEDIR, 'tmp'))
+        ts = datetime.fromtimestamp(0)
+        syncstatus = {'status': 'synced'}
+        # written before there was a status table; imported when it is created
+        with open(gitstatus.path(BASEDIR, COLLECTIONS[2]), 'w') as f:
+            f.write(gitstatus.dumps(ts, '0:00:02', 'OLD', 'ANNEX', syncstatus))
+        for cid in COLLECTIONS[:2]:
+            gitstatus.write(BASEDIR, cid, ts, '0:00:01', 'STATUS', 'ANNEX', syncstatus)
+        out = gitstatus.read_many(BASEDIR, COLLECTIONS)
+        self.assertEqual(sorted(out.keys()), COLLECTIONS[:3])
+        self.assertEqual(out[COLLECTIONS[0]]['status'], 'STATUS')
+        self.assertEqual(out[COLLECTIONS[2]]['status'], 'OLD')
+        store = gitstatus.status_db(BASEDIR)
+        self.assertEqual(len(store), 3)
+        # a new status invalidates cached statuses
+        generation = store.generation()
+        gitstatus.write(BASEDIR, COLLECTIONS[0], ts, '0:00:01', 'CHANGED', 'ANNEX', syncstatus)
+        self.assertEqual(store.generation(), generation + 1)
+        self.assertEqual(gitstatus.read(BASEDIR, COLLECTIONS[0])['status'], 'CHANGED')
+        # new timestamps alone do not
+        gitstatus.write(BASEDIR, COLLECTIONS[0], datetime.now(), '0:00:01', 'CHANGED', 'ANNEX', syncstatus, changed=False)
+        self.assertEqual(store.generation(), generation + 1)
+    
     def test_status_paths(self):
         expected = []
         tmp_dir = os.path.join(BASEDIR, 'tmp')
@@ -207,6 +342,22 @@ class GitstatusTests(TestCase):
 
 #    def test_next_repo(self):
 #        pass
+    
+    def test_next_repos(self):
+        now = datetime.now()
+        queue = {
+            'generated': now,
+            'collections': [
+                [now + timedelta(seconds=600), 'ddr-test-123'],
+                [datetime.fromtimestamp(0), 'ddr-test-124'],
+                [now - timedelta(seconds=60), 'ddr-test-136'],
+                [datetime.fromtimestamp(0), 'ddr-test-248'],
+            ]
+        }
+        out = [os.path.basename(p) for p in gitstatus.next_repos(queue)]
+        self.assertEqual(out, ['ddr-test-124', 'ddr-test-248', 'ddr-test-136'])
+        out = [os.path.basename(p) for p in gitstatus.next_repos(queue, limit=2)]
+        self.assertEqual(out, ['ddr-test-124', 'ddr-test-248'])
 #     
 #    def test_update_store(self):
 #        pass
@@ -1,4 +1,21 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+from django.test import TestCase
+
 from ddrlocal import models
+from ddrlocal.models import cache
+from ddrlocal.models import catalog
+from ddrlocal.models import hashing
+from ddrlocal.models import inheritance
+from ddrlocal.models import links
+from ddrlocal.models import manifest
+from ddrlocal.models import meta
+from ddrlocal.models import schema
+from ddrlocal.models import xml
 
 
 def test_git_version():
@@ -7,6 +24,427 @@ def test_git_version():
     assert 'git-annex version' in out
     assert 'local repository version' in out
 
+def _write_entity_json(collection_path, eid, title):
+    entity_path = os.path.join(collection_path, 'files', eid)
+    if not os.path.exists(entity_path):
+        os.makedirs(entity_path)
+    data = [{'application': 'https://github.com/densho/ddr-local.git'},
+            {'id': eid}, {'title': title}, {'public': 1}, {'status': 'inprocess'},
+            {'record_lastmod': '2014-01-01T00:00:00'},
+            {'files': [{'path_rel': 'a.jpg'}, {'path_rel': 'b.jpg'}]},]
+    with open(os.path.join(entity_path, 'entity.json'), 'w') as f:
+        f.write(json.dumps(data))
+    return data
+
+def _write_file_json(entity_path, basename, link_to=''):
+    files_path = os.path.join(entity_path, 'files')
+    if not os.path.exists(files_path):
+        os.makedirs(files_path)
+    data = [{'application': 'https://github.com/densho/ddr-local.git'},
+            {'path_rel': basename}, {'links': link_to},]
+    json_path = os.path.join(files_path, '%s.json' % os.path.splitext(basename)[0])
+    with open(json_path, 'w') as f:
+        f.write(json.dumps(data))
+    return json_path
+
+
+class TmpDirTests(TestCase):
+    """Each test gets a fresh temp dir in self.base, removed afterwards."""
+    
+    def setUp(self):
+        self.base = tempfile.mkdtemp(prefix='test-models-')
+    
+    def tearDown(self):
+        shutil.rmtree(self.base, ignore_errors=True)
+
+
+class ManifestTests(TmpDirTests):
+    
+    def test_manifest(self):
+        cpath = os.path.join(self.base, 'ddr-test-123')
+        _write_entity_json(cpath, 'ddr-test-123-10', 'ten')
+        _write_entity_json(cpath, 'ddr-test-123-2', 'two')
+        entries = manifest.entities(cpath)
+        self.assertEqual([e['id'] for e in entries], ['ddr-test-123-2', 'ddr-test-123-10'])
+        self.assertEqual(entries[0]['title'], 'two')
+        self.assertEqual(entries[0]['files'], 2)
+        self.assertEqual(entries[0]['public'], 1)
+        self.assertTrue(os.path.exists(manifest.manifest_path(cpath)))
+        # incremental update
+        data = _write_entity_json(cpath, 'ddr-test-123-2', 'TWO')
+        manifest.update_entity(cpath, 'ddr-test-123-2', data)
+        self.assertEqual(manifest.read(cpath)['entities']['ddr-test-123-2']['title'], 'TWO')
+        # delete
+        shutil.rmtree(os.path.join(cpath, 'files', 'ddr-test-123-10'))
+        manifest.remove_entity(cpath, 'ddr-test-123-10')
+        entries = manifest.entities(cpath)
+        self.assertEqual([e['id'] for e in entries], ['ddr-test-123-2'])
+        # concurrent updates of different entities are not lost
+        eids = ['ddr-test-123-%s' % n for n in range(3, 9)]
+        datas = [_write_entity_json(cpath, eid, eid) for eid in eids]
+        threads = [threading.Thread(target=manifest.update_entity, args=(cpath, eid, data))
+                   for eid,data in zip(eids, datas)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(sorted(manifest.read(cpath)['entities'].keys()),
+                         sorted(['ddr-test-123-2'] + eids))
+
+
+class CatalogTests(TmpDirTests):
+    
+    def setUp(self):
+        super(CatalogTests, self).setUp()
+        self.collection_path = os.path.join(self.base, 'ddr-test-123')
+        self.catalog = catalog.Catalog(os.path.join(self.base, 'tmp', 'catalog.db'))
+    
+    def test_catalog(self):
+        cpath = self.collection_path
+        cat = self.catalog
+        _write_entity_json(cpath, 'ddr-test-123-1', 'banana')
+        _write_entity_json(cpath, 'ddr-test-123-2', 'Apple')
+        _write_entity_json(cpath, 'ddr-test-123-10', 'cherry')
+        self.assertFalse(cat.has_collection('ddr-test-123'))
+        self.assertEqual(cat.sync_collection(cpath), (3,0))
+        self.assertTrue(cat.has_collection('ddr-test-123'))
+        # nothing changed, nothing read
+        self.assertEqual(cat.sync_collection(cpath), (0,0))
+        entities = cat.entities('ddr-test-123')
+        self.assertEqual(entities.count(), 3)
+        self.assertEqual([e.id for e in entities[0:3]],
+                         ['ddr-test-123-1', 'ddr-test-123-2', 'ddr-test-123-10'])
+        self.assertEqual(entities[2].file_count, 2)
+        titles = cat.entities('ddr-test-123', sort='title')
+        self.assertEqual([e.title for e in titles[1:3]], ['banana', 'cherry'])
+        self.assertEqual([e.id for e in cat.entities('ddr-test-123', q='CHER')[0:10]],
+                         ['ddr-test-123-10'])
+        # incremental update
+        data = _write_entity_json(cpath, 'ddr-test-123-2', 'zebra')
+        cat.update_entity(cpath, 'ddr-test-123-2', data)
+        self.assertEqual(cat.entities('ddr-test-123', sort='-title')[0].title, 'zebra')
+        # deleted outside ddr-local
+        shutil.rmtree(os.path.join(cpath, 'files', 'ddr-test-123-1'))
+        self.assertEqual(cat.sync_collection(cpath), (0,1))
+        self.assertEqual(cat.entities('ddr-test-123').count(), 2)
+    
+    def test_catalog_search(self):
+        cpath = self.collection_path
+        cat = self.catalog
+        _write_entity_json(cpath, 'ddr-test-123-1', 'Manzanar camp')
+        _write_entity_json(cpath, 'ddr-test-123-2', 'Tule Lake')
+        file_json = os.path.join(cpath, 'files', 'ddr-test-123-1', 'files', 'a.json')
+        os.makedirs(os.path.dirname(file_json))
+        with open(file_json, 'w') as f:
+            f.write(json.dumps([{}, {'label': 'camp newsletter'}, {'basename_orig': 'scan.tif'}]))
+        cat.sync_collection(cpath)
+        hits = cat.search('camp')
+        self.assertEqual(hits.count(), 2)
+        self.assertEqual([(h['model'], h['id']) for h in hits[0:10]],
+                         [('entity', 'ddr-test-123-1'), ('file', 'a')])
+        self.assertEqual(cat.search('camp', models=['file'])[0]['label'], 'camp newsletter')
+        # operators and stray quotes in queries are just words
+        self.assertEqual(cat.search('tule OR "lake').count(), 0)
+        self.assertEqual(cat.search('tule lake').count(), 1)
+        # best match first, not in ID order
+        entity_json = os.path.join(cpath, 'files', 'ddr-test-123-10', 'entity.json')
+        os.makedirs(os.path.dirname(entity_json))
+        with open(entity_json, 'w') as f:
+            f.write(json.dumps([{}, {'id': 'ddr-test-123-10'}, {'title': 'Lake photos'},
+                                {'description': 'taken near Tule'}]))
+        cat.sync_collection(cpath)
+        self.assertEqual([h['id'] for h in cat.search('tule lake')[0:10]],
+                         ['ddr-test-123-2', 'ddr-test-123-10'])
+        # removed entities drop out
+        shutil.rmtree(os.path.join(cpath, 'files', 'ddr-test-123-1'))
+        cat.sync_collection(cpath)
+        self.assertEqual(cat.search('camp').count(), 0)
+    
+    def test_catalog_scan(self):
+        cpath = self.collection_path
+        cat = self.catalog
+        _write_entity_json(cpath, 'ddr-test-123-1', 'Manzanar camp')
+        with open(os.path.join(cpath, 'collection.json'), 'w') as f:
+            f.write(json.dumps([{}, {'id': 'ddr-test-123'}, {'title': 'Camps'}]))
+        self.assertEqual(cat.scanned(), None)
+        self.assertEqual(cat.scan_if_due(self.base, 60), True)
+        self.assertNotEqual(cat.scanned(), None)
+        self.assertEqual(cat.search('camp').count(), 1)
+        # throttled
+        self.assertEqual(cat.scan_if_due(self.base, 60), False)
+        self.assertEqual(cat.scan_if_due(self.base, 0), True)
+
+
+class CacheTests(TmpDirTests):
+    
+    def test_object_cache(self):
+        class Thing(object):
+            pass
+        path = os.path.join(self.base, 'thing.json')
+        with open(path, 'w') as f:
+            f.write('[]')
+        objects = cache.ObjectCache(size=2)
+        thing = Thing()
+        thing.tags = ['a']
+        signature = cache.file_signature(path)
+        objects.put(Thing, path, signature, thing)
+        # callers get copies
+        copy1 = objects.get(Thing, path, signature)
+        copy1.tags.append('b')
+        self.assertEqual(objects.get(Thing, path, signature).tags, ['a'])
+        # changed file
+        with open(path, 'w') as f:
+            f.write('[{}]')
+        self.assertEqual(objects.get(Thing, path, cache.file_signature(path)), None)
+        # explicit invalidation
+        objects.put(Thing, path, signature, thing)
+        objects.invalidate(path)
+        self.assertEqual(objects.get(Thing, path, signature), None)
+        # size bound
+        for n in range(3):
+            objects.put(Thing, str(n), signature, thing)
+        self.assertEqual(objects.get(Thing, '0', signature), None)
+        self.assertTrue(objects.get(Thing, '2', signature))
+    
+    def test_tree_cache(self):
+        path = os.path.join(self.base, 'mets.xml')
+        with open(path, 'w') as f:
+            f.write('<mets><a/></mets>')
+        trees = xml.TreeCache(size=2)
+        tree = trees.parse(path)
+        tree.getroot().append(xml.etree.Element('b'))
+        # callers get copies
+        self.assertEqual(len(trees.parse(path).getroot()), 1)
+        # writers put what they wrote; the next parse is a hit
+        with open(path, 'w') as f:
+            f.write(xml.etree.tostring(tree, pretty_print=True))
+        trees.put(path)
+        self.assertEqual(trees._data[path][0], cache.stat_signature(path))
+        # what was parsed from the file, not the tree it was written from
+        self.assertEqual(xml.etree.tostring(trees.parse(path)),
+                         xml.etree.tostring(xml.etree.parse(path)))
+        self.assertEqual([e.tag for e in trees.parse(path).getroot()], ['a', 'b'])
+    
+    def test_payload_index(self):
+        path = self.base
+        for filename in ['ddr-test-123-1-master-a1b2c3d4e5.jpg',
+                         'ddr-test-123-1-master-a1b2c3d4e5.json',
+                         'ddr-test-123-1-master-a1b2c3d4e5-a.jpg',]:
+            with open(os.path.join(path, filename), 'w') as f:
+                f.write('')
+        payloads = cache.PayloadIndex()
+        self.assertEqual(payloads.payload(path, 'ddr-test-123-1-master-a1b2c3d4e5'),
+                         os.path.join(path, 'ddr-test-123-1-master-a1b2c3d4e5.jpg'))
+        self.assertEqual(payloads.payload(path, 'ddr-test-123-1-master-f6e5d4c3b2'), None)
+        with open(os.path.join(path, 'ddr-test-123-1-master-f6e5d4c3b2.tif'), 'w') as f:
+            f.write('')
+        payloads.invalidate(path)
+        self.assertEqual(payloads.payload(path, 'ddr-test-123-1-master-f6e5d4c3b2'),
+                         os.path.join(path, 'ddr-test-123-1-master-f6e5d4c3b2.tif'))
+    
+    def test_hash_cache(self):
+        path = os.path.join(self.base, 'file.txt')
+        with open(path, 'w') as f:
+            f.write('abc')
+        hashes = hashing.HashCache(os.path.join(self.base, 'tmp', 'hashes.db'))
+        sha1 = 'a9993e364706816aba3e25717850c26c9cd0d89d'
+        self.assertEqual(hashing.hash_file(path, ['sha1'], cache=hashes), {'sha1': sha1})
+        self.assertEqual(hashes.get(os.stat(path)), {'sha1': sha1})
+        # cached value is used...
+        hashes.put(os.stat(path), {'sha1': 'cached'})
+        self.assertEqual(hashing.hash_file(path, ['sha1'], cache=hashes)['sha1'], 'cached')
+        # ...unless verifying
+        self.assertEqual(hashing.hash_file(path, ['sha1'], verify=True, cache=hashes)['sha1'], sha1)
+        # copy caches the destination
+        dest = os.path.join(self.base, 'copy.txt')
+        digests = hashing.copy_and_hash(path, dest, ['sha1', 'md5'], cache=hashes)
+        self.assertEqual(hashes.get(os.stat(dest)), digests)
+
+
+class SchemaTests(TestCase):
+    
+    def test_compile_hooks(self):
+        class Module(object):
+            display_title = staticmethod(lambda value: value.upper())
+            display_notes = 'not a function'
+        fields = [{'name':'title'}, {'name':'notes'}, {'name':'status'}]
+        display = schema.compile_hooks(Module, fields, 'display')
+        self.assertEqual(display['title']('abc'), 'ABC')
+        self.assertIs(display['notes'], schema.identity)
+        self.assertIs(display['status'], schema.identity)
+    
+    def test_schema_changed(self):
+        class Module(object):
+            pass
+        class Obj(object):
+            pass
+        fields = [{'name':'title'}, {'name':'topics'}, {'name':'files'}]
+        fschema = schema.FieldSchema(Module, fields, tracked=['title', 'topics'])
+        o = Obj()
+        o.title = 'title'
+        o.topics = ['a']
+        o.files = []
+        snapshot = fschema.snapshot(o)
+        self.assertEqual(fschema.changed(o, snapshot), [])
+        # in-place edits are seen; untracked fields are not
+        o.topics.append('b')
+        o.files.append('c')
+        self.assertEqual(fschema.changed(o, snapshot), ['topics'])
+        self.assertEqual(fschema.changed(o, None), ['title', 'topics'])
+
+
+class LazyFileTests(TestCase):
+    
+    def test_lazyfile(self):
+        loaded = []
+        class FakeFile(object):
+            def __init__(self, path_abs=None):
+                loaded.append(path_abs)
+                self.path_abs = path_abs
+                self.label = 'label'
+        path_abs = '/base/ddr-test-123/files/ddr-test-123-1/files/ddr-test-123-1-master-a1b2c3d4e5.jpg'
+        fdict = {'path_rel': 'ddr-test-123-1-master-a1b2c3d4e5.jpg', 'role': 'master', 'sha1': 'a1b2c3d4e5',}
+        f = models.LazyFile(FakeFile, path_abs, fdict)
+        self.assertEqual(f.role, 'master')
+        self.assertEqual(f.basename, 'ddr-test-123-1-master-a1b2c3d4e5.jpg')
+        self.assertEqual(loaded, [])
+        self.assertEqual(f.label, 'label')
+        self.assertEqual(len(loaded), 1)
+        # copies (e.g. in cache.objects) do not carry loaded file data
+        f_copy = cache.copy_object(f)
+        self.assertFalse(f_copy.loaded())
+        self.assertEqual(f_copy.label, 'label')
+        self.assertEqual(len(loaded), 2)
+        files = models.FileList([f, f, f])
+        self.assertTrue(isinstance(files[1:], models.FileList))
+        f2 = models.LazyFile(FakeFile, path_abs, fdict)
+        self.assertEqual(models.entity_file_dict(f2), fdict)
+        self.assertFalse(f2.loaded())
+        # files are sorted without loading their JSON...
+        fdict = dict(fdict, sort=2)
+        f3 = models.LazyFile(FakeFile, path_abs, fdict)
+        self.assertEqual(f3.sort, 2)
+        self.assertFalse(f3.loaded())
+        # ...unless entity.json predates sort
+        f4 = models.LazyFile(FakeFile, path_abs, {'role': 'master'})
+        try:
+            f4.sort
+        except AttributeError:
+            pass
+        self.assertTrue(f4.loaded())
+    
+    def test_filelist_version(self):
+        files = models.FileList()
+        self.assertEqual(files.version, 0)
+        files.append('a')
+        files.extend(['c', 'b'])
+        files.sort()
+        del files[0]
+        self.assertEqual(files, ['b', 'c'])
+        self.assertEqual(files.version, 4)
+        # copies keep the version so indexes made before caching stay valid
+        self.assertEqual(cache._copy_value(files).version, 4)
+
+
+class MetaTests(TmpDirTests):
+    
+    def test_patch_json(self):
+        path = os.path.join(self.base, 'entity.json')
+        data = [{'application': 'https://github.com/densho/ddr-local.git'},
+                {'id': 'ddr-test-123-1'}, {'rights': 'pcr'}, {'public': 1},]
+        with open(path, 'w') as f:
+            f.write(meta.format_json(data))
+        # no change, no write
+        mtime = os.path.getmtime(path)
+        self.assertEqual(meta.patch_json(path, [('rights','pcr')]), (False, data))
+        self.assertEqual(os.path.getmtime(path), mtime)
+        # only the patched key differs; the missing key goes in its place
+        changed,patched = meta.patch_json(path, [('rights','cc'), ('status','completed')],
+                                          implicit={'status': ''},
+                                          order=['id', 'status', 'rights', 'public'])
+        self.assertTrue(changed)
+        data[2]['rights'] = 'cc'
+        data.insert(2, {'status': 'completed'})
+        with open(path, 'r') as f:
+            self.assertEqual(f.read(), meta.format_json(data))
+    
+    def test_patch_json_file_dict(self):
+        path = os.path.join(self.base, 'entity.json')
+        data = [{'id': 'ddr-test-123-1'},
+                {'files': [{'path_rel': 'a.jpg', 'public': 1}, {'path_rel': 'b.jpg', 'public': 1}]},]
+        with open(path, 'w') as f:
+            f.write(meta.format_json(data))
+        changed,patched = meta.patch_json_file_dict(path, {'path_rel': 'b.jpg', 'public': 1, 'sort': 3})
+        self.assertTrue(changed)
+        self.assertEqual(patched[1]['files'][1], {'path_rel': 'b.jpg', 'public': 1, 'sort': 3})
+        self.assertEqual(patched[1]['files'][0], {'path_rel': 'a.jpg', 'public': 1})
+        self.assertEqual(meta.patch_json_file_dict(path, {'path_rel': 'b.jpg', 'sort': 3}),
+                         (False, patched))
+
+
+class LinksTests(TmpDirTests):
+    
+    def test_links(self):
+        epath = os.path.join(self.base, 'ddr-test-123', 'files', 'ddr-test-123-1')
+        a = 'ddr-test-123-1-master-a1b2c3d4e5.jpg'
+        b = 'ddr-test-123-1-mezzanine-f6e5d4c3b2.jpg'
+        _write_file_json(epath, a, b)
+        json_b = _write_file_json(epath, b)
+        self.assertEqual(links.incoming(epath, b), [a])
+        self.assertEqual(links.incoming(epath, a), [])
+        self.assertTrue(os.path.exists(links.graph_path(epath)))
+        # file JSON rewritten in place, graph updated by dump_json
+        _write_file_json(epath, b, a)
+        links.update_file(epath, json_b, b, a)
+        self.assertEqual(links.incoming(epath, a), [b])
+        # concurrent updates of different files are not lost
+        c = 'ddr-test-123-1-mezzanine-0a1b2c3d4e.jpg'
+        json_c = _write_file_json(epath, c)
+        links.graph(epath)
+        json_a = _write_file_json(epath, a, c)
+        _write_file_json(epath, c, a)
+        threads = [threading.Thread(target=links.update_file, args=(epath, json_a, a, c)),
+                   threading.Thread(target=links.update_file, args=(epath, json_c, c, a)),]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(links.incoming(epath, a), [c, b])
+        self.assertEqual(links.incoming(epath, c), [a])
+        # links with a path in front still match the basename
+        link_to = 'files/%s; /var/www/media/base/%s' % (a, c)
+        _write_file_json(epath, b, link_to)
+        links.update_file(epath, json_b, b, link_to)
+        self.assertEqual(links.incoming(epath, a), [c, b])
+        self.assertEqual(links.incoming(epath, c), [a, b])
+
+
+class InheritanceTests(TmpDirTests):
+    
+    def test_inheritance_propagate(self):
+        cpath = os.path.join(self.base, 'ddr-test-123')
+        entity_path = os.path.join(cpath, 'files', 'ddr-test-123-1')
+        os.makedirs(os.path.join(entity_path, 'files'))
+        with open(os.path.join(cpath, 'collection.json'), 'w') as f:
+            f.write(json.dumps([{'id': 'ddr-test-123'}, {'rights': 'cc'}]))
+        with open(os.path.join(entity_path, 'entity.json'), 'w') as f:
+            f.write(json.dumps([{'id': 'ddr-test-123-1'}, {'rights': 'pcr'}]))
+        file_json = os.path.join(entity_path, 'files', 'ddr-test-123-1-master-a1b2c3d4e5.json')
+        with open(file_json, 'w') as f:
+            f.write(json.dumps([{'path_rel': 'ddr-test-123-1-master-a1b2c3d4e5.jpg'}, {'rights': 'cc'}]))
+        cat = catalog.Catalog(os.path.join(self.base, 'tmp', 'catalog.db'))
+        child_ids,changed_files = inheritance.propagate(cpath, [('rights','cc')], store_catalog=cat)
+        self.assertEqual(child_ids, ['ddr-test-123-1'])
+        self.assertEqual(changed_files, [os.path.join(entity_path, 'entity.json')])
+        # nothing left to change
+        self.assertEqual(inheritance.propagate(cpath, [('rights','cc')], store_catalog=cat), ([],[]))
+        # file JSONs patched without touching entity.json are reindexed
+        cat.sync_collection(cpath)
+        self.assertEqual(cat.search('pdm').count(), 0)
+        inheritance.propagate(entity_path, [('rights','pdm')], store_catalog=cat)
+        self.assertEqual([h['id'] for h in cat.search('pdm')[0:10]],
+                         ['ddr-test-123-1-master-a1b2c3d4e5'])
+
 # TODO module_function
 # TODO module_xml_function
 # TODO write_json
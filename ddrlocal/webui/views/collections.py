@@ -1,9 +1,10 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 import json
 import logging
 logger = logging.getLogger(__name__)
 import os
 import random
+import sqlite3
 
 from bs4 import BeautifulSoup
 
@@ -23,6 +24,8 @@ from DDR import commands
 from DDR import docstore
 from DDR.models import make_object_id, id_from_path
 
+from ddrlocal.models import catalog
+from ddrlocal.models.catalog import ENTITY_SORTS
 from ddrlocal.models.collection import COLLECTION_FIELDS
 
 from storage.decorators import storage_required
@@ -32,6 +35,7 @@ from webui.decorators import ddrview, search_index
 from webui.forms import DDRForm
 from webui.forms.collections import NewCollectionForm, UpdateForm, SyncConfirmForm
 from webui import gitolite
+from webui import gitstatus
 from webui.models import Collection, COLLECTION_STATUS_CACHE_KEY, COLLECTION_STATUS_TIMEOUT
 from webui.tasks import collection_new_expert, collection_edit, collection_sync
 from webui.tasks import csv_export_model, export_csv_path, gitstatus_update
@@ -69,12 +73,18 @@ def collections( request ):
                 repo,org,cid = c[0],c[1],c[2]
                 collection = Collection.from_json(Collection.collection_path(request,repo,org,cid))
                 colls.append(collection)
-                gitstatus = collection.gitstatus()
-                if gitstatus and gitstatus.get('sync_status'):
-                    collection.sync_status = gitstatus['sync_status']
-                else:
-                    collection_status_urls.append( "'%s'" % collection.sync_status_url())
         collections.append( (o,repo,org,colls) )
+    # statuses for all collections in one read
+    statuses = gitstatus.read_many(
+        settings.MEDIA_BASE,
+        [collection.id for o,repo,org,colls in collections for collection in colls])
+    for o,repo,org,colls in collections:
+        for collection in colls:
+            status = statuses.get(collection.id, None)
+            if status and status.get('sync_status'):
+                collection.sync_status = status['sync_status']
+            else:
+                collection_status_urls.append( "'%s'" % collection.sync_status_url())
     # load statuses in random order
     random.shuffle(collection_status_urls)
     return render_to_response(
@@ -84,6 +94,34 @@ def collections( request ):
         context_instance=RequestContext(request, processors=[])
     )
 
+@storage_required
+def gitstatus_schedule( request ):
+    """gitstatus update schedule and the per-collection stats it is based on.
+    """
+    maximum = getattr(settings, 'GITSTATUS_MAX_INTERVAL', None)
+    rows = []
+    try:
+        queue = gitstatus.queue_db(settings.MEDIA_BASE)
+        generated = queue.generated()
+        for stats in queue.stats():
+            if maximum:
+                stats['interval'] = timedelta(seconds=gitstatus.adaptive_interval(
+                    stats, settings.GITSTATUS_INTERVAL, maximum))
+            else:
+                stats['interval'] = timedelta(seconds=settings.GITSTATUS_INTERVAL)
+            rows.append(stats)
+    except sqlite3.Error as err:
+        logger.error('gitstatus db: %s' % err)
+        messages.error(request, 'Could not read gitstatus queue: %s' % err)
+        generated = None
+    return render_to_response(
+        'webui/collections/gitstatus-schedule.html',
+        {'generated': generated,
+         'adaptive': bool(maximum),
+         'rows': rows,},
+        context_instance=RequestContext(request, processors=[])
+    )
+
 @storage_required
 def detail( request, repo, org, cid ):
     collection = Collection.from_json(Collection.collection_path(request,repo,org,cid))
@@ -102,7 +140,25 @@ def detail( request, repo, org, cid ):
 def entities( request, repo, org, cid ):
     collection = Collection.from_json(Collection.collection_path(request,repo,org,cid))
     alert_if_conflicted(request, collection)
-    entities = collection.entities(quick=True)
+    sort = request.GET.get('sort', 'id')
+    if sort not in ENTITY_SORTS:
+        sort = 'id'
+    q = request.GET.get('q', '').strip()
+    # page/sort/filter in the catalog.  Rows are kept current by dump_json,
+    # the post-sync task and catalog_scan; a collection is only synced here
+    # if it is not in the catalog yet.
+    try:
+        store_catalog = catalog.store_catalog()
+        if not store_catalog.has_collection(collection.id):
+            store_catalog.sync_collection(collection.path)
+        entities = store_catalog.entities(collection.id, sort=sort, q=q)
+        entities.count()
+    except sqlite3.Error as err:
+        logger.error('catalog unavailable: %s' % err)
+        entities = collection.entities(quick=True)
+        if q:
+            entities = [e for e in entities
+                        if (q.lower() in e.id.lower()) or (q.lower() in (e.title or '').lower())]
     # paginate
     thispage = request.GET.get('page', 1)
     paginator = Paginator(entities, settings.RESULTS_PER_PAGE)
@@ -115,7 +171,9 @@ def entities( request, repo, org, cid ):
          'collection': collection,
          'paginator': paginator,
          'page': page,
-         'thispage': thispage,},
+         'thispage': thispage,
+         'sort': sort,
+         'q': q,},
         context_instance=RequestContext(request, processors=[])
     )
 
@@ -169,6 +227,18 @@ def git_status( request, repo, org, cid ):
         context_instance=RequestContext(request, processors=[])
     )
 
+@ddrview
+@login_required
+@storage_required
+def git_status_refresh( request, repo, org, cid ):
+    """Queues a git status update that runs git even if the repo looks unchanged.
+    """
+    collection = Collection.from_json(Collection.collection_path(request,repo,org,cid))
+    if request.method == 'POST':
+        gitstatus_update.apply_async((collection.path,), {'force': True}, countdown=2)
+        messages.success(request, WEBUI_MESSAGES['VIEWS_COLL_GITSTATUS_REFRESH'].format(collection.id))
+    return HttpResponseRedirect( reverse('webui-collection-git-status', args=[repo,org,cid]) )
+
 @storage_required
 def ead_xml( request, repo, org, cid ):
     collection = Collection.from_json(Collection.collection_path(request,repo,org,cid))
@@ -344,9 +414,11 @@ def edit( request, repo, org, cid ):
         if form.is_valid():
             
             collection.form_post(form)
-            collection.dump_json()
-            collection.dump_ead()
-            updated_files = [collection.json_path, collection.ead_path,]
+            updated_files = []
+            if collection.dump_json():
+                updated_files.append(collection.json_path)
+            if collection.dump_ead():
+                updated_files.append(collection.ead_path)
             
             # if inheritable fields selected, propagate changes to child objects
             inheritables = collection.selected_inheritables(form.cleaned_data)
@@ -355,7 +427,8 @@ def edit( request, repo, org, cid ):
                 updated_files = updated_files + modified_files
             
             # commit files, delete cache, update search index, update git status
-            collection_edit(request, collection, updated_files, git_name, git_mail)
+            if updated_files:
+                collection_edit(request, collection, updated_files, git_name, git_mail)
             
             return HttpResponseRedirect(collection.url())
         
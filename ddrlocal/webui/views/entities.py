@@ -22,6 +22,7 @@ from django.template import RequestContext
 from DDR import commands
 from DDR import docstore
 
+from ddrlocal.models import catalog
 from ddrlocal.models.entity import ENTITY_FIELDS
 
 from storage.decorators import storage_required
@@ -470,11 +471,12 @@ def edit( request, repo, org, cid, eid ):
             
             # commit files, delete cache, update search index, update git status
             # in the background
-            collection_entity_edit(
-                request,
-                collection, entity, updated_files,
-                git_name, git_mail, settings.AGENT
-            )
+            if updated_files:
+                collection_entity_edit(
+                    request,
+                    collection, entity, updated_files,
+                    git_name, git_mail, settings.AGENT
+                )
             
             return HttpResponseRedirect( reverse('webui-entity', args=[repo,org,cid,eid]) )
     else:
@@ -550,6 +552,7 @@ def edit_json( request, repo, org, cid, eid ):
                 # TODO validate XML
                 with open(entity.json_path, 'w') as f:
                     f.write(json)
+                catalog.store_catalog().update_entity(entity.parent_path, entity.id)
                 
                 exit,status = commands.entity_update(git_name, git_mail,
                                                      entity.parent_path, entity.id,
@@ -647,14 +650,18 @@ def files_dedupe( request, repo, org, cid, eid ):
             # remove duplicates
             entity.rm_file_duplicates()
             # update metadata files
-            entity.dump_json()
-            entity.dump_mets()
-            updated_files = [entity.json_path, entity.mets_path,]
+            updated_files = []
+            if entity.dump_json():
+                updated_files.append(entity.json_path)
+            if entity.dump_mets():
+                updated_files.append(entity.mets_path)
             success_msg = WEBUI_MESSAGES['VIEWS_ENT_UPDATED']
-            exit,status = commands.entity_update(git_name, git_mail,
-                                                 entity.parent_path, entity.id,
-                                                 updated_files,
-                                                 agent=settings.AGENT)
+            exit,status = 0,''
+            if updated_files:
+                exit,status = commands.entity_update(git_name, git_mail,
+                                                     entity.parent_path, entity.id,
+                                                     updated_files,
+                                                     agent=settings.AGENT)
             collection.cache_delete()
             if exit:
                 messages.error(request, WEBUI_MESSAGES['ERROR'].format(status))
@@ -335,10 +335,10 @@ def edit( request, repo, org, cid, eid, role, sha1 ):
         if form.is_valid():
             
             file_.form_post(form)
-            file_.dump_json()
             
             # commit files, delete cache, update search index, update git status
-            entity_file_edit(request, collection, file_, git_name, git_mail)
+            if file_.dump_json():
+                entity_file_edit(request, collection, file_, git_name, git_mail)
             
             return HttpResponseRedirect( file_.url() )
             
@@ -393,12 +393,17 @@ def edit_old( request, repo, org, cid, eid, role, sha1 ):
             f.xmp = form.cleaned_data['xmp']
             result = entity.file(repo, org, cid, eid, role, sha1, f)
             if result in ['added','updated']:
-                entity.dump_json()
-                entity.dump_mets()
-                exit,status = commands.entity_update(git_name, git_mail,
-                                                     entity.parent_path, entity.id,
-                                                     [entity.json_path, entity.mets_path,],
-                                                     agent=settings.AGENT)
+                updated_files = []
+                if entity.dump_json():
+                    updated_files.append(entity.json_path)
+                if entity.dump_mets():
+                    updated_files.append(entity.mets_path)
+                exit,status = 0,''
+                if updated_files:
+                    exit,status = commands.entity_update(git_name, git_mail,
+                                                         entity.parent_path, entity.id,
+                                                         updated_files,
+                                                         agent=settings.AGENT)
                 if exit:
                     messages.error(request, WEBUI_MESSAGES['ERROR'].format(status))
                 else:
@@ -2,6 +2,7 @@ from datetime import datetime
 from decimal import Decimal
 import logging
 logger = logging.getLogger(__name__)
+import sqlite3
 
 from dateutil import parser
 
@@ -18,11 +19,14 @@ from django.utils.http import urlquote  as django_urlquote
 from elasticsearch import Elasticsearch
 
 from DDR import docstore, models
+from ddrlocal.models import catalog
+from webui import set_docstore_index
 from webui import tasks
 from webui.decorators import search_index
 from webui.forms.search import SearchForm, IndexConfirmForm, DropConfirmForm
 
 BAD_CHARS = ('{', '}', '[', ']')
+CATALOG_SCAN_CACHE_KEY = 'webui:search:catalog-scan'
 
 
 # helpers --------------------------------------------------------------
@@ -53,6 +57,23 @@ def massage_query_results( results, thispage, size ):
             o['absolute_url'] = make_object_url(parts)
     return objects
 
+def local_search( request, query ):
+    """Full-text search of the Store's JSON in the local catalog.
+    
+    Used when there is no Elasticsearch index; see ddrlocal.models.catalog.
+    The catalog is kept up to date by saves and by the catalog_scan task;
+    if the Store has never been scanned a scan is started in the background.
+    
+    @returns: catalog.Query of result dicts
+    """
+    store_catalog = catalog.store_catalog()
+    if store_catalog.scanned() is None:
+        # only one scan at a time
+        if cache.add(CATALOG_SCAN_CACHE_KEY, 'true', settings.CATALOG_SCAN_INTERVAL):
+            tasks.catalog_scan.apply_async(countdown=2)
+        messages.info(request, 'The local search index is being built. Results may be incomplete.')
+    return store_catalog.search(query)
+
 
 # views ----------------------------------------------------------------
 
@@ -68,10 +89,22 @@ def index( request ):
         context_instance=RequestContext(request, processors=[])
     )
 
-@search_index
 def results( request ):
     """Results of a search query or a DDR ID query.
+    
+    If there is no Elasticsearch index for the mounted Store the local
+    catalog's full-text index is searched instead; it is paged in the
+    query (LIMIT/OFFSET), not in Python.
     """
+    # same messages as @search_index, except that without an index
+    # the Store's local catalog is searched
+    storage_label,docstore_index_exists = set_docstore_index(request)
+    if storage_label and not docstore_index_exists:
+        messages.warning(request, 'No search index for %s. Searching local files.' % (storage_label))
+    elif docstore_index_exists and not storage_label:
+        messages.warning(request, 'No storage devices mounted. Search is disabled.')
+    elif not storage_label:
+        messages.warning(request, 'No storage devices mounted and no search index. Search is disabled.')
     target_index = docstore.target_index(settings.DOCSTORE_HOSTS, settings.DOCSTORE_INDEX)
     template = 'webui/search/results.html'
     context = {
@@ -102,6 +135,23 @@ def results( request ):
         sort = {'record_created': request.GET.get('record_created', ''),
                 'record_lastmod': request.GET.get('record_lastmod', ''),}
         
+        if storage_label and not docstore_index_exists:
+            thispage = request.GET.get('page', 1)
+            try:
+                paginator = Paginator(local_search(request, query), settings.RESULTS_PER_PAGE)
+                page = paginator.page(thispage)
+                for o in page.object_list:
+                    parts = models.split_object_id(o['id'])
+                    o['absolute_url'] = make_object_url(parts[1:])
+                context['paginator'] = paginator
+                context['page'] = page
+            except sqlite3.Error as err:
+                logger.error('local search: %s' % err)
+                context['error_message'] = 'Search query "%s" caused an error. Please try again.' % query
+            return render_to_response(
+                template, context, context_instance=RequestContext(request, processors=[])
+            )
+        
         # do query and cache the results
         results = docstore.search(settings.DOCSTORE_HOSTS, settings.DOCSTORE_INDEX,
                                   query=query, filters=filters,
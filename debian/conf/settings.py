@@ -141,6 +141,26 @@ if config.has_option('local', 'gitstatus_use_global_lock'):
 # Minimum interval between git-status updates per collection repository.
 GITSTATUS_INTERVAL = 60*60*1
 GITSTATUS_BACKOFF = 30
+# Maximum interval for repositories that rarely change or are slow to check.
+# Intervals between GITSTATUS_INTERVAL and this are set per repository
+# from its gitstatus history.  Set to 0 to use GITSTATUS_INTERVAL for all.
+GITSTATUS_MAX_INTERVAL = 60*60*24
+if config.has_option('local', 'gitstatus_max_interval'):
+    GITSTATUS_MAX_INTERVAL = config.getint('local', 'gitstatus_max_interval')
+# Number of collection repositories each gitstatus-update run checks at
+# the same time, and how long (seconds) a run may keep starting new checks.
+# Keep the time budget below the celerybeat interval (60s).
+# Set concurrency to 1 to check one repository per run.
+GITSTATUS_CONCURRENCY = 4
+if config.has_option('local', 'gitstatus_concurrency'):
+    GITSTATUS_CONCURRENCY = config.getint('local', 'gitstatus_concurrency')
+GITSTATUS_TIME_BUDGET = 45
+if config.has_option('local', 'gitstatus_time_budget'):
+    GITSTATUS_TIME_BUDGET = config.getint('local', 'gitstatus_time_budget')
+# Most collections a run takes from the queue; the rest wait for the next run.
+GITSTATUS_BATCH = GITSTATUS_CONCURRENCY * 4
+if config.has_option('local', 'gitstatus_batch'):
+    GITSTATUS_BATCH = config.getint('local', 'gitstatus_batch')
 # Indicates whether or not gitstatus_update_store periodic task is active.
 # This should be True for most single-user workstations.
 # See CELERYBEAT_SCHEDULE below.
@@ -153,6 +173,13 @@ GITSTATUS_BACKGROUND_ACTIVE = True
 if config.has_option('local', 'gitstatus_background_active'):
     GITSTATUS_BACKGROUND_ACTIVE = config.get('local', 'gitstatus_background_active')
 
+# Minimum time (seconds) between scans of the whole Store for the local
+# catalog/search index (see ddrlocal.models.catalog).  Edits made in
+# ddr-local update the catalog immediately; scans pick up git pulls etc.
+CATALOG_SCAN_INTERVAL = 60*15
+if config.has_option('local', 'catalog_scan_interval'):
+    CATALOG_SCAN_INTERVAL = config.getint('local', 'catalog_scan_interval')
+
 # ----------------------------------------------------------------------
 
 import djcelery
@@ -222,7 +249,11 @@ CELERYBEAT_SCHEDULE = {
     'webui-gitolite-info-refresh': {
         'task': 'webui.tasks.gitolite_info_refresh',
         'schedule': timedelta(seconds=GITOLITE_INFO_CHECK_PERIOD),
-    }
+    },
+    'webui-catalog-scan': {
+        'task': 'webui.tasks.catalog_scan',
+        'schedule': timedelta(seconds=CATALOG_SCAN_INTERVAL),
+    },
 }
 if GITSTATUS_BACKGROUND_ACTIVE:
     CELERYBEAT_SCHEDULER = 'djcelery.schedulers.DatabaseScheduler'